@@ -4,14 +4,26 @@ import network
 import socket
 import machine
 import sys
+import errno
+import struct
+import json
+import os
+import hashlib
+import select
+from array import array
 try:
     import ntptime
 except:
     ntptime = None
 try:
-    import urequests
-except:
-    urequests = None
+    import micropython
+    micropython.alloc_emergency_exception_buf(100)
+except ImportError:
+    micropython = None
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
 
 # I2C LCD (PCF8574 backpack)
 I2C_SCL = 9
@@ -26,9 +38,39 @@ RS485_SLAVE = 1
 RS485_FUNC = 0x03  # 0x03=holding registers, 0x04=input registers
 RS485_REG = 0x0000
 RS485_COUNT = 1
+RS485_TIMEOUT_MS = 100  # worst-case slave turnaround allowance on top of the frame time
+RS485_TIMEOUT_MIN_MS = 10  # floor for the per-slave adaptive timeout
+RS485_TIMEOUT_BACKOFF = 3  # consecutive misses before the adaptive timeout starts doubling
+RS485_SCAN_TIMEOUT_MS = 20  # turnaround allowance per probe during a bus scan
+RS485_SCAN_BAUDS = (9600, 19200, 4800, 38400, 2400, 57600, 115200)
+# Register map: name:offset:type:order:scale, comma separated. offset is in registers from RS485_REG,
+# type int16/uint16/int32/uint32/float32, order ABCD (big-endian), CDAB, BADC or DCBA.
+# The first channel is the PT100 temperature shown on the LCD and uploaded.
+RS485_MAP = "temp:0:int16:ABCD:0.1"
+RS485_PERIOD_MS = 10_000  # PT100 poll period
+# Extra devices on the same segment: name:slave:func:reg:count:period_ms:priority, comma separated.
+# priority 1 is served first when several polls are due; the PT100 runs at priority 5.
+RS485_DEVICES = ""
+
+# Modbus TCP gateway in front of the RS485 bus
+MBTCP_ENABLED = False  # opt-in: the port has no authentication
+MBTCP_READ_ONLY = True  # only read functions 1-4 reach the bus; others get exception 01
+MBTCP_PORT = 502
+MBTCP_CACHE_TTL_MS = 1000  # identical reads within this window are answered from cache
+MBTCP_CACHE_MAX = 16
+MBTCP_MAX_CLIENTS = 4
+MBTCP_MAX_PENDING = 8
+MBTCP_IDLE_MS = 120_000
 
 # Pulse counter (GPIO20)
 PULSE_PIN = 20
+PULSE_CHANNELS = "20:count"  # pin:name[:save divider[:send divider]], comma separated; first = primary
+PULSE_MAX_CH = 4
+# The hard IRQ only bumps a counter (~15 us per edge on the C3), so edges are
+# counted reliably up to PULSE_MAX_HZ sustained; faster trains may lose edges.
+# Without hard IRQ support (soft IRQ fallback) budget about 1 kHz.
+PULSE_MAX_HZ = 5000
+PULSE_WRAP = 0x3FFFFFFF  # IRQ counter wraps here so it stays a small int
 
 # Wi-Fi credentials (from esp32-pzem-counter-v0.py)
 DEFAULT_SSID = "TP-Link_5B9A"
@@ -39,8 +81,14 @@ wifi_mode = "dhcp"
 wifi_ip = ""
 wifi_gateway = ""
 wifi_subnet = ""
-CONFIG_FILE = "esp32c3_config.txt"
-COUNTER_FILE = "counter_data.txt"
+CONFIG_FILE = "esp32c3_config.json"
+CONFIG_LEGACY_FILE = "esp32c3_config.txt"  # positional format, migrated once
+COUNTER_FILE = "counter_data.txt"  # older text snapshot; only read to seed an empty journal
+JOURNAL_FILE = "counter_journal{}.bin"
+JOURNAL_SEGMENTS = 3        # pre-sized segments written in rotation
+JOURNAL_SEG_RECORDS = 128   # 20-byte records per segment
+JOURNAL_MIN_MS = 10_000     # a divider hit reaches flash at most this often...
+JOURNAL_PERIOD_MS = 60_000  # ...and any other counted pulse within this long
 device_mac = "unknown"
 counter_divider = 10
 counter_send_divider = 10  # send counter data every N pulses (for upload)
@@ -53,9 +101,38 @@ UPLOAD_TEMP_INTERVAL_MS = 60_000  # default 60s
 UPLOAD_DEVICE_ID = "smart01"
 UPLOAD_PDID = "PO-001"
 KFACTOR = 100  # percent (50-200)
+UPLOAD_QUEUE_MAX = 32
+UPLOAD_OVERFLOW = "coalesce"  # queue full: "coalesce" counter events into the latest totals, or "drop_oldest"
+UPLOAD_CONNECT_TIMEOUT_MS = 3000
+UPLOAD_READ_TIMEOUT_MS = 5000
+UPLOAD_KEEPALIVE_MS = 15_000  # reopen the upload connection after this long idle
+UPLOAD_ENCODING = "text"   # bulk POST / MQTT payloads: "text" or "binary" frames (see upload_decoder.py)
+
+# MQTT transport (UPLOAD_MODE = "mqtt")
+MQTT_HOST = ""             # broker; blank = same host as UPLOAD_HOST
+MQTT_PORT = 1883
+MQTT_TOPIC = "iot2026"     # publishes <topic>/<devid>/temp and <topic>/<devid>/<pdid>/counter
+MQTT_QOS = 1
+MQTT_INFLIGHT = 8          # QoS 1 messages awaiting PUBACK
+MQTT_KEEPALIVE_S = 60
+MQTT_USER = ""
+MQTT_PASS = ""
+UPLOAD_MODE = "get"        # "get": one GET per reading (older servers), "bulk": batched POST, "mqtt"
+UPLOAD_BULK_PATH = "iot2026/smart01/bulk.php"
+UPLOAD_BATCH_SIZE = 16     # bulk: send once this many readings are queued...
+UPLOAD_BATCH_MAX_MS = 60_000  # ...or once the oldest queued reading is this old
+# Store-and-forward spool for uploads that could not be delivered
+SPOOL_FILE = "upload_spool.bin"
+SPOOL_RECORDS = 512        # fixed ring size; the oldest record is overwritten when full
+SPOOL_FLUSH_MS = 10_000    # buffered records and the read pointer reach flash at most this often
+SPOOL_BATCH = 8            # ...or as soon as this many records are buffered
+SPOOL_DRAIN_PER_MIN = 60   # backlog replay rate once the host answers again; live readings go out alongside
+SPOOL_RETRY_MS = 30_000    # while the host is down, probe it this often
 
 # Timezone offset seconds (UTC+7 default)
 TIME_OFFSET = 7 * 3600
+# seconds between the port's time() epoch and the Unix epoch (ESP32 ports count from 2000)
+EPOCH_OFFSET = 946_684_800 if time.gmtime(0)[0] == 2000 else 0
 
 EN = 0x04      # Enable bit
 RS = 0x01      # Register select
@@ -64,58 +141,131 @@ BACKLIGHT = 0x08
 # Global handles
 i2c = None
 uart = None
-sock = None
-ntp_synced = False
-last_send_ms = 0
-last_counter_send_ms = 0
-last_send_status = "Never"
-pulse_count = 0
-pulse_accm = 0
-pulse_cpm = 0           # displayed CPM (prev full minute, or first-minute live)
-pulse_window_start = 0  # ms timestamp of current minute window
-pulse_window_pulses = 0 # pulses counted in current minute window
-pulse_cpm_prev = 0      # last completed minute CPM
-has_prev_cpm = False
-divider_counter = 0
-counter_save_pending = False
-counter_send_accum = 0
-counter_send_pending = False
-lcd_page = 0
-lcd_page_timer = 0
-
+modbus = None
+poller = None
+pt100_dev = None
+bus_scan = None
+mbtcp = None
+web = None
+rs485_regmap = []
+rs485_values = {}
+
+class State:
+    """Runtime values shared by the tasks started in main(); settings stay module-level."""
+
+    def __init__(self):
+        self.ip = ""
+        self.ntp_synced = False
+        self.latest_temp = None
+        self.latest_err = ""
+        self.last_ts = 0
+        self.last_send_ms = 0
+        self.last_counter_send_ms = 0
+        self.last_send_status = "Never"
+        self.counter_save_pending = False
+        self.lcd_page = 0
+        self.frame_seq = 0            # binary upload frames sent since boot
+        self.i2c_bytes = 0            # bytes written to the LCD backpack since boot
+        self.i2c_rate = 0             # ...per second, over the last LCD page
+
+
+state = State()
 
 # ---------------- LCD helpers ----------------
+LCD_COLS = 16
+LCD_ROW_ADDR = (0x80, 0xC0)
+# what the display currently shows, one bytearray per row; lcd_print_at() only sends the difference
+_lcd_shown = [bytearray(b" " * LCD_COLS), bytearray(b" " * LCD_COLS)]
+_lcd_want = bytearray(LCD_COLS)
+_lcd_cgram = [None] * 8  # custom character patterns loaded in CGRAM slots 0-7
+# Burst buffer: every HD44780 byte is 4 PCF8574 writes (high nibble with EN, without EN,
+# then the low nibble), so an address command plus a full row fits. At 400 kHz each I2C
+# byte takes ~22 us: that is the EN pulse width, and the 4 bytes per character outlast
+# the 37 us the controller needs per character, so no sleeps are needed inside a burst.
+_lcd_burst = bytearray(4 * (LCD_COLS + 1))
+_lcd_burst_mv = memoryview(_lcd_burst)
+
+
+def _lcd_put(n, bits, mode):
+    # encode one byte at offset n of the burst buffer; returns the next offset
+    buf = _lcd_burst
+    hi = mode | (bits & 0xF0) | BACKLIGHT
+    lo = mode | ((bits << 4) & 0xF0) | BACKLIGHT
+    buf[n] = hi | EN
+    buf[n + 1] = hi
+    buf[n + 2] = lo | EN
+    buf[n + 3] = lo
+    return n + 4
+
+
+def _lcd_send(n):
+    i2c.writeto(LCD_ADDR, _lcd_burst_mv[:n])
+    state.i2c_bytes += n
+
+
 def _lcd_write4(bits, mode=0):
+    # single nibble, only used by the 8-bit -> 4-bit switch in lcd_init()
     data = mode | (bits & 0xF0) | BACKLIGHT
-    i2c.writeto(LCD_ADDR, bytes([data | EN]))
-    time.sleep_us(500)
-    i2c.writeto(LCD_ADDR, bytes([data]))
-    time.sleep_us(100)
+    _lcd_burst[0] = data | EN
+    _lcd_burst[1] = data
+    _lcd_send(2)
 
 
 def _lcd_write_byte(bits, mode=0):
-    _lcd_write4(bits, mode)
-    _lcd_write4(bits << 4, mode)
+    _lcd_send(_lcd_put(0, bits, mode))
 
 
 def lcd_cmd(cmd):
     _lcd_write_byte(cmd, 0)
-
-
-def lcd_write_char(ch):
-    _lcd_write_byte(ord(ch), RS)
+    if cmd <= 0x03:
+        time.sleep_ms(2)  # clear and home take up to 1.52 ms; everything else 37 us
 
 
 def lcd_print_at(row, text):
-    addr = 0x80 if row == 0 else 0xC0
-    lcd_cmd(addr)
+    # diff against the shadow row and send only the changed spans, each behind one
+    # cursor-address command; a single unchanged column between two changes is rewritten,
+    # since re-addressing costs as much as the character. chr(0)-chr(7) are custom characters.
+    shown = _lcd_shown[row]
+    want = _lcd_want
     s = str(text)
-    if len(s) < 16:
-        s = s + (" " * (16 - len(s)))
-    else:
-        s = s[:16]
-    for ch in s:
-        lcd_write_char(ch)
+    n = len(s)
+    for col in range(LCD_COLS):
+        b = ord(s[col]) if col < n else 0x20
+        want[col] = b if b <= 0xFF else 0x3F  # no glyph outside the ROM character set: "?"
+    col = 0
+    while col < LCD_COLS:
+        if shown[col] == want[col]:
+            col += 1
+            continue
+        end = col + 1
+        while end < LCD_COLS:
+            if shown[end] != want[end]:
+                end += 1
+            elif end + 1 < LCD_COLS and shown[end + 1] != want[end + 1]:
+                end += 2
+            else:
+                break
+        # one burst per span: the address command, then the characters
+        n = _lcd_put(0, LCD_ROW_ADDR[row] + col, 0)
+        for i in range(col, end):
+            n = _lcd_put(n, want[i], RS)
+            shown[i] = want[i]
+        _lcd_send(n)
+        col = end
+
+
+def lcd_custom_char(slot, pattern):
+    # load a 5x8 glyph (8 row bytes) into CGRAM slot 0-7 unless it is already there;
+    # characters on screen using the slot change with it, so the shadow rows stay valid
+    pattern = bytes(pattern)
+    if _lcd_cgram[slot] == pattern:
+        return
+    n = _lcd_put(0, 0x40 | (slot << 3), 0)
+    for b in pattern:
+        n = _lcd_put(n, b, RS)
+    _lcd_send(n)
+    _lcd_cgram[slot] = pattern
+    # the next lcd_print_at() span starts with a DDRAM address, which ends CGRAM mode
 
 
 def lcd_init():
@@ -129,111 +279,1061 @@ def lcd_init():
     lcd_cmd(0x0C)  # display on, cursor off
     lcd_cmd(0x06)  # entry mode set
     lcd_cmd(0x01)  # clear
-    time.sleep_ms(5)
+    for row in _lcd_shown:
+        row[:] = b" " * LCD_COLS
+    for i in range(8):
+        _lcd_cgram[i] = None
 
 
 # ---------------- RS485 / Modbus helpers ----------------
-def modbus_crc(data):
-    crc = 0xFFFF
-    for b in data:
-        crc ^= b
+def _crc_table():
+    # CRC-16/MODBUS (poly 0xA001 reflected), one entry per low byte of crc ^ data
+    table = array("H", [0] * 256)
+    for i in range(256):
+        crc = i
         for _ in range(8):
             if crc & 0x0001:
                 crc = (crc >> 1) ^ 0xA001
             else:
                 crc >>= 1
+        table[i] = crc
+    return table
+
+
+_CRC_TABLE = _crc_table()
+
+
+def modbus_crc(data):
+    # data may be bytes, bytearray or a memoryview slice (no copy needed)
+    table = _CRC_TABLE
+    crc = 0xFFFF
+    for b in data:
+        crc = (crc >> 8) ^ table[(crc ^ b) & 0xFF]
     return crc
 
 
+MB_IDLE = 0
+MB_WAIT = 1
+MB_DONE = 2
+MB_RETRY = 3
+
+# slave turnaround histogram, bucket upper edges in ms (last bucket is open-ended)
+LAT_BOUNDS_MS = (2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class SlaveStats:
+    """Turnaround histogram and ok/fail counts for one slave; tunes its timeout and retries."""
+
+    def __init__(self):
+        self.hist = array("H", [0] * (len(LAT_BOUNDS_MS) + 1))
+        self.samples = 0
+        self.ok = 0
+        self.fail = 0
+        self.retried = 0
+        self.streak = 0     # consecutive misses
+
+    def record(self, ms):
+        if self.streak >= RS485_TIMEOUT_BACKOFF:
+            # answered at a widened timeout: the old turnaround history no longer fits, learn it again
+            for j in range(len(self.hist)):
+                self.hist[j] = 0
+            self.samples = 0
+        self.streak = 0
+        i = 0
+        while i < len(LAT_BOUNDS_MS) and ms > LAT_BOUNDS_MS[i]:
+            i += 1
+        self.hist[i] += 1
+        self.samples += 1
+        self.ok += 1
+        if self.samples >= 1000:
+            # decay so the histogram follows a slave that slows down or speeds up
+            self.samples = 0
+            for j in range(len(self.hist)):
+                self.hist[j] >>= 1
+                self.samples += self.hist[j]
+        self._decay()
+
+    def failed(self):
+        self.fail += 1
+        self.streak += 1
+        self._decay()
+
+    def _decay(self):
+        if self.ok + self.fail >= 200:
+            self.ok >>= 1
+            self.fail >>= 1
+
+    def percentile(self, frac):
+        need = self.samples * frac
+        seen = 0
+        for i in range(len(LAT_BOUNDS_MS)):
+            seen += self.hist[i]
+            if seen >= need:
+                return LAT_BOUNDS_MS[i]
+        return RS485_TIMEOUT_MS
+
+    def timeout_ms(self):
+        # twice the p99 turnaround once there is enough history, never above the configured worst case;
+        # a run of misses doubles it per miss, so a slave that slowed down is heard again
+        if self.samples < 8:
+            return RS485_TIMEOUT_MS
+        t = max(RS485_TIMEOUT_MIN_MS, min(RS485_TIMEOUT_MS, 2 * self.percentile(0.99)))
+        if self.streak >= RS485_TIMEOUT_BACKOFF:
+            t = min(RS485_TIMEOUT_MS, t << min(8, self.streak - RS485_TIMEOUT_BACKOFF + 1))
+        return t
+
+    def retries(self):
+        total = self.ok + self.fail
+        if total < 8:
+            return 1
+        if self.fail * 2 > total:
+            return 0  # mostly silent: do not spend the bus on retries
+        return 2 if self.fail * 20 > total else 1
+
+
+def reply_len(pdu):
+    # expected RTU reply length for a request PDU, 0 when unknown (frame then ends on t3.5)
+    func = pdu[0]
+    if len(pdu) >= 5:
+        qty = (pdu[3] << 8) | pdu[4]
+        if func == 1 or func == 2:
+            return 5 + (qty + 7) // 8
+        if func == 3 or func == 4:
+            return 5 + 2 * qty
+    if func in (5, 6, 15, 16):
+        return 8
+    return 0
+
+
+class ModbusRTU:
+    """Non-blocking Modbus RTU master: start a transaction, then call poll() from the loop."""
+
+    def __init__(self, uart, baud):
+        self.uart = uart
+        self.tx = bytearray(260)
+        self.rx = bytearray(260)
+        self.rx_mv = memoryview(self.rx)
+        self.rx_len = 0
+        self.expect = 0
+        self.slave = 0
+        self.func = 0
+        self.state = MB_IDLE
+        self.error = None
+        self.data = None
+        self.sent_us = 0
+        self.last_rx_us = 0
+        self.deadline_us = 0
+        self.done_us = 0
+        self.first_us = 0
+        self.elapsed_ms = 0
+        self.tx_n = 0
+        self.timeout_ms = RS485_TIMEOUT_MS
+        self.retries_left = 0
+        self.track = True
+        self.raw = False
+        self.stats = {}
+        self.set_baud(baud)
+
+    def set_baud(self, baud):
+        # the RTU spec counts 11 bits per character; above 19200 baud t3.5 is fixed at 1750 us
+        self.char_us = 11_000_000 // baud
+        self.t35_us = 1750 if baud > 19200 else (self.char_us * 35) // 10
+
+    def busy(self):
+        return self.state == MB_WAIT or self.state == MB_RETRY
+
+    def ready(self):
+        # idle and the bus has been silent for t3.5 since the last frame
+        return self.state == MB_IDLE and time.ticks_diff(time.ticks_us(), self.done_us) >= self.t35_us
+
+    def frame_us(self, count):
+        # wire time of a read of count registers: request + reply + both inter-frame gaps
+        return (8 + 5 + 2 * count) * self.char_us + 2 * self.t35_us
+
+    def slave_stats(self, slave):
+        st = self.stats.get(slave)
+        if st is None:
+            st = self.stats[slave] = SlaveStats()
+        return st
+
+    def start_read(self, slave, func, reg, count, timeout_ms=None, retries=None, track=True):
+        tx = self.tx
+        tx[0] = slave
+        tx[1] = func
+        tx[2] = (reg >> 8) & 0xFF
+        tx[3] = reg & 0xFF
+        tx[4] = (count >> 8) & 0xFF
+        tx[5] = count & 0xFF
+        self.raw = False
+        self._begin(6, 5 + 2 * count, timeout_ms, retries, track)
+
+    def start_raw(self, slave, pdu, timeout_ms=None, retries=None):
+        # forward any request PDU (function code + payload); the reply PDU is handed back as-is,
+        # Modbus exception replies included
+        n = len(pdu) + 1
+        if n > 254:
+            raise ValueError("pdu too long")
+        tx = self.tx
+        tx[0] = slave
+        tx[1:n] = pdu
+        self.raw = True
+        self._begin(n, reply_len(pdu), timeout_ms, retries, True)
+
+    def _begin(self, n, expect, timeout_ms, retries, track):
+        # timeout/retries default to what this slave's latency history supports
+        self.track = track
+        st = self.slave_stats(self.tx[0]) if track else None
+        self.timeout_ms = st.timeout_ms() if timeout_ms is None else timeout_ms
+        self.retries_left = st.retries() if retries is None else retries
+        tx = self.tx
+        self.expect = expect
+        self.tx_n = n
+        crc = modbus_crc(memoryview(tx)[:n])
+        tx[n] = crc & 0xFF
+        tx[n + 1] = (crc >> 8) & 0xFF
+        self.first_us = time.ticks_us()
+        self._send()
+
+    def _send(self):
+        tx = self.tx
+        n = self.tx_n
+        expect = self.expect
+        while self.uart.any():
+            self.uart.read()  # drop stale bytes from a previous late reply
+        self.uart.write(memoryview(tx)[:n + 2])
+        now = time.ticks_us()
+        # frame leaves the wire, slave answers within timeout_ms, reply takes expect chars
+        budget = (n + 2 + expect) * self.char_us + self.timeout_ms * 1000
+        self.slave = tx[0]
+        self.func = tx[1]
+        self.rx_len = 0
+        self.error = None
+        self.data = None
+        self.sent_us = now
+        self.last_rx_us = now
+        self.deadline_us = time.ticks_add(now, budget)
+        self.state = MB_WAIT
+
+    def poll(self):
+        # returns True once the transaction has finished (ok or error)
+        if self.state == MB_RETRY:
+            if time.ticks_diff(time.ticks_us(), self.done_us) >= self.t35_us:
+                self._send()
+            return False
+        if self.state != MB_WAIT:
+            return self.state == MB_DONE
+        now = time.ticks_us()
+        n = self.uart.any()
+        if n:
+            room = len(self.rx) - self.rx_len
+            if room > 0:
+                got = self.uart.readinto(self.rx_mv[self.rx_len:], min(n, room))
+                if got:
+                    self.rx_len += got
+            else:
+                self.uart.read()
+            self.last_rx_us = now
+        rx_len = self.rx_len
+        if rx_len >= 5 and self.rx[1] == (self.func | 0x80):
+            self._finish(now)
+        elif self.expect and rx_len >= self.expect:
+            self._finish(now)
+        elif rx_len and time.ticks_diff(now, self.last_rx_us) >= self.t35_us:
+            self._finish(now)  # end of frame on 3.5 char silence
+        elif not rx_len and time.ticks_diff(now, self.deadline_us) >= 0:
+            self._finish(now)
+        return self.state == MB_DONE
+
+    def _finish(self, now):
+        self.state = MB_DONE
+        self.done_us = now
+        self.elapsed_ms = time.ticks_diff(now, self.first_us) // 1000
+        try:
+            self.data = self._check()
+        except RuntimeError as e:
+            self.error = str(e)
+        if not self.track:
+            return
+        st = self.slave_stats(self.slave)
+        if self.answered():
+            # the slave answered; log its turnaround (total time minus both frames on the wire)
+            wire_us = (self.tx_n + 2 + self.rx_len) * self.char_us
+            st.record(max(0, time.ticks_diff(now, self.sent_us) - wire_us) // 1000)
+            return
+        st.failed()
+        if self.retries_left > 0:
+            self.retries_left -= 1
+            st.retried += 1
+            self.state = MB_RETRY
+
+    def _check(self):
+        resp = self.rx_mv[:self.rx_len]
+        if self.raw:
+            if len(resp) < 5:
+                raise RuntimeError("no/short response")
+            if resp[0] != self.slave or (resp[1] & 0x7F) != self.func:
+                raise RuntimeError("bad header {}".format(bytes(resp[:2])))
+            n = len(resp) - 2
+            if (resp[n] | (resp[n + 1] << 8)) != modbus_crc(resp[:n]):
+                raise RuntimeError("crc mismatch")
+            return resp[1:n]
+        if len(resp) >= 5 and resp[0] == self.slave and resp[1] == (self.func | 0x80):
+            if (resp[3] | (resp[4] << 8)) != modbus_crc(resp[:3]):
+                raise RuntimeError("crc mismatch (exception frame)")
+            raise RuntimeError("exception code {}".format(resp[2]))
+        if len(resp) < 7:
+            raise RuntimeError("no/short response")
+        if resp[0] != self.slave or resp[1] != self.func:
+            raise RuntimeError("bad header {}".format(bytes(resp[:2])))
+        byte_count = resp[2]
+        if byte_count < 2:
+            raise RuntimeError("byte_count {}".format(byte_count))
+        expected = 3 + byte_count + 2
+        if len(resp) < expected:
+            raise RuntimeError("len {} < {}".format(len(resp), expected))
+        recv_crc = resp[3 + byte_count] | (resp[3 + byte_count + 1] << 8)
+        calc_crc = modbus_crc(resp[:3 + byte_count])
+        if recv_crc != calc_crc:
+            raise RuntimeError("crc mismatch recv=0x%04X calc=0x%04X" % (recv_crc, calc_crc))
+        return resp[3:3 + byte_count]
+
+    def answered(self):
+        # the slave replied with a valid frame (data or a Modbus exception)
+        return self.error is None or self.error.startswith("exception")
+
+    def result(self):
+        # registers of the finished transaction; raises on error
+        self.state = MB_IDLE
+        if self.error:
+            raise RuntimeError(self.error)
+        return self.data
+
+
+REG_TYPES = {"int16": 1, "uint16": 1, "int32": 2, "uint32": 2, "float32": 2}  # width in registers
+
+
+def parse_regmap(text):
+    regmap = []
+    for item in text.split(","):
+        f = item.strip().split(":")
+        if not f[0]:
+            continue
+        offset = int(f[1]) if len(f) > 1 and f[1] else 0
+        typ = f[2].lower() if len(f) > 2 and f[2] else "int16"
+        order = f[3].upper() if len(f) > 3 and f[3] else "ABCD"
+        scale = float(f[4]) if len(f) > 4 and f[4] else 1.0
+        if typ not in REG_TYPES:
+            raise ValueError("bad type " + typ)
+        if len(order) != 4 or sorted(order) != ["A", "B", "C", "D"]:
+            raise ValueError("bad order " + order)
+        if offset < 0 or offset + REG_TYPES[typ] > 125:
+            raise ValueError("bad offset {}".format(offset))
+        if REG_TYPES[typ] == 1:
+            # a 16-bit register only sees the byte order within the word
+            perm = (1, 0) if order.index("A") > order.index("B") else (0, 1)
+        else:
+            # perm[i] = position in the reply of value byte i (A=MSB)
+            perm = tuple(order.index(c) for c in "ABCD")
+        regmap.append((f[0], offset * 2, typ, perm, scale))
+    if not regmap:
+        raise ValueError("empty register map")
+    return regmap
+
+
+def regmap_words(regmap):
+    return max(pos // 2 + REG_TYPES[typ] for _, pos, typ, _, _ in regmap)
+
+
+def regmap_text(regmap):
+    parts = []
+    for name, pos, typ, perm, scale in regmap:
+        if len(perm) == 2:
+            order = "BADC" if perm[0] else "ABCD"
+        else:
+            order = "".join("ABCD"[perm.index(i)] for i in range(4))
+        parts.append("{}:{}:{}:{}:{}".format(name, pos // 2, typ, order, scale))
+    return ",".join(parts)
+
+
+def set_regmap(text):
+    global RS485_MAP, rs485_regmap, rs485_values
+    try:
+        regmap = parse_regmap(text)
+    except Exception as e:
+        print("Register map rejected:", text, e)
+        return False
+    rs485_regmap = regmap
+    RS485_MAP = regmap_text(regmap)
+    rs485_values = {}
+    return True
+
+
+def decode_registers(data, regmap):
+    # one pass over the register block; channels beyond a short reply decode as None
+    values = {}
+    n = len(data)
+    for name, pos, typ, perm, scale in regmap:
+        if len(perm) == 2:
+            if pos + 2 > n:
+                values[name] = None
+                continue
+            v = (data[pos + perm[0]] << 8) | data[pos + perm[1]]
+            if typ == "int16" and v & 0x8000:
+                v -= 0x10000
+        else:
+            if pos + 4 > n:
+                values[name] = None
+                continue
+            v = ((data[pos + perm[0]] << 24) | (data[pos + perm[1]] << 16) |
+                 (data[pos + perm[2]] << 8) | data[pos + perm[3]])
+            if typ == "float32":
+                v = struct.unpack(">f", struct.pack(">I", v))[0]
+            elif typ == "int32" and v & 0x80000000:
+                v -= 0x100000000
+        values[name] = v * scale
+    return values
+
+
 def rs485_init():
-    global uart
+    global uart, modbus
     uart = UART(1, baudrate=RS485_BAUD, bits=8, parity=None, stop=1,
-                tx=RS485_TX_PIN, rx=RS485_RX_PIN, timeout=1000)
+                tx=RS485_TX_PIN, rx=RS485_RX_PIN, timeout=0)
+    modbus = ModbusRTU(uart, RS485_BAUD)
+    if not set_regmap(RS485_MAP):
+        set_regmap("temp:0:int16:ABCD:0.1")
+    build_poll_table()
     print("RS485 ready on UART1 TX={}, RX={}, baud={}".format(RS485_TX_PIN, RS485_RX_PIN, RS485_BAUD))
 
 
+def pt100_count():
+    # one request covers RS485_COUNT registers or the whole map, whichever is larger
+    return min(125, max(RS485_COUNT, regmap_words(rs485_regmap)))
+
+
+def rs485_start_read():
+    modbus.start_read(RS485_SLAVE, RS485_FUNC, RS485_REG, pt100_count())
+
+
+def pt100_decode(data):
+    global rs485_values
+    rs485_values = decode_registers(data, rs485_regmap)
+    temp = rs485_values[rs485_regmap[0][0]]
+    if temp is None:
+        raise RuntimeError("byte_count {}".format(len(data)))
+    return temp  # °C
+
+
+def pt100_from_result():
+    return pt100_decode(modbus.result())
+
+
 def read_pt100_temp():
+    # blocking variant, kept for one-off reads outside the main loop
     if not rs485_enabled:
         return None
-    req = bytearray([
-        RS485_SLAVE,
-        RS485_FUNC,
-        (RS485_REG >> 8) & 0xFF,
-        RS485_REG & 0xFF,
-        (RS485_COUNT >> 8) & 0xFF,
-        RS485_COUNT & 0xFF,
-    ])
-    crc = modbus_crc(req)
-    req.append(crc & 0xFF)
-    req.append((crc >> 8) & 0xFF)
-
-    uart.read()  # clear
-    uart.write(req)
-    time.sleep_ms(120)
-
-    resp = uart.read()
-    if not resp or len(resp) < 7:
-        raise RuntimeError("no/short response")
-    if resp[0] != RS485_SLAVE or resp[1] != RS485_FUNC:
-        raise RuntimeError("bad header {}".format(resp[:2]))
-    byte_count = resp[2]
-    if byte_count < 2:
-        raise RuntimeError("byte_count {}".format(byte_count))
-    expected = 3 + byte_count + 2
-    if len(resp) < expected:
-        raise RuntimeError("len {} < {}".format(len(resp), expected))
-    data = resp[3:3 + byte_count]
-    recv_crc = resp[3 + byte_count] | (resp[3 + byte_count + 1] << 8)
-    calc_crc = modbus_crc(resp[:3 + byte_count])
-    if recv_crc != calc_crc:
-        raise RuntimeError("crc mismatch recv=0x%04X calc=0x%04X" % (recv_crc, calc_crc))
-    raw = (data[0] << 8) | data[1]
-    return raw / 10.0  # °C
+    rs485_start_read()
+    while not modbus.poll():
+        time.sleep_ms(1)
+    return pt100_from_result()
+
+
+# ---------------- RS485 poll scheduler ----------------
+def registers_u16(data):
+    return [(data[i] << 8) | data[i + 1] for i in range(0, len(data) - 1, 2)]
+
+
+class PollDevice:
+    def __init__(self, name, slave, func, reg, count, period_ms, prio=5, decode=registers_u16):
+        self.name = name
+        self.slave = slave
+        self.func = func
+        self.reg = reg
+        self.count = count
+        self.period_ms = max(100, period_ms)
+        self.prio = prio
+        self.decode = decode
+        self.enabled = True
+        self.next_due = time.ticks_ms()
+        self.value = None
+        self.error = ""
+        self.polls = 0
+        self.fails = 0
+        self.txn_ms = 0       # last transaction time (request sent -> reply done)
+        self.late_ms = 0      # how late the last poll started vs its slot
+        self.late_max_ms = 0
+        self.late_sum_ms = 0
+        self.first_ms = 0
+
+    def complete(self, mb):
+        self.txn_ms = mb.elapsed_ms
+        try:
+            self.value = self.decode(mb.result())
+            self.error = ""
+        except Exception as e:
+            self.error = str(e)
+            self.fails += 1
+        return True
 
 
-# ---------------- Pulse counter (GPIO20) ----------------
-def _pulse_irq(pin):
-    global pulse_count, pulse_accm, divider_counter, counter_save_pending, pulse_window_pulses, counter_send_accum, counter_send_pending
-    if not counter_enabled:
+class PollScheduler:
+    """Serves due devices back-to-back on one RS485 segment, highest priority first."""
+
+    def __init__(self, mb):
+        self.mb = mb
+        self.devices = []
+        self.jobs = []
+        self.current = None
+        self.polls = 0
+        self.rate_start = time.ticks_ms()
+        self.rate_polls = 0
+        self.rate = 0.0
+
+    def tick(self, now):
+        # returns the device whose transaction just finished, or None
+        mb = self.mb
+        done = None
+        if self.current is not None:
+            if not mb.poll():
+                return None
+            done = self.current
+            self.current = None
+            self.polls += 1
+            if not done.complete(mb):
+                done = None
+        if bus_scan is not None and bus_scan.active:
+            # a discovery scan owns the bus until it is done; periodic polls resume after
+            bus_scan.tick(now)
+            return done
+        span = time.ticks_diff(now, self.rate_start)
+        if span >= 10_000:
+            self.rate = (self.polls - self.rate_polls) * 1000 / span
+            self.rate_polls = self.polls
+            self.rate_start = now
+        if rs485_enabled and mb.ready():
+            self._start_next(now)
+        return done
+
+    def submit(self, job):
+        # one-shot transaction (e.g. from the Modbus TCP gateway), served before periodic polls
+        self.jobs.append(job)
+
+    def _start_next(self, now):
+        if self.jobs:
+            job = self.jobs.pop(0)
+            self.current = job
+            self.mb.start_raw(job.slave, job.pdu)
+            return
+        best = None
+        best_late = 0
+        for dev in self.devices:
+            if not dev.enabled:
+                continue
+            late = time.ticks_diff(now, dev.next_due)
+            if late < 0:
+                continue
+            if best is None or dev.prio < best.prio or (dev.prio == best.prio and late > best_late):
+                best = dev
+                best_late = late
+        if best is None:
+            return
+        best.late_ms = best_late
+        best.late_sum_ms += best_late
+        if best_late > best.late_max_ms:
+            best.late_max_ms = best_late
+        if not best.polls:
+            best.first_ms = now
+        best.polls += 1
+        # keep the slot grid; if a whole period was missed, restart the grid from now
+        if best_late >= best.period_ms:
+            best.next_due = time.ticks_add(now, best.period_ms)
+        else:
+            best.next_due = time.ticks_add(best.next_due, best.period_ms)
+        self.current = best
+        self.mb.start_read(best.slave, best.func, best.reg, best.count)
+
+    def load(self):
+        # fraction of bus time the table asks for at the current baud (>1.0 = overcommitted)
+        total = 0.0
+        for dev in self.devices:
+            if dev.enabled:
+                total += self.mb.frame_us(dev.count) / 1000 / dev.period_ms
+        return total
+
+    def dev_rate(self, dev, now):
+        span = time.ticks_diff(now, dev.first_ms)
+        if dev.polls < 2 or span <= 0:
+            return 0.0
+        return (dev.polls - 1) * 1000 / span
+
+
+class BusScanner:
+    """Probes slave ids 1-247 (optionally at every RS485_SCAN_BAUDS rate) with one short read each."""
+
+    def __init__(self, mb, all_bauds=False):
+        self.mb = mb
+        self.bauds = RS485_SCAN_BAUDS if all_bauds else (RS485_BAUD,)
+        self.baud_i = 0
+        self.slave = 0
+        self.found = []
+        self.active = True
+        self.probing = False
+        self.started = time.ticks_ms()
+        self.elapsed_ms = 0
+        self._set_baud(self.bauds[0])
+
+    def _set_baud(self, baud):
+        uart.init(baudrate=baud)
+        self.mb.set_baud(baud)
+
+    def tick(self, now):
+        mb = self.mb
+        if self.probing:
+            if not mb.poll():
+                return
+            self.probing = False
+            if mb.answered():
+                self.found.append((self.slave, self.bauds[self.baud_i], mb.elapsed_ms))
+                print("RS485 scan: slave {} answers at {} baud ({} ms)".format(self.slave, self.bauds[self.baud_i], mb.elapsed_ms))
+            mb.state = MB_IDLE
+        if not mb.ready():
+            return
+        self.slave += 1
+        if self.slave > 247:
+            self.baud_i += 1
+            if self.baud_i >= len(self.bauds):
+                self.active = False
+                self.elapsed_ms = time.ticks_diff(now, self.started)
+                self._set_baud(RS485_BAUD)
+                print("RS485 scan done in {} ms: {}".format(self.elapsed_ms, self.found))
+                return
+            self._set_baud(self.bauds[self.baud_i])
+            self.slave = 1
+        # no retries and no latency tracking: most ids are expected to stay silent
+        mb.start_read(self.slave, RS485_FUNC, RS485_REG, 1, RS485_SCAN_TIMEOUT_MS, 0, False)
+        self.probing = True
+
+    def status(self):
+        if self.active:
+            return "Scanning id {}/247 at {} baud, found {}".format(
+                self.slave, self.bauds[self.baud_i], len(self.found))
+        found = ", ".join("{}@{}".format(sl, bd) for sl, bd, _ in self.found) or "none"
+        return "Scan done in {:.1f} s, found: {}".format(self.elapsed_ms / 1000, found)
+
+
+def start_bus_scan(all_bauds=False):
+    global bus_scan
+    if bus_scan is not None and bus_scan.active:
         return
-    pulse_count += 1
-    pulse_accm += 1
-    pulse_window_pulses += 1
-    divider_counter += 1
-    counter_send_accum += 1
-    if counter_send_accum >= counter_send_divider:
-        counter_send_pending = True
-        counter_send_accum = 0
-    print("divider= ", divider_counter)
-    print("counter= ", pulse_count, " accm= ", pulse_accm, "cpm: ", pulse_cpm)
-    if divider_counter >= counter_divider:
-        print("Divider hit: {} pulses (accm={})".format(divider_counter, pulse_accm))
-        divider_counter = 0
-        counter_save_pending = True
+    bus_scan = BusScanner(modbus, all_bauds)
+
+
+def parse_devices(text):
+    devices = []
+    for item in text.split(","):
+        f = item.strip().split(":")
+        if not f[0]:
+            continue
+        if len(f) < 6:
+            raise ValueError("device needs name:slave:func:reg:count:period_ms[:priority]")
+        count = int(f[4])
+        if count < 1 or count > 125:
+            raise ValueError("bad count {}".format(count))
+        devices.append(PollDevice(f[0], int(f[1]), int(f[2]), int(f[3]), count, int(f[5]),
+                                  int(f[6]) if len(f) > 6 and f[6] else 5))
+    return devices
+
+
+def build_poll_table():
+    global poller, pt100_dev, RS485_DEVICES
+    if poller is None:
+        poller = PollScheduler(modbus)
+    pt100_dev = PollDevice("pt100", RS485_SLAVE, RS485_FUNC, RS485_REG, pt100_count(),
+                           RS485_PERIOD_MS, 5, pt100_decode)
+    try:
+        extra = parse_devices(RS485_DEVICES)
+    except Exception as e:
+        print("RS485 device table rejected:", RS485_DEVICES, e)
+        extra = []
+        RS485_DEVICES = ""
+    poller.devices = [pt100_dev] + extra
+    print("RS485 poll table: {} device(s), bus load {:.0f}%".format(len(poller.devices), poller.load() * 100))
+
+
+# ---------------- Modbus TCP gateway ----------------
+class GatewayJob:
+    def __init__(self, gw, key, slave, pdu, cacheable):
+        self.gw = gw
+        self.key = key
+        self.slave = slave
+        self.pdu = pdu
+        self.cacheable = cacheable
+        self.waiters = []
+
+    def complete(self, mb):
+        try:
+            reply = bytes(mb.result())
+            ok = True
+        except RuntimeError:
+            reply = bytes([self.pdu[0] | 0x80, 0x0B])  # gateway target device failed to respond
+            ok = False
+        self.gw.finish(self, reply, ok)
+        return False
+
+
+class ModbusTcpGateway:
+    """Modbus TCP server that forwards to the RS485 scheduler, caching and coalescing reads."""
+
+    def __init__(self, sched, port=MBTCP_PORT):
+        self.sched = sched
+        addr = socket.getaddrinfo("0.0.0.0", port)[0][-1]
+        s = socket.socket()
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(addr)
+        s.listen(2)
+        s.setblocking(False)
+        self.sock = s
+        self.clients = []   # [socket, rx bytearray, last activity ms]
+        self.cache = {}     # slave + request pdu -> (ticks_ms, reply pdu)
+        self.pending = {}   # slave + request pdu -> GatewayJob still on the bus
+        self.requests = 0
+        self.hits = 0
+        self.coalesced = 0
+        self.serial = 0
+        print("Modbus TCP gateway on port", port)
+
+    def poll(self, now):
+        try:
+            c, _ = self.sock.accept()
+            if len(self.clients) >= MBTCP_MAX_CLIENTS:
+                c.close()
+            else:
+                c.setblocking(False)
+                self.clients.append([c, bytearray(), now])
+        except OSError:
+            pass
+        for cl in self.clients[:]:
+            try:
+                chunk = cl[0].recv(260)
+            except OSError as e:
+                if e.args[0] != errno.EAGAIN or time.ticks_diff(now, cl[2]) > MBTCP_IDLE_MS:
+                    self._drop(cl[0])
+                continue
+            if not chunk:
+                self._drop(cl[0])
+                continue
+            cl[2] = now
+            buf = cl[1]
+            buf.extend(chunk)
+            while len(buf) >= 8:
+                # MBAP: transaction id, protocol id (0), length, unit id
+                length = (buf[4] << 8) | buf[5]
+                if buf[2] or buf[3] or length < 2 or length > 254:
+                    self._drop(cl[0])
+                    break
+                if len(buf) < 6 + length:
+                    break
+                tid = (buf[0] << 8) | buf[1]
+                self._request(cl[0], tid, buf[6], bytes(buf[7:6 + length]), now)
+                buf = cl[1] = buf[6 + length:]
+
+    def _request(self, sock, tid, uid, pdu, now):
+        self.requests += 1
+        if not rs485_enabled:
+            self._reply(sock, tid, uid, bytes([pdu[0] | 0x80, 0x0A]))  # gateway path unavailable
+            return
+        cacheable = pdu[0] in (1, 2, 3, 4)
+        if MBTCP_READ_ONLY and not cacheable:
+            self._reply(sock, tid, uid, bytes([pdu[0] | 0x80, 0x01]))  # illegal function
+            return
+        # unit id 0/255 addresses the gateway itself -> the configured PT100 slave
+        slave = RS485_SLAVE if uid == 0 or uid == 255 else uid
+        key = bytes([slave]) + pdu
+        if cacheable:
+            hit = self.cache.get(key)
+            if hit is not None and time.ticks_diff(now, hit[0]) < MBTCP_CACHE_TTL_MS:
+                self.hits += 1
+                self._reply(sock, tid, uid, hit[1])
+                return
+            job = self.pending.get(key)
+            if job is not None:
+                self.coalesced += 1
+                job.waiters.append((sock, tid, uid))
+                return
+        else:
+            self.cache.clear()  # a write may change what cached reads would return
+        if len(self.sched.jobs) >= MBTCP_MAX_PENDING:
+            self._reply(sock, tid, uid, bytes([pdu[0] | 0x80, 0x06]))  # slave device busy
+            return
+        job = GatewayJob(self, key, slave, pdu, cacheable)
+        job.waiters.append((sock, tid, uid))
+        if cacheable:
+            self.pending[key] = job
+        self.serial += 1
+        self.sched.submit(job)
+
+    def finish(self, job, reply, ok):
+        if job.cacheable:
+            self.pending.pop(job.key, None)
+            if ok and not reply[0] & 0x80:
+                self._cache_put(job.key, reply)
+        for sock, tid, uid in job.waiters:
+            self._reply(sock, tid, uid, reply)
+
+    def _cache_put(self, key, reply):
+        now = time.ticks_ms()
+        if len(self.cache) >= MBTCP_CACHE_MAX:
+            oldest = None
+            for k, v in self.cache.items():
+                if oldest is None or time.ticks_diff(v[0], self.cache[oldest][0]) < 0:
+                    oldest = k
+            del self.cache[oldest]
+        self.cache[key] = (now, reply)
+
+    def _reply(self, sock, tid, uid, pdu):
+        for cl in self.clients:
+            if cl[0] is sock:
+                break
+        else:
+            return  # client went away while its request was on the bus
+        try:
+            sock.send(struct.pack(">HHHB", tid, 0, len(pdu) + 1, uid) + pdu)
+        except OSError:
+            self._drop(sock)
+
+    def _drop(self, sock):
+        for cl in self.clients:
+            if cl[0] is sock:
+                self.clients.remove(cl)
+                break
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+    def status(self):
+        return "{} client(s), {} req, {} cached, {} merged, {} on bus".format(
+            len(self.clients), self.requests, self.hits, self.coalesced, self.serial)
+
+
+# ---------------- Pulse counter (GPIO20) ----------------
+class RateMeter:
+    """Pulse rates from a ring of per-second buckets: rolling 60 s CPM plus 5 s and 15 min rates.
+
+    tick() reads the IRQ edge counter, so it needs no hook in the pulse path;
+    each call costs O(1) per elapsed second."""
+
+    def __init__(self, seconds=900):
+        self.ring = array("H", [0] * seconds)
+        self.size = seconds
+        self.cur = 0
+        self.sec_ms = None  # start of the current bucket
+        self.last = 0
+        self.filled = 0     # completed seconds, for the warm-up after boot
+        self.s5 = 0
+        self.s60 = 0
+        self.s15m = 0
+        self.cpm = 0
+        self.cpm_5s = 0
+        self.cpm_15m = 0
+
+    def tick(self, now, edges):
+        if self.sec_ms is None:
+            self.sec_ms = now
+            self.last = edges
+            return
+        n = (edges - self.last) & PULSE_WRAP
+        self.last = edges
+        if n:
+            self.ring[self.cur] = min(0xFFFF, self.ring[self.cur] + n)
+            self.s5 += n
+            self.s60 += n
+            self.s15m += n
+        steps = time.ticks_diff(now, self.sec_ms) // 1000
+        if steps >= self.size:
+            # nothing seen for a whole ring: start over
+            for i in range(self.size):
+                self.ring[i] = 0
+            self.s5 = self.s60 = self.s15m = 0
+            self.filled += steps
+            self.sec_ms = now
+        else:
+            for _ in range(steps):
+                self.cur = (self.cur + 1) % self.size
+                self.s5 -= self.ring[(self.cur - 5) % self.size]
+                self.s60 -= self.ring[(self.cur - 60) % self.size]
+                self.s15m -= self.ring[self.cur]
+                self.ring[self.cur] = 0
+                self.filled += 1
+            self.sec_ms = time.ticks_add(self.sec_ms, steps * 1000)
+        part = time.ticks_diff(now, self.sec_ms)
+        self.cpm = self._rate(self.s60, 60, part)
+        self.cpm_5s = self._rate(self.s5, 5, part)
+        self.cpm_15m = self._rate(self.s15m, self.size, part)
+
+    def _rate(self, total, window, part):
+        # the window is window-1 whole seconds plus the running one (less right after boot)
+        span = min(window - 1, self.filled) * 1000 + part
+        return total * 60_000 // span if span > 0 else 0
+
+
+# edges seen by each channel's IRQ (wrap at PULSE_WRAP); [0] of _pulse_sched: pulse_service() queued
+_pulse_edges = array("I", [0] * PULSE_MAX_CH)
+_pulse_sched = array("B", [0])
+_pulse_pins = []
+
+
+def _pulse_handler(ch):
+    def irq(pin):
+        # hard IRQ: no allocation, no print; pulse_service() does the rest
+        if counter_enabled:
+            _pulse_edges[ch] = (_pulse_edges[ch] + 1) & PULSE_WRAP
+            if micropython is not None and not _pulse_sched[0]:
+                _pulse_sched[0] = 1
+                try:
+                    micropython.schedule(pulse_service, None)
+                except RuntimeError:
+                    pass  # schedule queue full: cpm_task picks the edges up
+    return irq
+
+
+class PulseChannels:
+    """Counter state for every pulse input, one array column per field, indexed by channel."""
+
+    def __init__(self, spec):
+        self.pins = []
+        self.names = []
+        save = []
+        send = []
+        for part in spec.split(","):
+            f = [x.strip() for x in part.split(":")]
+            if not f[0] or len(self.pins) >= PULSE_MAX_CH:
+                continue
+            try:
+                pin = int(f[0])
+                div = int(f[2]) if len(f) > 2 and f[2] else 0
+                sdiv = int(f[3]) if len(f) > 3 and f[3] else 0
+            except ValueError:
+                continue
+            self.pins.append(pin)
+            self.names.append(f[1] if len(f) > 1 and f[1] else "ch{}".format(len(self.names)))
+            save.append(max(0, div))  # 0 = use counter_divider
+            send.append(max(0, sdiv))  # 0 = use counter_send_divider
+        if not self.pins:
+            self.pins = [PULSE_PIN]
+            self.names = ["count"]
+            save = [0]
+            send = [0]
+        n = self.n = len(self.pins)
+        self.save_div = array("I", save)
+        self.send_div = array("I", send)
+        self.count = array("I", [0] * n)
+        self.accm = array("I", [0] * n)
+        self.divider = array("I", [0] * n)     # pulses toward the next save
+        self.send_accum = array("I", [0] * n)  # pulses toward the next upload
+        self.send_pending = array("B", [0] * n)
+        self.seen = array("I", [_pulse_edges[i] for i in range(n)])
+        self.cpm = array("I", [0] * n)
+        self.cpm_5s = array("I", [0] * n)
+        self.cpm_15m = array("I", [0] * n)
+        self.meters = [RateMeter() for _ in range(n)]
+
+    def spec(self):
+        out = []
+        for i in range(self.n):
+            f = "{}:{}".format(self.pins[i], self.names[i])
+            if self.save_div[i] or self.send_div[i]:
+                f += ":{}".format(self.save_div[i] or "")
+            if self.send_div[i]:
+                f += ":{}".format(self.send_div[i])
+            out.append(f)
+        return ",".join(out)
+
+    def reset(self, accm=False):
+        for i in range(self.n):
+            self.count[i] = 0
+            self.divider[i] = 0
+            if accm:
+                self.accm[i] = 0
+
+    def rows(self):
+        return [(self.names[i], self.count[i], self.accm[i], self.cpm[i], self.cpm_5s[i], self.cpm_15m[i])
+                for i in range(self.n)]
+
+
+pulses = PulseChannels(PULSE_CHANNELS)
+
+
+def set_pulse_channels(text):
+    # rebuild the channel table; counts carry over by channel index
+    global pulses, PULSE_CHANNELS
+    new = PulseChannels(text)
+    for i in range(min(new.n, pulses.n)):
+        new.count[i] = pulses.count[i]
+        new.accm[i] = pulses.accm[i]
+        new.divider[i] = pulses.divider[i]
+        new.send_accum[i] = pulses.send_accum[i]
+    changed = new.pins != pulses.pins
+    pulses = new
+    PULSE_CHANNELS = new.spec()
+    return changed
+
+
+def pulse_service(_=None):
+    # folds new IRQ edges into the counters; runs scheduled after an edge and from cpm_task
+    _pulse_sched[0] = 0
+    p = pulses
+    for ch in range(p.n):
+        edges = _pulse_edges[ch]
+        n = (edges - p.seen[ch]) & PULSE_WRAP
+        if not n:
+            continue
+        p.seen[ch] = edges
+        p.count[ch] += n
+        p.accm[ch] += n
+        p.divider[ch] += n
+        p.send_accum[ch] += n
+        div = p.send_div[ch] or max(1, counter_send_divider)
+        if p.send_accum[ch] >= div:
+            p.send_pending[ch] = 1
+            p.send_accum[ch] %= div
+        div = p.save_div[ch] or max(1, counter_divider)
+        if p.divider[ch] >= div:
+            print("Divider hit: {} {} pulses (accm={})".format(p.names[ch], p.divider[ch], p.accm[ch]))
+            p.divider[ch] %= div
+            state.counter_save_pending = True
+
 
 def pulse_init():
-    global pulse_window_start
+    # (re)attach one IRQ per channel pin; pins dropped from the table are released
+    for pin in _pulse_pins:
+        pin.irq(handler=None)
+    _pulse_pins[:] = []
     if not counter_enabled:
         return
-    pin = Pin(PULSE_PIN, Pin.IN, Pin.PULL_DOWN)
-    pin.irq(trigger=Pin.IRQ_RISING, handler=_pulse_irq)
-    pulse_window_start = time.ticks_ms()
+    for ch in range(pulses.n):
+        pin = Pin(pulses.pins[ch], Pin.IN, Pin.PULL_DOWN)
+        try:
+            pin.irq(trigger=Pin.IRQ_RISING, handler=_pulse_handler(ch), hard=True)
+        except TypeError:
+            pin.irq(trigger=Pin.IRQ_RISING, handler=_pulse_handler(ch))
+        _pulse_pins.append(pin)
+        pulses.seen[ch] = _pulse_edges[ch]
 
 
 # ---------------- Wi-Fi + HTTP helpers ----------------
 def set_wifi(ssid, password, mode=None, ip=None, gateway=None, subnet=None):
-    global wifi_ssid, wifi_pass, wifi_mode, wifi_ip, wifi_gateway, wifi_subnet
-    wifi_ssid = ssid or wifi_ssid
-    wifi_pass = password or wifi_pass
-    if mode in ("dhcp", "static"):
-        wifi_mode = mode
+    # blank ssid/password keep the current ones; this also commits any other pending settings
+    config_set("wifi_ssid", ssid or "")
+    config_set("wifi_pass", password or "")
+    if mode is not None:
+        config_set("wifi_mode", mode)
     if ip is not None:
-        wifi_ip = ip
+        config_set("wifi_ip", ip)
     if gateway is not None:
-        wifi_gateway = gateway
+        config_set("wifi_gateway", gateway)
     if subnet is not None:
-        wifi_subnet = subnet
-    save_config()
+        config_set("wifi_subnet", subnet)
+    config_commit()
 
 
 def connect_wifi(ssid=None, password=None, timeout_s=15):
@@ -281,44 +1381,165 @@ def wifi_rssi():
     return None
 
 
+def _hex(c):
+    # ASCII hex digit -> 0..15, else -1
+    c |= 0x20
+    if 48 <= c <= 57:
+        return c - 48
+    if 97 <= c <= 102:
+        return c - 87
+    return -1
+
+
+def url_decode(b, i=0, j=None):
+    # urlencoded bytes b[i:j] -> str: '+' is a space, %XX a byte (e.g. ':' -> %3A, ',' -> %2C)
+    if j is None:
+        j = len(b)
+    out = bytearray()
+    while i < j:
+        c = b[i]
+        if c == 43:
+            c = 32
+        elif c == 37 and i + 2 < j:
+            hi = _hex(b[i + 1])
+            lo = _hex(b[i + 2])
+            if hi >= 0 and lo >= 0:
+                c = hi << 4 | lo
+                i += 2
+        out.append(c)
+        i += 1
+    return out.decode("utf-8", "ignore")
+
+
+def form_params(body):
+    # urlencoded POST body -> {name: decoded value}, scanned in place
+    params = {}
+    n = len(body)
+    i = 0
+    while i < n:
+        j = i
+        eq = -1
+        while j < n and body[j] != 38:  # '&'
+            if body[j] == 61 and eq < 0:  # '='
+                eq = j
+            j += 1
+        if eq >= 0:
+            params[url_decode(body, i, eq)] = url_decode(body, eq + 1, j)
+        i = j + 1
+    return params
+
+
+def hdr_at(buf, i, j, name):
+    # index just past a (lowercase) header name at the start of line buf[i:j], else 0
+    if j - i < len(name):
+        return 0
+    for k in range(len(name)):
+        if (buf[i + k] | 0x20) != name[k]:
+            return 0
+    i += len(name)
+    while i < j and buf[i] == 32:
+        i += 1
+    return i
+
+
+def parse_int(buf, i, j, base):
+    v = 0
+    while i < j:
+        d = _hex(buf[i])
+        if d < 0 or d >= base:
+            break
+        v = v * base + d
+        i += 1
+    return v
+
+
 def create_server(ip):
     addr = socket.getaddrinfo("0.0.0.0", 80)[0][-1]
     s = socket.socket()
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     s.bind(addr)
-    s.listen(2)
-    s.settimeout(0.05)
+    s.listen(HTTP_MAX_CONNS)
+    s.setblocking(False)
     print("HTTP server on http://{}:80".format(ip))
     return s
 
 
-HTML = """<!DOCTYPE html>
+def _compile(tpl):
+    # str.format-style template -> tuple of constant bytes and field names, "{{"/"}}" unescaped
+    parts = []
+    lit = ""
+    i = 0
+    n = len(tpl)
+    while i < n:
+        c = tpl[i]
+        if c in "{}" and tpl[i + 1:i + 2] == c:
+            lit += c
+            i += 2
+        elif c == "{":
+            j = tpl.index("}", i)
+            parts.append(lit.encode())
+            parts.append(tpl[i + 1:j])
+            lit = ""
+            i = j + 1
+        else:
+            j = i + 1
+            while j < n and tpl[j] not in "{}":
+                j += 1
+            lit += tpl[i:j]
+            i = j
+    parts.append(lit.encode())
+    return tuple(parts)
+
+
+def html_escape(s):
+    # & < > " for element text and quoted attribute values; most values have none and pass as they are
+    if "&" in s:
+        s = s.replace("&", "&amp;")
+    if "<" in s:
+        s = s.replace("<", "&lt;")
+    if ">" in s:
+        s = s.replace(">", "&gt;")
+    if '"' in s:
+        s = s.replace('"', "&quot;")
+    return s
+
+
+def template_parts(tpl, vals):
+    # compiled template -> byte pieces; fields are a nested template, a list of markup strings,
+    # or a value, which is HTML-escaped (settings such as Wi-Fi and MQTT passwords may hold quotes)
+    for i in range(len(tpl)):
+        part = tpl[i]
+        if i & 1 == 0:
+            if part:
+                yield part
+            continue
+        v = vals[part]
+        if type(v) is tuple:
+            yield from template_parts(v, vals)
+        elif type(v) is list:
+            for x in v:
+                yield x.encode()
+        elif type(v) is str:
+            yield html_escape(v).encode()
+        else:
+            yield str(v).encode()
+
+
+def template_len(tpl, vals):
+    n = 0
+    for part in template_parts(tpl, vals):
+        n += len(part)
+    return n
+
+
+HTTP_CHUNK = 512  # response bytes per send(); each connection packs small pieces into a buffer this big
+
+
+HTML = _compile("""<!DOCTYPE html>
 <html><head><meta charset="utf-8"><meta name="viewport" content="width=device-width,initial-scale=1">
-{refresh}
 <title>ESP32-C3 PT100</title>
-<style>
-*{{box-sizing:border-box;}}
-body{{font-family:Arial,sans-serif;background:radial-gradient(120% 120% at 20% 20%,#1e3a8a 0,#0f172a 45%,#0b1224 100%);color:#e2e8f0;margin:0;padding:0;}}
-.shell{{max-width:760px;margin:0 auto;padding:20px;}}
-.tabs{{display:flex;gap:8px;margin-bottom:12px;flex-wrap:wrap;}}
-.tab{{padding:10px 14px;border-radius:10px;background:rgba(255,255,255,0.06);color:#cbd5e1;text-decoration:none;border:1px solid rgba(255,255,255,0.08);transition:all .2s;}}
-.tab.active{{background:#0ea5e9;color:#0b1224;border-color:#38bdf8;box-shadow:0 10px 30px rgba(56,189,248,0.25);}}
-.card{{background:rgba(15,23,42,0.8);padding:18px 20px;border-radius:14px;box-shadow:0 15px 40px rgba(0,0,0,0.4);border:1px solid rgba(255,255,255,0.05);}}
-.grid{{display:grid;grid-template-columns:repeat(auto-fit,minmax(200px,1fr));gap:12px;}}
-.pill{{padding:10px 12px;border-radius:10px;background:rgba(255,255,255,0.04);border:1px solid rgba(255,255,255,0.06);}}
-.pill strong{{display:block;color:#38bdf8;margin-bottom:4px;}}
-code, .mono{{font-family:SFMono-Regular,Consolas,monospace;background:#0b1224;padding:2px 6px;border-radius:6px;}}
-form{{display:flex;flex-direction:column;gap:10px;margin-top:10px;}}
-input{{padding:10px 12px;border-radius:10px;border:1px solid rgba(255,255,255,0.2);background:rgba(255,255,255,0.08);color:#e2e8f0;}}
-button{{padding:10px 12px;border:none;border-radius:10px;background:#22d3ee;color:#0b1224;font-weight:700;cursor:pointer;box-shadow:0 10px 25px rgba(34,211,238,0.35);}}
-small{{color:#94a3b8;}}
-.switch{{position:relative;display:inline-block;width:54px;height:28px;}}
-.switch input{{opacity:0;width:0;height:0;}}
-.slider{{position:absolute;cursor:pointer;top:0;left:0;right:0;bottom:0;background:#475569;border-radius:14px;transition:.2s;}}
-.slider:before{{position:absolute;content:'';height:22px;width:22px;left:3px;top:3px;background:white;border-radius:50%;transition:.2s;}}
-input:checked + .slider{{background:#0ea5e9;}}
-input:checked + .slider:before{{transform:translateX(26px);}}
-</style></head>
+<link rel="stylesheet" href="/static/app.css?v={css_v}">
+</head>
 <body>
 <div class="shell">
   <div class="tabs">
@@ -330,14 +1551,10 @@ input:checked + .slider:before{{transform:translateX(26px);}}
     {content}
   </div>
 </div>
-</body></html>"""
+</body></html>""")
 
 
-def render_page(get_state_fn, tab="dashboard", note=""):
-    status, temp, err, ts, send_status, ip, synced, pcount, paccm, pcpm, c_enabled, r_enabled = get_state_fn()
-    refresh = '<meta http-equiv="refresh" content="10">' if tab == "dashboard" else ""
-    if tab == "settings":
-        content = """
+SETTINGS_HTML = _compile("""
         <h2>Wi-Fi Settings</h2>
         <form method="POST" action="/settings">
           <label style="display:flex;align-items:center;gap:10px;">
@@ -354,7 +1571,11 @@ def render_page(get_state_fn, tab="dashboard", note=""):
           <input name="gateway" placeholder="Gateway" value="{gw}">
           <input name="subnet" placeholder="Subnet mask" value="{mask}">
           <input name="divider" placeholder="Counter divider" value="{divider}">
+          <label>Pulse channels (pin:name[:save div[:send div]], comma separated, max 4)</label>
+          <input name="pulse_channels" placeholder="20:good,21:reject" value="{pchans}">
           <h3>RS485 Settings</h3>
+          <label>Baud rate</label>
+          <input name="rs485_baud" placeholder="9600" value="{rs_baud}">
           <label>Slave address (1-247)</label>
           <input name="rs485_slave" placeholder="Slave address (1-247)" value="{rs_slave}">
           <label>Function (3=holding, 4=input)</label>
@@ -363,6 +1584,28 @@ def render_page(get_state_fn, tab="dashboard", note=""):
           <input name="rs485_reg" placeholder="Start register (e.g., 0)" value="{rs_reg}">
           <label>Register count</label>
           <input name="rs485_count" placeholder="Register count" value="{rs_count}">
+          <label>Register map (name:offset:type:order:scale, first = temperature)</label>
+          <input name="rs485_map" placeholder="temp:0:int16:ABCD:0.1" value="{rs_map}">
+          <label>Poll period (ms)</label>
+          <input name="rs485_period" placeholder="10000" value="{rs_period}">
+          <label>Extra devices (name:slave:func:reg:count:period_ms:priority, ...)</label>
+          <input name="rs485_devices" placeholder="flow:2:3:0:4:1000:1" value="{rs_devices}">
+          <label>Modbus TCP cache TTL (ms)</label>
+          <input name="mbtcp_ttl" placeholder="1000" value="{mbtcp_ttl}">
+          <label style="display:flex;align-items:center;gap:10px;">
+            <span>Modbus TCP :502 (reboot to apply)</span>
+            <label class="switch">
+              <input type="checkbox" name="mbtcp_on" value="1" {mbtcp_checked}>
+              <span class="slider"></span>
+            </label>
+          </label>
+          <label style="display:flex;align-items:center;gap:10px;">
+            <span>Modbus TCP read-only (functions 1-4)</span>
+            <label class="switch">
+              <input type="checkbox" name="mbtcp_ro" value="1" {mbtcp_ro_checked}>
+              <span class="slider"></span>
+            </label>
+          </label>
           <label style="display:flex;align-items:center;gap:10px;">
             <span>Counter</span>
             <label class="switch">
@@ -377,7 +1620,15 @@ def render_page(get_state_fn, tab="dashboard", note=""):
               <span class="slider"></span>
             </label>
           </label>
-          <button type="submit">Save (reboot to apply)</button>
+          <button type="submit">Save</button>
+        </form>
+        <form method="POST" action="/rs485_scan" style="margin-top:10px;">
+          <label style="display:flex;align-items:center;gap:10px;">
+            <input type="checkbox" name="all_bauds" value="1" style="width:auto;">
+            <span>Try all common baud rates</span>
+          </label>
+          <button type="submit" style="background:#a78bfa;color:#0b1224;">Scan RS485 bus (ids 1-247)</button>
+          <small>{scan}</small>
         </form>
         <form method="POST" action="/reset_counter" style="margin-top:10px;">
           <button type="submit" style="background:#f59e0b;color:#0b1224;">Reset Counter</button>
@@ -390,26 +1641,9 @@ def render_page(get_state_fn, tab="dashboard", note=""):
         </form>
         <p><small>{note}</small></p>
         <p><small>MAC: {mac}</small></p>
-        """.format(
-            ssid=wifi_ssid,
-            pwd=wifi_pass,
-            ip=wifi_ip,
-            gw=wifi_gateway,
-            mask=wifi_subnet,
-            dhcp_checked="checked" if wifi_mode != "static" else "",
-            static_checked="checked" if wifi_mode == "static" else "",
-            note=note or "",
-            mac=device_mac,
-            divider=counter_divider,
-            rs_slave=RS485_SLAVE,
-            rs_func=RS485_FUNC,
-            rs_reg=RS485_REG,
-            rs_count=RS485_COUNT,
-            counter_checked="checked" if counter_enabled else "",
-            rs485_checked="checked" if rs485_enabled else ""
-        )
-    elif tab == "upload":
-        content = """
+        """)
+
+UPLOAD_HTML = _compile("""
         <h2>Upload Targets</h2>
         <form method="POST" action="/upload">
           <label>Host</label>
@@ -433,11 +1667,117 @@ def render_page(get_state_fn, tab="dashboard", note=""):
           </select>
           <label>Counter send divider (pulses)</label>
           <input name="upload_counter_div" placeholder="10" value="{cdiv}">
-          <p style="font-size:12px;color:#94a3b8;">Counter payload: devid=&lt;id&gt;&amp;qty=&lt;qty&gt;&amp;accm=&lt;accm&gt;&amp;cpm=&lt;cpm&gt;<br>Temp payload: devid=&lt;id&gt;&amp;temp=&lt;value&gt;&amp;kfactor=&lt;k&gt;</p>
+          <label>Upload mode</label>
+          <select name="upload_mode">
+            <option value="get" {mode_get}>One GET per reading</option>
+            <option value="bulk" {mode_bulk}>Bulk POST (batched)</option>
+            <option value="mqtt" {mode_mqtt}>MQTT publish</option>
+          </select>
+          <label>Bulk / MQTT payload encoding</label>
+          <select name="upload_encoding">
+            <option value="text" {enc_text}>Text</option>
+            <option value="binary" {enc_bin}>Binary frames (upload_decoder.py)</option>
+          </select>
+          <label>Bulk path</label>
+          <input name="upload_bulk_path" placeholder="iot2026/smart01/bulk.php" value="{bpath}">
+          <label>Bulk batch size (readings, 1-{qmax})</label>
+          <input name="upload_batch" placeholder="16" value="{batch}">
+          <label>Bulk flush interval (seconds)</label>
+          <input name="upload_batch_s" placeholder="60" value="{batch_s}">
+          <label>MQTT broker (blank = upload host)</label>
+          <input name="mqtt_host" placeholder="broker host" value="{mq_host}">
+          <label>MQTT port</label>
+          <input name="mqtt_port" placeholder="1883" value="{mq_port}">
+          <label>MQTT topic prefix</label>
+          <input name="mqtt_topic" placeholder="iot2026" value="{mq_topic}">
+          <label>MQTT QoS</label>
+          <select name="mqtt_qos">
+            <option value="0" {mq_qos0}>0 (at most once)</option>
+            <option value="1" {mq_qos1}>1 (at least once)</option>
+          </select>
+          <label>MQTT keepalive (seconds)</label>
+          <input name="mqtt_keepalive" placeholder="60" value="{mq_ka}">
+          <label>MQTT user / password (optional)</label>
+          <input name="mqtt_user" placeholder="user" value="{mq_user}">
+          <input name="mqtt_pass" placeholder="password" value="{mq_pass}">
+          <label>Spool replay rate after an outage (records/min)</label>
+          <input name="upload_drain" placeholder="60" value="{drain}">
+          <label>When the upload queue is full</label>
+          <select name="upload_overflow">
+            <option value="coalesce" {ov_coalesce}>Coalesce counter events into latest totals</option>
+            <option value="drop_oldest" {ov_drop}>Drop oldest</option>
+          </select>
+          <p style="font-size:12px;color:#94a3b8;">Counter payload: devid=&lt;id&gt;&amp;qty=&lt;qty&gt;&amp;accm=&lt;accm&gt;&amp;cpm=&lt;cpm&gt;<br>Temp payload: devid=&lt;id&gt;&amp;temp=&lt;value&gt;&amp;kfactor=&lt;k&gt;<br>Bulk body: devid=&lt;id&gt;&amp;pdid=&lt;pdid&gt;&amp;kfactor=&lt;k&gt;&amp;n=&lt;rows&gt;&amp;d=C,&lt;ts&gt;,&lt;qty&gt;,&lt;accm&gt;,&lt;cpm&gt;;T,&lt;ts&gt;,&lt;temp&gt;;...<br>MQTT: &lt;prefix&gt;/&lt;id&gt;/temp {{"temp":..,"kfactor":..,"ts":..}}, &lt;prefix&gt;/&lt;id&gt;/&lt;pdid&gt;/counter {{"qty":..,"accm":..,"cpm":..,"ts":..}}</p>
           <button type="submit">Save Upload Settings</button>
         </form>
         <p><small>{note}</small></p>
-        """.format(
+        """)
+
+# Static: values arrive from /api/events (see static/app.js), keyed by element id.
+# Counter channels and RS485 devices are filled into the display:contents placeholders.
+DASHBOARD_HTML = _compile("""
+        <h2>PT100 RS485</h2>
+        <div class="grid">
+          <div class="pill"><strong>Status</strong><span class="mono" id="status">-</span></div>
+          <div class="pill"><strong>Temp</strong><span class="mono" id="temp">-</span></div>
+          <div class="pill"><strong>Last error</strong><span class="mono" id="err"></span></div>
+          <div class="pill"><strong>Updated</strong><span class="mono" id="ts">-</span></div>
+          <div class="pill"><strong>Send</strong><span class="mono" id="send">-</span></div>
+          <div class="pill"><strong>Upload queue</strong><span class="mono" id="upload_queue">-</span></div>
+          <div class="pill"><strong>Upload HTTP</strong><span class="mono" id="upload_http">-</span></div>
+          <div class="pill"><strong>MQTT</strong><span class="mono" id="mqtt">-</span></div>
+          <div class="pill"><strong>Spool</strong><span class="mono" id="spool">-</span></div>
+          <div class="pill"><strong>Counter journal</strong><span class="mono" id="journal">-</span></div>
+          <div class="pill"><strong>IP</strong><span class="mono" id="ip">-</span></div>
+          <div class="pill"><strong>HTTP</strong><span class="mono" id="http">-</span></div>
+          <div class="pill"><strong>LCD I2C</strong><span class="mono" id="lcd_i2c">-</span></div>
+          <div class="pill"><strong>NTP</strong><span class="mono" id="ntp">-</span></div>
+          <div id="chans" style="display:contents"></div>
+          <div class="pill"><strong>Counter</strong><span class="mono" id="counter">-</span></div>
+          <div class="pill"><strong>RS485</strong><span class="mono" id="rs485">-</span></div>
+          <div class="pill"><strong>Registers</strong><span class="mono" id="regs">-</span></div>
+          <div class="pill"><strong>RS485 bus</strong><span class="mono" id="bus">-</span></div>
+          <div class="pill"><strong>Modbus TCP</strong><span class="mono" id="mbtcp">-</span></div>
+          <div id="devs" style="display:contents"></div>
+        </div>
+        <p><small id="live">connecting...</small></p>
+        <script src="/static/app.js?v={js_v}"></script>
+        """)
+
+
+def page_values(tab="dashboard", note=""):
+    # field values for one page; the markup stays in the compiled templates
+    if tab == "settings":
+        vals = dict(
+            ssid=wifi_ssid,
+            pwd=wifi_pass,
+            ip=wifi_ip,
+            gw=wifi_gateway,
+            mask=wifi_subnet,
+            dhcp_checked="checked" if wifi_mode != "static" else "",
+            static_checked="checked" if wifi_mode == "static" else "",
+            note=note or "",
+            mac=device_mac,
+            divider=counter_divider,
+            pchans=PULSE_CHANNELS,
+            rs_baud=RS485_BAUD,
+            rs_slave=RS485_SLAVE,
+            rs_func=RS485_FUNC,
+            rs_reg=RS485_REG,
+            rs_count=RS485_COUNT,
+            rs_map=RS485_MAP,
+            rs_period=RS485_PERIOD_MS,
+            rs_devices=RS485_DEVICES,
+            scan=bus_scan.status() if bus_scan else "",
+            mbtcp_ttl=MBTCP_CACHE_TTL_MS,
+            mbtcp_checked="checked" if MBTCP_ENABLED else "",
+            mbtcp_ro_checked="checked" if MBTCP_READ_ONLY else "",
+            counter_checked="checked" if counter_enabled else "",
+            rs485_checked="checked" if rs485_enabled else ""
+        )
+        vals["content"] = SETTINGS_HTML
+    elif tab == "upload":
+        vals = dict(
             host=UPLOAD_HOST,
             cpath=UPLOAD_COUNTER_PATH,
             tpath=UPLOAD_TEMP_PATH,
@@ -449,253 +1789,617 @@ def render_page(get_state_fn, tab="dashboard", note=""):
             int180="selected" if UPLOAD_TEMP_INTERVAL_MS == 180_000 else "",
             int300="selected" if UPLOAD_TEMP_INTERVAL_MS == 300_000 else "",
             cdiv=counter_send_divider,
+            drain=SPOOL_DRAIN_PER_MIN,
+            mode_get="selected" if UPLOAD_MODE == "get" else "",
+            mode_bulk="selected" if UPLOAD_MODE == "bulk" else "",
+            mode_mqtt="selected" if UPLOAD_MODE == "mqtt" else "",
+            enc_text="selected" if UPLOAD_ENCODING == "text" else "",
+            enc_bin="selected" if UPLOAD_ENCODING == "binary" else "",
+            mq_host=MQTT_HOST,
+            mq_port=MQTT_PORT,
+            mq_topic=MQTT_TOPIC,
+            mq_qos0="selected" if MQTT_QOS == 0 else "",
+            mq_qos1="selected" if MQTT_QOS == 1 else "",
+            mq_ka=MQTT_KEEPALIVE_S,
+            mq_user=MQTT_USER,
+            mq_pass=MQTT_PASS,
+            bpath=UPLOAD_BULK_PATH,
+            batch=UPLOAD_BATCH_SIZE,
+            qmax=UPLOAD_QUEUE_MAX,
+            batch_s=UPLOAD_BATCH_MAX_MS // 1000,
+            ov_coalesce="selected" if UPLOAD_OVERFLOW == "coalesce" else "",
+            ov_drop="selected" if UPLOAD_OVERFLOW == "drop_oldest" else "",
             note=note or ""
         )
+        vals["content"] = UPLOAD_HTML
     else:
-        content = """
-        <h2>PT100 RS485</h2>
-        <div class="grid">
-          <div class="pill"><strong>Status</strong><span class="mono">{status}</span></div>
-          <div class="pill"><strong>Temp</strong><span class="mono">{temp}</span></div>
-          <div class="pill"><strong>Last error</strong><span class="mono">{err}</span></div>
-          <div class="pill"><strong>Updated</strong><span class="mono">{ts}</span></div>
-          <div class="pill"><strong>Send</strong><span class="mono">{send}</span></div>
-          <div class="pill"><strong>IP</strong><span class="mono">{ip}</span></div>
-          <div class="pill"><strong>NTP</strong><span class="mono">{synced}</span></div>
-          <div class="pill"><strong>Pulse count</strong><span class="mono">{pcount}</span></div>
-          <div class="pill"><strong>Pulse accm</strong><span class="mono">{paccm}</span></div>
-          <div class="pill"><strong>CPM</strong><span class="mono">{pcpm}</span></div>
-          <div class="pill"><strong>Counter</strong><span class="mono">{cstat}</span></div>
-          <div class="pill"><strong>RS485</strong><span class="mono">{rstat}</span></div>
-        </div>
-        """.format(status=status, temp=temp, err=err, ts=ts, send=send_status, ip=ip, synced=("yes" if synced else "no"),
-                   pcount=pcount, paccm=paccm, pcpm=pcpm,
-                   cstat="on" if c_enabled else "off",
-                   rstat="on" if r_enabled else "off")
-    return HTML.format(
-        refresh=refresh,
-        dash_active="active" if tab == "dashboard" else "",
-        set_active="active" if tab == "settings" else "",
-        upload_active="active" if tab == "upload" else "",
-        content=content
-    )
-
-
-def handle_http_once(sock, get_state_fn):
-    global counter_divider, counter_send_divider, divider_counter, pulse_count, pulse_accm, counter_save_pending, counter_enabled, rs485_enabled, RS485_SLAVE, RS485_FUNC, RS485_REG, RS485_COUNT
-    global pulse_window_start, pulse_window_pulses, counter_send_accum, counter_send_pending
-    global UPLOAD_HOST, UPLOAD_COUNTER_PATH, UPLOAD_TEMP_PATH, UPLOAD_TEMP_INTERVAL_MS, UPLOAD_DEVICE_ID, UPLOAD_PDID, KFACTOR
-    try:
-        client, _ = sock.accept()
-    except OSError:
-        return False
+        vals = {"js_v": static_version(b"/static/app.js"), "content": DASHBOARD_HTML}
+    vals["css_v"] = static_version(b"/static/app.css")
+    vals["dash_active"] = "active" if tab == "dashboard" else ""
+    vals["set_active"] = "active" if tab == "settings" else ""
+    vals["upload_active"] = "active" if tab == "upload" else ""
+    return vals
+
+
+def send_page(client, tab="dashboard", note=""):
+    # a counting pass first, so Content-Length is exact without building the page in memory;
+    # the connection then pulls the pieces as the socket takes them
+    vals = page_values(tab, note)
+    client.sendall("HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Length: {}\r\nConnection: close\r\n\r\n".format(
+        template_len(HTML, vals)).encode())
+    client.sendparts(template_parts(HTML, vals))
+
+
+# Static assets: url -> (flash path, content type). A gzipped copy (path + ".gz") is preferred;
+# pages link them with ?v=<etag>, so browsers may cache them for a year without revalidating.
+STATIC_FILES = {
+    b"/static/app.css": ("static/app.css", "text/css"),
+    b"/static/app.js": ("static/app.js", "application/javascript"),
+}
+STATIC_MAX_AGE_S = 31_536_000
+_static_meta = {}  # flash path -> (size, etag) or None when missing, filled on first use
+_static_buf = bytearray(HTTP_CHUNK)
+
+
+def _static_file(path):
+    if path not in _static_meta:
+        meta = None
+        try:
+            size = os.stat(path)[6]
+            h = hashlib.sha256()
+            mv = memoryview(_static_buf)
+            with open(path, "rb") as f:
+                while True:
+                    n = f.readinto(_static_buf)
+                    if not n:
+                        break
+                    h.update(mv[:n])
+            meta = (size, '"' + "".join("{:02x}".format(b) for b in h.digest()[:8]) + '"')
+        except OSError:
+            pass
+        _static_meta[path] = meta
+    return _static_meta[path]
+
+
+def static_version(url):
+    path = STATIC_FILES[url][0]
+    meta = _static_file(path + ".gz") or _static_file(path)
+    return meta[1][1:-1] if meta else "0"
+
+
+def send_static(client, url, gzip_ok, if_none_match):
+    path, ctype = STATIC_FILES[url]
+    enc = ""
+    meta = _static_file(path + ".gz") if gzip_ok else None
+    if meta:
+        path += ".gz"
+        enc = "Content-Encoding: gzip\r\n"
+    else:
+        meta = _static_file(path)
+    if not meta:
+        client.sendall(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+        return
+    size, etag = meta
+    cache = "ETag: {}\r\nCache-Control: public, max-age={}\r\nVary: Accept-Encoding\r\n".format(etag, STATIC_MAX_AGE_S)
+    if if_none_match and etag in if_none_match:
+        client.sendall("HTTP/1.1 304 Not Modified\r\n{}Connection: close\r\n\r\n".format(cache).encode())
+        return
+    client.sendall("HTTP/1.1 200 OK\r\nContent-Type: {}\r\n{}Content-Length: {}\r\n{}Connection: close\r\n\r\n".format(
+        ctype, enc, size, cache).encode())
+    client.sendfile(path)  # straight from flash, one buffer at a time
+
+
+# /api/state answers with the whole state as JSON; its ETag changes only when a value does
+_api_boot = struct.unpack("<I", os.urandom(4))[0]  # keeps ETags from a previous boot from matching
+_api_last = None
+_api_seq = 0
+
+
+def send_api_state(client, get_state_fn, if_none_match):
+    global _api_last, _api_seq
+    d = get_state_fn()
+    if d != _api_last:
+        _api_last = d
+        _api_seq += 1
+    etag = '"{:08x}-{}"'.format(_api_boot, _api_seq)
+    if if_none_match and etag in if_none_match:
+        client.sendall("HTTP/1.1 304 Not Modified\r\nETag: {}\r\nConnection: close\r\n\r\n".format(etag).encode())
+        return
+    body = json.dumps(d).encode()
+    client.sendall("HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nCache-Control: no-cache\r\nETag: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n".format(
+        etag, len(body)).encode())
+    client.sendall(body)
+
+
+class EventStream:
+    """Server-Sent Events to the open dashboards: the full state on connect, then only changed fields."""
+
+    def __init__(self):
+        self.clients = []
+        self.last = {}      # values as of the last push; every client has seen at least these
+        self.last_diag = time.ticks_ms()
+        self.last_beat = self.last_diag
+
+    def open(self, client, get_state_fn):
+        if len(self.clients) >= SSE_MAX_CLIENTS:
+            client.sendall(b"HTTP/1.1 503 Service Unavailable\r\nRetry-After: 10\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            return
+        client.sendall(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: keep-alive\r\n\r\nretry: 3000\n")
+        client.sendall(b"data: " + json.dumps(get_state_fn()).encode() + b"\n\n")
+        client.then = self.clients.append  # the socket is ours once the first event is out
+        # tick() does not run without clients, so the stamps may be older than the ticks_diff range
+        # (2^29 ms, about 6 days); the full state just queued counts as the diagnostics pass
+        self.last_diag = self.last_beat = time.ticks_ms()
+
+    def _send(self, msg):
+        for c in self.clients[:]:
+            try:
+                if c.send(msg) == len(msg):
+                    continue
+            except OSError:
+                pass
+            self.clients.remove(c)  # EventSource reconnects by itself
+            try:
+                c.close()
+            except OSError:
+                pass
+
+    def tick(self, now, get_state_fn):
+        if not self.clients:
+            return
+        # live values every tick; the slower diagnostics every SSE_DIAG_MS
+        diag = time.ticks_diff(now, self.last_diag) >= SSE_DIAG_MS
+        if diag:
+            self.last_diag = now
+        d = get_state_fn(diag)
+        changed = {}
+        for k in d:
+            if self.last.get(k) != d[k]:
+                changed[k] = d[k]
+                self.last[k] = d[k]
+        if changed:
+            self._send(b"data: " + json.dumps(changed).encode() + b"\n\n")
+            self.last_beat = now
+        elif time.ticks_diff(now, self.last_beat) >= SSE_HEARTBEAT_MS:
+            self._send(b": \n\n")  # comment line keeps proxies and the browser from timing out
+            self.last_beat = now
+
+
+events = EventStream()
+
+
+def _reset_device(sock):
+    sock.close()
+    if journal:
+        pulse_service()
+        journal.retain(pulses)  # counts since the last append survive the reset
+    machine.reset()
+
+
+# Route handlers get the parsed connection (path, query, headers, body) and queue the response on it.
+def route_dashboard(c, get_state_fn):
+    # "/?tab=..." links from before the tabs had their own paths
+    if b"tab=settings" in c.query:
+        send_page(c, tab="settings")
+    elif b"tab=upload" in c.query:
+        send_page(c, tab="upload")
+    else:
+        send_page(c, tab="dashboard")
+
+
+def route_settings(c, get_state_fn):
+    send_page(c, tab="settings")
+
+
+def route_upload(c, get_state_fn):
+    send_page(c, tab="upload")
+
+
+def route_static(c, get_state_fn):
+    send_static(c, c.path, c.gzip_ok, c.if_none_match)
+
+
+def route_api_state(c, get_state_fn):
+    send_api_state(c, get_state_fn, c.if_none_match)
+
+
+def route_api_events(c, get_state_fn):
+    events.open(c, get_state_fn)
+
+
+def route_save_settings(c, get_state_fn):
+    params = form_params(c.body())
+    if "ssid" not in params:
+        send_page(c, tab="settings", note="No data")
+        return
+    for name, key in SETTINGS_FORM:
+        config_set(key, params.get(name, "").strip())
+    note = "Saved and applied. Wi-Fi and Modbus TCP on/off take effect after Reset Device."
+    rs_map_val = params.get("rs485_map", "").strip()
+    if rs_map_val and not config_set("RS485_MAP", rs_map_val):
+        note = "Register map rejected, kept: " + RS485_MAP
+    if not config_set("RS485_DEVICES", params.get("rs485_devices", "")):
+        note = "Device table rejected, kept: " + (RS485_DEVICES or "none")
+    for ch in range(pulses.n):
+        pulses.divider[ch] = 0
+    # If slider unchecked, mode is empty -> DHCP; blank fields keep the current values
+    set_wifi(params.get("ssid", "").strip(), params.get("password", "").strip(),
+             "static" if params.get("mode", "") == "static" else "dhcp",
+             params.get("ip", "").strip() or None, params.get("gateway", "").strip() or None,
+             params.get("subnet", "").strip() or None)
+    send_page(c, tab="settings", note=note)
+
+
+def route_save_upload(c, get_state_fn):
+    params = form_params(c.body())
+    for name, key in UPLOAD_FORM:
+        config_set(key, params.get(name, "").strip())
     try:
-        req = client.recv(512)
-        if not req:
-            return False
-        req_line = req.split(b"\r\n", 1)[0]
-        # capture any body bytes that arrived with the first read
-        header_split = req.find(b"\r\n\r\n")
-        initial_body = b""
-        content_length = 0
-        if header_split != -1:
-            headers_part = req[:header_split].decode("utf-8", "ignore")
-            for hline in headers_part.split("\r\n"):
-                if hline.lower().startswith("content-length:"):
-                    try:
-                        content_length = int(hline.split(":", 1)[1].strip())
-                    except:
-                        content_length = 0
-            initial_body = req[header_split + 4:]
-        print("Request:", req_line)
-        is_settings = b"/settings" in req_line or b"tab=settings" in req_line
-        is_upload = b"/upload" in req_line or b"tab=upload" in req_line
-        method = b"GET"
-        if req_line:
-            parts = req_line.split()
-            if len(parts) >= 1:
-                method = parts[0]
-        body = ""
-        if method == b"POST":
-            # read rest for form data (honor content-length)
-            rest = initial_body
-            remaining = max(0, content_length - len(initial_body))
-            while remaining > 0:
-                chunk = client.recv(min(remaining, 2048))
-                if not chunk:
+        batch_s = params.get("upload_batch_s", "").strip()
+        if batch_s:
+            config_set("UPLOAD_BATCH_MAX_MS", int(batch_s) * 1000)
+    except ValueError:
+        pass
+    print("Upload settings changed:", sorted(config_commit()))
+    send_page(c, tab="upload", note="Upload settings saved and applied.")
+
+
+def route_rs485_scan(c, get_state_fn):
+    start_bus_scan(form_params(c.body()).get("all_bauds") == "1")
+    send_page(c, tab="settings", note="RS485 scan started, reload Settings for results.")
+
+
+def route_reset_counter(c, get_state_fn):
+    pulses.reset()
+    save_counters()
+    send_page(c, tab="settings", note="Counter reset & saved.")
+
+
+def route_reset_accm(c, get_state_fn):
+    pulses.reset(accm=True)
+    save_counters()
+    send_page(c, tab="settings", note="Accumulation+Counter reset & saved.")
+
+
+def route_reset(c, get_state_fn):
+    c.sendall(b"HTTP/1.1 302 Found\r\nLocation: /\r\nContent-Type: text/plain\r\nConnection: close\r\n\r\nRedirecting...")
+    c.then = _reset_device  # after the redirect is out
+
+
+# exact path -> (GET handler, POST handler); anything else is a 404, a missing handler a 405
+HTTP_ROUTES = {
+    b"/": (route_dashboard, None),
+    b"/settings": (route_settings, route_save_settings),
+    b"/upload": (route_upload, route_save_upload),
+    b"/rs485_scan": (None, route_rs485_scan),
+    b"/reset_counter": (None, route_reset_counter),
+    b"/reset_accm": (None, route_reset_accm),
+    b"/reset": (None, route_reset),
+    b"/api/state": (route_api_state, None),
+    b"/api/events": (route_api_events, None),
+}
+for _url in STATIC_FILES:
+    HTTP_ROUTES[_url] = (route_static, None)
+
+HTTP_REASONS = {
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Content Too Large",
+    431: "Request Header Fields Too Large",
+    501: "Not Implemented",
+}
+
+
+class HttpConn:
+    """One browser connection: request bytes in, then the queued response out as the socket takes it.
+
+    The request is read into a buffer lent by the server and parsed in place, line by line as it
+    arrives; the response is packed into a second lent buffer of HTTP_CHUNK bytes. Handlers write
+    to it like a socket; sendparts() and sendfile() queue a template or a flash file that is read
+    only when the previous bytes are gone, so a page never sits in memory whole."""
+
+    def __init__(self, sock, rx, tx, now):
+        self.sock = sock
+        self.rx = rx         # HTTP_MAX_HEADER + HTTP_MAX_BODY bytes; None once the request is handled
+        self.rxv = memoryview(rx)
+        self.end = 0         # bytes received
+        self.pos = 0         # start of the line being parsed
+        self.scan = 0        # where the search for its CRLF resumes
+        self.route = None    # handler, once the request line is in
+        self.path = b""
+        self.query = b""
+        self.gzip_ok = False
+        self.if_none_match = ""
+        self.body_at = -1    # body offset, once the headers are in
+        self.length = 0
+        self.tx = tx         # memoryview of HTTP_CHUNK bytes; None once the connection is done
+        self.srcs = []       # response sources in order: bytes, template piece generators, open files
+        self.out = None      # memoryview still to send
+        self.then = None     # called with the socket once the response is out, instead of closing it
+        self.last = now
+
+    # -- request --
+    def parse(self):
+        # 0 while more bytes are needed, 200 once the request is complete, else the status to reject it with
+        rx = self.rx
+        while self.body_at < 0:
+            i = self.scan
+            end = self.end
+            while i + 1 < end and not (rx[i] == 13 and rx[i + 1] == 10):
+                i += 1
+            if i + 2 > HTTP_MAX_HEADER or (i + 1 >= end and end >= HTTP_MAX_HEADER):
+                return 431
+            if i + 1 >= end:
+                self.scan = i
+                return 0
+            status = self._line(self.pos, i) if self.route else self._request_line(self.pos, i)
+            if status:
+                return status
+            self.pos = self.scan = i + 2
+        if self.length > HTTP_MAX_BODY:
+            return 413
+        return 200 if self.end >= self.body_at + self.length else 0
+
+    def _request_line(self, i, j):
+        # METHOD SP path[?query] SP HTTP/x.y; the route is looked up before any header is read
+        rx = self.rx
+        k = i
+        while k < j and rx[k] != 32:
+            k += 1
+        if k - i == 3 and rx[i] == 71 and rx[i + 1] == 69 and rx[i + 2] == 84:  # GET
+            m = 0
+        elif k - i == 4 and rx[i] == 80 and rx[i + 1] == 79 and rx[i + 2] == 83 and rx[i + 3] == 84:  # POST
+            m = 1
+        else:
+            return 501
+        a = k + 1
+        q = b = a
+        while b < j and rx[b] != 32:
+            if rx[b] == 63 and q == a:  # '?'
+                q = b
+            b += 1
+        if b == a or b == j or rx[a] != 47:  # no path, no version, or not starting with '/'
+            return 400
+        if q == a:
+            q = b
+        self.path = bytes(self.rxv[a:q])
+        self.query = bytes(self.rxv[q + 1:b]) if q < b else b""
+        handlers = HTTP_ROUTES.get(self.path)
+        if handlers is None:
+            return 404
+        self.route = handlers[m]
+        if self.route is None:
+            return 405
+        return 0
+
+    def _line(self, i, j):
+        if i == j:  # blank line: headers done
+            self.body_at = j + 2
+            return 0
+        rx = self.rx
+        k = hdr_at(rx, i, j, b"content-length:")
+        if k:
+            self.length = parse_int(rx, k, j, 10)
+        elif hdr_at(rx, i, j, b"accept-encoding:"):
+            self.gzip_ok = b"gzip" in bytes(self.rxv[i:j])
+        else:
+            k = hdr_at(rx, i, j, b"if-none-match:")
+            if k:
+                self.if_none_match = bytes(self.rxv[k:j]).decode()
+        return 0
+
+    def body(self):
+        return self.rxv[self.body_at:self.body_at + self.length]
+
+    # -- response --
+    def sendall(self, data):
+        self.srcs.append(bytes(data))
+
+    def sendparts(self, parts):
+        self.srcs.append(parts)
+
+    def sendfile(self, path):
+        self.srcs.append(open(path, "rb"))
+
+    def fill(self):
+        # next bytes to send: small pieces are packed into buf, large ones go out as they are
+        n = 0
+        tx = self.tx
+        size = len(tx)
+        srcs = self.srcs
+        while srcs:
+            src = srcs[0]
+            if type(src) is bytes:
+                part = srcs.pop(0)
+            elif hasattr(src, "readinto"):
+                if n:
                     break
-                rest += chunk
-                remaining -= len(chunk)
-            if b"/reset_counter" in req_line:
-                pulse_count = 0
-                divider_counter = 0
-                save_counters()
-                body = render_page(get_state_fn, tab="settings", note="Counter reset & saved.")
-                response = "HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Length: {}\r\nConnection: close\r\n\r\n{}".format(
-                    len(body), body
-                )
-                client.send(response)
-                return True
-            if b"/reset_accm" in req_line:
-                pulse_accm = 0
-                pulse_count = 0
-                divider_counter = 0
-                save_counters()
-                body = render_page(get_state_fn, tab="settings", note="Accumulation+Counter reset & saved.")
-                response = "HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Length: {}\r\nConnection: close\r\n\r\n{}".format(
-                    len(body), body
-                )
-                client.send(response)
-                return True
-            if b"/reset" in req_line:
-                client.send(b"HTTP/1.1 302 Found\r\nLocation: /\r\nContent-Type: text/plain\r\nConnection: close\r\n\r\nRedirecting...")
-                client.close()
-                machine.reset()
-                return True
-            if b"/upload" in req_line:
-                try:
-                    payload = rest.split(b"\r\n\r\n", 1)[1]
-                except IndexError:
-                    payload = rest
-                params = {}
-                for pair in payload.split(b"&"):
-                    if b"=" in pair:
-                        k, v = pair.split(b"=", 1)
-                        params[k.decode()] = v.decode().replace("+", " ")
-                host_val = params.get("upload_host", "").strip()
-                cpath_val = params.get("upload_counter_path", "").strip()
-                tpath_val = params.get("upload_temp_path", "").strip()
-                temp_interval_val = params.get("upload_temp_interval", "").strip()
-                counter_div_val = params.get("upload_counter_div", "").strip()
-                device_val = params.get("upload_device_id", "").strip()
-                pdid_val = params.get("upload_pdid", "").strip()
-                kfactor_val = params.get("upload_kfactor", "").strip()
-                # normalize encoded slashes if present
-                cpath_val = cpath_val.replace("%252F", "/").replace("%2F", "/")
-                tpath_val = tpath_val.replace("%252F", "/").replace("%2F", "/")
-                print("Upload POST -> host:", host_val, "cpath:", cpath_val, "tpath:", tpath_val,
-                      "devid:", device_val, "pdid:", pdid_val, "kfactor:", kfactor_val,
-                      "temp_int:", temp_interval_val, "ctr_div:", counter_div_val)
-                if host_val:
-                    UPLOAD_HOST = host_val
-                if cpath_val:
-                    UPLOAD_COUNTER_PATH = cpath_val
-                if tpath_val:
-                    UPLOAD_TEMP_PATH = tpath_val
-                if device_val:
-                    UPLOAD_DEVICE_ID = device_val
-                if pdid_val:
-                    UPLOAD_PDID = pdid_val
-                try:
-                    UPLOAD_TEMP_INTERVAL_MS = int(temp_interval_val) if temp_interval_val else UPLOAD_TEMP_INTERVAL_MS
-                except:
-                    pass
-                try:
-                    counter_send_divider = int(counter_div_val) if counter_div_val else counter_send_divider
-                except:
-                    pass
-                try:
-                    if kfactor_val:
-                        KFACTOR = int(kfactor_val)
-                except:
-                    pass
-                save_config()
-                body = render_page(get_state_fn, tab="upload", note="Upload settings saved.")
-            elif b"ssid=" in rest:
-                try:
-                    payload = rest.split(b"\r\n\r\n", 1)[1]
-                except IndexError:
-                    payload = rest
-                params = {}
-                for pair in payload.split(b"&"):
-                    if b"=" in pair:
-                        k, v = pair.split(b"=", 1)
-                        params[k.decode()] = v.decode().replace("+", " ")
-                ssid_val = params.get("ssid", "").strip()
-                pass_val = params.get("password", "").strip()
-                mode_val = params.get("mode", "").strip()  # "static" when slider checked, "" when DHCP
-                ip_val = params.get("ip", "").strip()
-                gw_val = params.get("gateway", "").strip()
-                mask_val = params.get("subnet", "").strip()
-                div_val = params.get("divider", "").strip()
-                rs_slave_val = params.get("rs485_slave", "").strip()
-                rs_func_val = params.get("rs485_func", "").strip()
-                rs_reg_val = params.get("rs485_reg", "").strip()
-                rs_count_val = params.get("rs485_count", "").strip()
-                counter_on = params.get("counter_on", "").strip()
-                rs485_on = params.get("rs485_on", "").strip()
-                # If slider unchecked, mode_val empty -> force DHCP
-                effective_mode = "static" if mode_val == "static" else "dhcp"
-                try:
-                    div_int = int(div_val) if div_val else counter_divider
-                except:
-                    div_int = counter_divider
-                try:
-                    slave_int = int(rs_slave_val) if rs_slave_val else RS485_SLAVE
-                except:
-                    slave_int = RS485_SLAVE
-                try:
-                    func_int = int(rs_func_val) if rs_func_val else RS485_FUNC
-                except:
-                    func_int = RS485_FUNC
-                try:
-                    reg_int = int(rs_reg_val) if rs_reg_val else RS485_REG
-                except:
-                    reg_int = RS485_REG
-                try:
-                    count_int = int(rs_count_val) if rs_count_val else RS485_COUNT
-                except:
-                    count_int = RS485_COUNT
-                prev_counter_enabled = counter_enabled
-                counter_enabled = True if counter_on == "1" else False
-                rs485_enabled = True if rs485_on == "1" else False
-                # apply wifi settings (keep existing if blank)
-                ssid_use = ssid_val or wifi_ssid
-                pass_use = pass_val or wifi_pass
-                set_wifi(ssid_use, pass_use, effective_mode, ip_val or None, gw_val or None, mask_val or None)
-                RS485_SLAVE = slave_int
-                RS485_FUNC = func_int
-                RS485_REG = reg_int
-                RS485_COUNT = count_int
-                counter_divider = div_int
-                divider_counter = 0
-                if counter_enabled and not prev_counter_enabled:
-                    # re-init pulse IRQ when turning counter on at runtime
-                    pulse_window_pulses = 0
-                    pulse_window_start = time.ticks_ms()
-                    pulse_init()
-                body = render_page(get_state_fn, tab="settings", note="Saved. Use Reset Device to apply Wi-Fi/static changes.")
+                k = src.readinto(tx)
+                if k:
+                    self.out = tx[:k]
+                    return
+                src.close()
+                srcs.pop(0)
+                continue
             else:
-                body = render_page(get_state_fn, tab="settings", note="No data")
-        else:
-            if is_upload:
-                body = render_page(get_state_fn, tab="upload")
-            elif is_settings:
-                body = render_page(get_state_fn, tab="settings")
+                try:
+                    part = next(src)
+                except StopIteration:
+                    srcs.pop(0)
+                    continue
+            k = len(part)
+            if n + k <= size:
+                tx[n:n + k] = part
+                n += k
+            elif n:
+                srcs.insert(0, part)
+                break
             else:
-                body = render_page(get_state_fn, tab="dashboard")
-        response = "HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Length: {}\r\nConnection: close\r\n\r\n{}".format(
-            len(body), body
-        )
-        client.send(response)
-    except Exception as e:
-        print("Client handling error:", e)
+                self.out = memoryview(part)
+                return
+        self.out = tx[:n] if n else None
+
+    def close(self):
+        for src in self.srcs:
+            if hasattr(src, "close"):
+                src.close()
+        self.srcs = []
         try:
-            sys.print_exception(e)
-        except Exception:
+            self.sock.close()
+        except OSError:
             pass
-    finally:
-        client.close()
-    return True
+
+
+class HttpServer:
+    """Non-blocking HTTP server: one select.poll over the listener and every open connection.
+
+    Each pass reads what has arrived, answers requests that are complete and writes as much as each
+    socket takes, so no browser can stall the firmware. A connection idle for HTTP_IDLE_TIMEOUT_MS
+    is dropped; while HTTP_MAX_CONNS are open, new ones wait in the listen backlog. Request and
+    response buffers are allocated once here and lent to connections while they read and write."""
+
+    def __init__(self, sock, get_state_fn):
+        self.sock = sock
+        self.get_state = get_state_fn
+        self.poller = select.poll()
+        self.poller.register(sock, select.POLLIN)
+        self.conns = {}  # socket -> HttpConn
+        self.pool = [bytearray(HTTP_MAX_HEADER + HTTP_MAX_BODY) for _ in range(HTTP_MAX_CONNS)]
+        self.tx_pool = [memoryview(bytearray(HTTP_CHUNK)) for _ in range(HTTP_MAX_CONNS)]
+        self.full = False
+        self.served = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    def poll(self, now):
+        # True when something happened, so the task can come straight back
+        busy = False
+        for s, ev in self.poller.ipoll(0):
+            busy = True
+            if s is self.sock:
+                self._accept(now)
+                continue
+            c = self.conns.get(s)
+            if c is None:
+                continue
+            if ev & (select.POLLERR | select.POLLHUP):
+                self._drop(c)
+            elif c.rx is not None:
+                self._read(c, now)
+            else:
+                self._write(c, now)
+        for c in list(self.conns.values()):
+            if time.ticks_diff(now, c.last) > HTTP_IDLE_TIMEOUT_MS:
+                self.timeouts += 1
+                self._drop(c)
+        full = len(self.conns) >= HTTP_MAX_CONNS
+        if full != self.full:
+            # stop watching the listener while full, or it would report the waiting clients every pass
+            self.full = full
+            self.poller.modify(self.sock, 0 if full else select.POLLIN)
+        return busy
+
+    def _accept(self, now):
+        while len(self.conns) < HTTP_MAX_CONNS:
+            try:
+                s, _ = self.sock.accept()
+            except OSError:
+                return
+            s.setblocking(False)
+            self.conns[s] = HttpConn(s, self.pool.pop(), self.tx_pool.pop(), now)
+            self.poller.register(s, select.POLLIN)
+
+    def _read(self, c, now):
+        try:
+            n = c.sock.readinto(c.rxv[c.end:])
+        except OSError:
+            self._drop(c)
+            return
+        if n is None:
+            return  # nothing yet (EAGAIN)
+        if not n:
+            self._drop(c)
+            return
+        c.last = now
+        c.end += n
+        status = c.parse()
+        if not status:
+            if c.end < len(c.rx):
+                return
+            status = 413  # buffer full without a complete request
+        self.poller.modify(c.sock, select.POLLOUT)
+        if status == 200:
+            self.served += 1
+            print("Request:", c.path, c.query)
+            try:
+                c.route(c, self.get_state)
+            except Exception as e:
+                print("Client handling error:", e)
+                try:
+                    sys.print_exception(e)
+                except Exception:
+                    pass
+        else:
+            self.rejected += 1
+            c.sendall("HTTP/1.1 {} {}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".format(
+                status, HTTP_REASONS[status]).encode())
+        self.pool.append(c.rx)  # the handler has read the body; the buffer goes to the next connection
+        c.rx = None
+        self._write(c, now)  # most responses fit the socket buffer; no need to wait a pass
+
+    def _write(self, c, now):
+        while True:
+            if c.out is None:
+                c.fill()
+                if c.out is None:
+                    self._done(c)
+                    return
+            try:
+                k = c.sock.send(c.out)
+            except OSError as e:
+                if e.args[0] != errno.EAGAIN:
+                    self._drop(c)
+                return
+            c.last = now
+            if k < len(c.out):
+                c.out = c.out[k:]
+                return  # socket full; POLLOUT brings us back
+            c.out = None
+
+    def _done(self, c):
+        self._release(c)
+        if c.then is None:
+            c.close()
+        else:
+            c.then(c.sock)
+
+    def _drop(self, c):
+        self._release(c)
+        c.close()
+
+    def _release(self, c):
+        # forget the connection and take its buffers back; the socket is closed or handed on by the caller
+        self.poller.unregister(c.sock)
+        del self.conns[c.sock]
+        if c.rx is not None:
+            self.pool.append(c.rx)
+            c.rx = None
+        self.tx_pool.append(c.tx)
+        c.tx = None
+        c.out = None
+
+    def status(self):
+        return "{} open, {} served, {} rejected, {} timed out".format(
+            len(self.conns), self.served, self.rejected, self.timeouts)
 
 
 def sync_time():
-    global ntp_synced
     if not ntptime:
         return False
     try:
         ntptime.settime()
-        ntp_synced = True
+        state.ntp_synced = True
         print("NTP synced")
         return True
     except Exception as e:
@@ -711,101 +2415,1281 @@ def fmt_datetime(ts=None):
     return "{:02d}-{:02d} {:02d}:{:02d}:{:02d}".format(tm[1], tm[2], tm[3], tm[4], tm[5])
 
 
-def send_temp(temp_c):
-    global last_send_status
-    if urequests is None:
-        last_send_status = "urequests missing"
-        return
-    try:
-        temp_path = UPLOAD_TEMP_PATH.replace("%2F", "/").replace("%252F", "/")
-        url = "http://{}/{}?devid={}&temp={:.1f}&kfactor={}".format(
-            UPLOAD_HOST, temp_path, UPLOAD_DEVICE_ID, temp_c, KFACTOR)
-        print("Send temp ->", url)
-        r = urequests.get(url)
-        last_send_status = "OK " + str(r.status_code)
+# ---------------- Upload queue + worker ----------------
+class UploadQueue:
+    """Bounded FIFO between the tasks that produce readings and the upload worker."""
+
+    def __init__(self, size):
+        self.items = []
+        self.size = size
+        self.event = asyncio.Event()
+        self.dropped = 0
+        self.coalesced = 0
+        self.sent = 0
+        self.failed = 0
+        self.inflight_since = None
+        self.last_ms = 0
+        self.first_ms = 0
+
+    def put(self, item):
+        if not self.items:
+            self.first_ms = time.ticks_ms()
+        if len(self.items) >= self.size:
+            victim = 0
+            coalesce = False
+            if UPLOAD_OVERFLOW == "coalesce" and item[0] == "C":
+                # counter totals are cumulative: the new event supersedes the oldest queued one
+                for i in range(len(self.items)):
+                    if self.items[i][0] == "C" and self.items[i][4] == item[4]:
+                        victim = i
+                        coalesce = True
+                        break
+            if coalesce:
+                self.coalesced += 1
+            else:
+                self.dropped += 1
+            self.items.pop(victim)
+        self.items.append(item)
+        self.event.set()
+
+    def take(self, n):
+        # oldest n items; what is left counts its age from now
+        batch = self.items[:n]
+        self.items = self.items[n:]
+        self.first_ms = time.ticks_ms()
+        return batch
+
+    def age_ms(self, now):
+        return time.ticks_diff(now, self.first_ms) if self.items else 0
+
+    async def wait(self, timeout_ms):
+        if self.items:
+            return
+        self.event.clear()
         try:
-            print("Temp response:", r.text)
+            await asyncio.wait_for(self.event.wait(), timeout_ms / 1000)
+        except asyncio.TimeoutError:
+            pass
+
+    def status(self):
+        if self.inflight_since is not None:
+            flight = "in flight {} ms".format(time.ticks_diff(time.ticks_ms(), self.inflight_since))
+        else:
+            flight = "last {} ms".format(self.last_ms)
+        return "{}/{} queued, {}, sent {}, failed {}, dropped {}, coalesced {}".format(
+            len(self.items), self.size, flight, self.sent, self.failed, self.dropped, self.coalesced)
+
+
+upload_q = UploadQueue(UPLOAD_QUEUE_MAX)
+
+# binary upload frame; upload_decoder.py is the reference decoder
+_FRAME_HDR = "<BBIIHB"    # version, records, devid FNV-1a hash, frame seq, kfactor, pdid length (pdid follows)
+_FRAME_HDR_LEN = 13
+_FRAME_REC = "<BBIiIH"    # kind, counter channel, captured unix ts, a, b, c
+_FRAME_REC_LEN = 16
+
+# flash record files (upload spool, counter journal) and the RTC counter mirror
+def presize(f, rec_len, records):
+    # write the file at full size once, 16 records at a time, so appends never grow it
+    blank = bytes(rec_len * 16)
+    for _ in range(records // 16):
+        f.write(blank)
+    if records % 16:
+        f.write(memoryview(blank)[:rec_len * (records % 16)])
+
+
+def crc_seal(rec, at):
+    # crc16 over the record with its crc field (rec[at:at + 2], little-endian) zeroed, then stored there
+    rec[at] = 0
+    rec[at + 1] = 0
+    crc = modbus_crc(rec)
+    rec[at] = crc & 0xFF
+    rec[at + 1] = crc >> 8
+    return crc
+
+
+def crc_check(rec, at):
+    # True when the stored crc matches; rec must be writable (a bad crc field is overwritten)
+    return (rec[at] | (rec[at + 1] << 8)) == crc_seal(rec, at)
+
+
+_SPOOL_HDR = "<4sII"      # magic, write seq, read seq
+_SPOOL_HDR_LEN = 12
+_SPOOL_REC = "<BBHIiii"   # kind, counter channel, crc16, captured unix ts, three values
+_SPOOL_REC_LEN = 20
+
+
+class Spool:
+    """Fixed-size record ring in one pre-sized flash file, drained oldest first."""
+
+    def __init__(self, path, records):
+        self.path = path
+        self.records = records
+        self.wr = 0
+        self.rd = 0
+        self.pending = []
+        self.hdr_dirty = False
+        self.last_flush = time.ticks_ms()
+        self.overwritten = 0
+        self.writes = 0
+        self.peek_end = 0   # seq just past the last peek(); pop() releases up to it
+        self._open()
+
+    def _open(self):
+        try:
+            with open(self.path, "rb") as f:
+                magic, wr, rd = struct.unpack(_SPOOL_HDR, f.read(_SPOOL_HDR_LEN))
+            if magic == b"SPL1" and 0 <= wr - rd <= self.records:
+                self.wr = wr
+                self.rd = rd
+                print("Spool: {} record(s) waiting".format(wr - rd))
+                return
         except Exception:
             pass
-        r.close()
-    except Exception as e:
-        last_send_status = "ERR " + str(e)
+        self._create()
+
+    def _create(self):
+        # an empty ring at full size; if the filesystem refuses, flush() logs its failed writes
+        # and the next peek() tries again
+        self.wr = self.rd = self.peek_end = 0
+        try:
+            with open(self.path, "wb") as f:
+                f.write(struct.pack(_SPOOL_HDR, b"SPL1", 0, 0))
+                presize(f, _SPOOL_REC_LEN, self.records)
+        except OSError as e:
+            print("Spool create failed:", e)
+
+    def count(self):
+        return self.wr - self.rd + len(self.pending)
+
+    def append(self, item):
+        self.pending.append(item)
+        if len(self.pending) >= SPOOL_BATCH:
+            self.flush()
+
+    def _pack(self, item):
+        if item[0] == "T":
+            ch, a, b, c = 0, int(round(item[1] * 100)), KFACTOR, 0
+        else:
+            ch, a, b, c = item[4], item[1], item[2], item[3]
+        rec = bytearray(struct.pack(_SPOOL_REC, ord(item[0]), ch, 0, item[-1], a, b, c))
+        crc_seal(rec, 2)
+        return rec
+
+    def flush(self):
+        if not self.pending and not self.hdr_dirty:
+            return
+        try:
+            with open(self.path, "r+b") as f:
+                for item in self.pending:
+                    f.seek(_SPOOL_HDR_LEN + (self.wr % self.records) * _SPOOL_REC_LEN)
+                    f.write(self._pack(item))
+                    self.wr += 1
+                if self.wr - self.rd > self.records:
+                    self.overwritten += self.wr - self.rd - self.records
+                    self.rd = self.wr - self.records
+                f.seek(0)
+                f.write(struct.pack(_SPOOL_HDR, b"SPL1", self.wr, self.rd))
+            self.writes += 1
+        except Exception as e:
+            print("Spool write failed:", e)
+        self.pending = []
+        self.hdr_dirty = False
+        self.last_flush = time.ticks_ms()
+
+    def tick(self, now):
+        # bounded write rate: buffered records and read progress go to flash together
+        if (self.pending or self.hdr_dirty) and time.ticks_diff(now, self.last_flush) >= SPOOL_FLUSH_MS:
+            self.flush()
+
+    def peek(self, n=1):
+        # up to n oldest records as queue items (with their capture time);
+        # torn or corrupt records are skipped and released by the next pop()
+        if self.wr == self.rd and self.pending:
+            self.flush()
+        items = []
+        seq = self.rd
+        try:
+            with open(self.path, "rb") as f:
+                while seq != self.wr and len(items) < n:
+                    f.seek(_SPOOL_HDR_LEN + (seq % self.records) * _SPOOL_REC_LEN)
+                    rec = bytearray(f.read(_SPOOL_REC_LEN))
+                    seq += 1
+                    if len(rec) != _SPOOL_REC_LEN or not crc_check(rec, 2):
+                        continue
+                    kind, ch, _, ts, a, b, c = struct.unpack(_SPOOL_REC, rec)
+                    if kind == ord("T"):
+                        items.append(("T", a / 100, ts))
+                    else:
+                        items.append(("C", a, b, c, ch, ts))
+        except OSError as e:
+            # file gone or unreadable: what it held is lost, start an empty ring
+            print("Spool read failed ({} record(s) lost):".format(self.wr - self.rd), e)
+            self._create()
+            return []
+        self.peek_end = seq
+        return items
+
+    def pop(self):
+        # release everything the last peek() covered; a flush() during the send may already have
+        # moved rd past it (ring overflow), and then nothing after rd may be skipped
+        if self.peek_end - self.rd > 0:
+            self.rd = self.peek_end
+        self.hdr_dirty = True
+
+
+spool = None
 
 
-def send_counter(qty, accm, cpm):
-    if urequests is None:
+def send_temp(temp_c):
+    # only enqueues; upload_worker() does the network I/O. ts is the capture time.
+    upload_q.put(("T", temp_c, int(time.time()) + EPOCH_OFFSET))
+
+
+def send_counter(qty, accm, cpm, ch=0):
+    upload_q.put(("C", qty, accm, cpm, ch, int(time.time()) + EPOCH_OFFSET))
+
+
+class TxBuffer:
+    """Preallocated output buffer that requests and packets are formatted into."""
+
+    def __init__(self, size, rx_size):
+        self.tx = bytearray(size)
+        self.txv = memoryview(self.tx)
+        self.rx = bytearray(rx_size)
+        self.rxv = memoryview(self.rx)
+        self.n = 0
+        self._enc = {}  # config strings, encoded once
+        self._hash = (None, 0)
+        self.bytes = 0
+
+    def enc(self, s):
+        if isinstance(s, str):
+            b = self._enc.get(s)
+            if b is None:
+                if len(self._enc) >= 16:
+                    self._enc = {}
+                b = self._enc[s] = s.encode()
+            return b
+        return s
+
+    def put(self, s):
+        s = self.enc(s)
+        end = self.n + len(s)
+        if end > len(self.tx):
+            raise OSError("request too large")
+        self.tx[self.n:end] = s
+        self.n = end
+
+    def put_int(self, v):
+        if v < 0:
+            self.put(b"-")
+            v = -v
+        i = self.n
+        while True:
+            if self.n >= len(self.tx):
+                raise OSError("request too large")
+            self.tx[self.n] = 48 + v % 10
+            self.n += 1
+            v //= 10
+            if not v:
+                break
+        j = self.n - 1  # digits went in least significant first
+        while i < j:
+            self.tx[i], self.tx[j] = self.tx[j], self.tx[i]
+            i += 1
+            j -= 1
+
+    def put_fixed1(self, v):
+        # "{:.1f}" itself: scaling and round() would round some halves differently (0.05 -> 0.0);
+        # one small string per temperature reading, bypassing the enc() cache
+        self.put("{:.1f}".format(v).encode())
+
+    def device_hash(self):
+        # FNV-1a of the device id, recomputed only when the id changes
+        if self._hash[0] != UPLOAD_DEVICE_ID:
+            h = 0x811C9DC5
+            for b in UPLOAD_DEVICE_ID.encode():
+                h = ((h ^ b) * 0x01000193) & 0xFFFFFFFF
+            self._hash = (UPLOAD_DEVICE_ID, h)
+        return self._hash[1]
+
+    def put_frame(self, items):
+        # header, pdid, then one fixed-size record per reading:
+        # T: a = temp * 100, b = c = 0; C: a = qty, b = accm, c = cpm, plus the counter channel
+        pdid = self.enc(UPLOAD_PDID)
+        if self.n + _FRAME_HDR_LEN + len(pdid) + _FRAME_REC_LEN * len(items) > len(self.tx):
+            raise OSError("request too large")
+        struct.pack_into(_FRAME_HDR, self.tx, self.n, 2, len(items), self.device_hash(),
+                         state.frame_seq, KFACTOR, len(pdid))
+        state.frame_seq = (state.frame_seq + 1) & 0xFFFFFFFF
+        self.n += _FRAME_HDR_LEN
+        self.put(pdid)
+        for item in items:
+            if item[0] == "T":
+                struct.pack_into(_FRAME_REC, self.tx, self.n, 84, 0, item[-1], int(round(item[1] * 100)), 0, 0)
+            else:
+                struct.pack_into(_FRAME_REC, self.tx, self.n, 67, item[4], item[-1], item[1], item[2], min(item[3], 0xFFFF))
+            self.n += _FRAME_REC_LEN
+
+
+class HttpClient(TxBuffer):
+    """Keep-alive HTTP/1.1 connection to the ingest host.
+
+    Requests are built in a preallocated buffer and responses are parsed and
+    drained through another one, so steady uploads do not churn the heap."""
+
+    BODY = 320  # POST bodies are built from here; request line + headers go below
+
+    def __init__(self, size=2048):
+        super().__init__(size, 512)
+        self.head_len = 0
+        self.body_len = 0
+        self.start = 0  # unread window of rx
+        self.end = 0
+        self.reader = None
+        self.writer = None
+        self.host = None
+        self.idle_since = 0
+        self.connects = 0
+        self.requests = 0
+        self.reused = 0
+
+    def head(self, host, body_len, ctype=b"application/x-www-form-urlencoded"):
+        self.put(b" HTTP/1.1\r\nHost: ")
+        self.put(host)
+        if body_len:
+            self.put(b"\r\nContent-Type: ")
+            self.put(ctype)
+            self.put(b"\r\nContent-Length: ")
+            self.put_int(body_len)
+        self.put(b"\r\n\r\n")
+        if body_len and self.n > self.BODY:
+            raise OSError("request too large")
+        self.head_len = self.n
+        self.body_len = body_len
+
+    # -- connection --
+    async def _connect(self, host):
+        name, port = host, 80
+        if ":" in host:
+            name, port = host.split(":", 1)
+            port = int(port)
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(name, port),
+                                                          UPLOAD_CONNECT_TIMEOUT_MS / 1000)
+        self.host = host
+        self.connects += 1
+
+    def close(self):
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            except Exception:
+                pass
+        self.reader = None
+        self.writer = None
+
+    async def send(self, host):
+        # sends the built request and returns the status code
+        for _ in range(2):
+            fresh = (self.writer is None or self.host != host or
+                     time.ticks_diff(time.ticks_ms(), self.idle_since) >= UPLOAD_KEEPALIVE_MS)
+            if fresh:
+                self.close()
+                await self._connect(host)
+            else:
+                self.reused += 1
+            self.start = self.end = 0
+            try:
+                self.writer.write(self.txv[:self.head_len])
+                if self.body_len:
+                    self.writer.write(self.txv[self.BODY:self.BODY + self.body_len])
+                await asyncio.wait_for(self.writer.drain(), UPLOAD_READ_TIMEOUT_MS / 1000)
+                self.bytes += self.head_len + self.body_len
+                status = await self._response()
+            except Exception:
+                self.close()
+                if fresh or self.end:
+                    raise
+                continue  # the host dropped the idle connection before answering: retry on a new one
+            self.requests += 1
+            self.idle_since = time.ticks_ms()
+            return status
+
+    # -- response parsing --
+    async def _fill(self):
+        # compact the unread window to the front of rx and read more after it; 0 at EOF
+        if self.start:
+            n = self.end - self.start
+            self.rx[:n] = self.rxv[self.start:self.end]
+            self.start = 0
+            self.end = n
+        if self.end >= len(self.rx):
+            raise OSError("response header too long")
+        n = await asyncio.wait_for(self.reader.readinto(self.rxv[self.end:]), UPLOAD_READ_TIMEOUT_MS / 1000)
+        self.end += n or 0
+        return n
+
+    async def _line(self):
+        # index of the CR that ends the line at self.start
+        i = self.start
+        while True:
+            while i + 1 < self.end:
+                if self.rx[i] == 13 and self.rx[i + 1] == 10:
+                    return i
+                i += 1
+            off = i - self.start
+            if not await self._fill():
+                raise OSError("connection closed")
+            i = self.start + off
+
+    async def _skip(self, n):
+        # discard n body bytes, or everything up to EOF when n < 0
+        while n:
+            avail = self.end - self.start
+            if avail:
+                take = avail if n < 0 or avail < n else n
+                self.start += take
+                if n > 0:
+                    n -= take
+                continue
+            self.start = self.end = 0
+            if not await self._fill():
+                if n < 0:
+                    return
+                raise OSError("connection closed")
+
+    async def _response(self):
+        j = await self._line()
+        if j - self.start < 12:
+            raise OSError("bad status line")
+        keep = self.rx[self.start + 7] == 49  # HTTP/1.1
+        status = parse_int(self.rx, self.start + 9, j, 10)
+        self.start = j + 2
+        length = -1
+        chunked = False
+        while True:
+            j = await self._line()
+            if j == self.start:
+                self.start = j + 2
+                break
+            i = hdr_at(self.rx, self.start, j, b"content-length:")
+            if i:
+                length = parse_int(self.rx, i, j, 10)
+            elif hdr_at(self.rx, self.start, j, b"transfer-encoding:"):
+                chunked = True
+            else:
+                i = hdr_at(self.rx, self.start, j, b"connection:")
+                if i and (self.rx[i] | 0x20) == 99:  # "close"
+                    keep = False
+            self.start = j + 2
+        if chunked:
+            while True:
+                j = await self._line()
+                size = parse_int(self.rx, self.start, j, 16)
+                self.start = j + 2
+                if not size:
+                    break
+                await self._skip(size + 2)
+            while True:  # trailers end with an empty line
+                j = await self._line()
+                done = j == self.start
+                self.start = j + 2
+                if done:
+                    break
+        elif length >= 0:
+            await self._skip(length)
+        else:
+            await self._skip(-1)
+            keep = False
+        if not keep:
+            self.close()
+        return status
+
+    def status(self):
+        return "{} connects, {} requests, {} reused, {} bytes out".format(
+            self.connects, self.requests, self.reused, self.bytes)
+
+
+http_client = HttpClient()
+
+
+class MqttClient(TxBuffer):
+    """MQTT 3.1.1 publisher on one persistent connection.
+
+    The session is kept (clean session off), QoS 1 messages stay in a bounded
+    window until their PUBACK arrives and are re-sent with DUP after a reconnect,
+    and PINGREQ keeps the link alive when there is nothing to publish."""
+
+    HDR = 5  # packets are built from here; the fixed header is written in front
+
+    def __init__(self):
+        super().__init__(512, 64)
+        self.reader = None
+        self.writer = None
+        self.task = None
+        self.event = asyncio.Event()
+        self.inflight = {}  # packet id -> queue item awaiting PUBACK
+        self.pid = 0
+        self.last_rx = 0
+        self.last_tx = 0
+        self.connects = 0
+        self.published = 0
+        self.acked = 0
+
+    def connected(self):
+        return self.writer is not None
+
+    def close(self):
+        if self.task is not None and self.task is not asyncio.current_task():
+            self.task.cancel()
+        self.task = None
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            except Exception:
+                pass
+        self.reader = None
+        self.writer = None
+        self.event.set()  # wake publishers waiting for window space
+
+    def abandon(self):
+        # give up on unacknowledged messages (they go back to the spool)
+        items = list(self.inflight.values())
+        self.inflight = {}
+        return items
+
+    # -- packet building --
+    def put_u16(self, v):
+        self.put(b"\0\0")
+        self.tx[self.n - 2] = v >> 8
+        self.tx[self.n - 1] = v & 0xFF
+
+    def put_str(self, s):
+        s = self.enc(s)
+        self.put_u16(len(s))
+        self.put(s)
+
+    async def _send(self, kind):
+        # remaining length is known once the body is built; prepend the fixed header
+        n = self.n - self.HDR
+        i = self.HDR - (2 if n < 128 else 3)
+        self.tx[i] = kind
+        j = i + 1
+        while True:
+            b = n & 0x7F
+            n >>= 7
+            self.tx[j] = b | 0x80 if n else b
+            j += 1
+            if not n:
+                break
+        self.writer.write(self.txv[i:self.n])
+        await asyncio.wait_for(self.writer.drain(), UPLOAD_READ_TIMEOUT_MS / 1000)
+        self.last_tx = time.ticks_ms()
+        self.bytes += self.n - i
+
+    # -- receiving --
+    async def _read(self, n):
+        i = 0
+        while i < n:
+            r = await self.reader.readinto(self.rxv[i:n])
+            if not r:
+                raise OSError("connection closed")
+            i += r
+
+    async def _recv(self):
+        # one packet; returns (type byte, body length kept in rx)
+        await self._read(1)
+        kind = self.rx[0]
+        n = 0
+        shift = 0
+        while True:
+            await self._read(1)
+            n |= (self.rx[0] & 0x7F) << shift
+            shift += 7
+            if not self.rx[0] & 0x80:
+                break
+        if n > len(self.rx):
+            # nothing we expect is this long: discard it
+            while n:
+                k = min(n, len(self.rx))
+                await self._read(k)
+                n -= k
+            return kind, 0
+        if n:
+            await self._read(n)
+        self.last_rx = time.ticks_ms()
+        return kind, n
+
+    async def _reader(self):
+        try:
+            while True:
+                kind, n = await self._recv()
+                if kind >> 4 == 4 and n >= 2:  # PUBACK
+                    if self.inflight.pop(self.rx[0] << 8 | self.rx[1], None) is not None:
+                        self.acked += 1
+                        self.event.set()
+                # PINGRESP only refreshes last_rx
+        except asyncio.CancelledError:
+            return
+        except Exception as e:
+            print("MQTT read:", e)
+        self.task = None
+        self.close()
+
+    # -- session --
+    async def connect(self):
+        self.close()
+        host = MQTT_HOST or UPLOAD_HOST.split(":")[0]
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(host, MQTT_PORT),
+                                                          UPLOAD_CONNECT_TIMEOUT_MS / 1000)
+        try:
+            flags = 0  # clean session off: the broker keeps our session across reconnects
+            if MQTT_USER:
+                flags |= 0x80
+                if MQTT_PASS:
+                    flags |= 0x40
+            self.n = self.HDR
+            self.put(b"\0\x04MQTT\x04")
+            self.put(b"\0")
+            self.tx[self.n - 1] = flags
+            self.put_u16(MQTT_KEEPALIVE_S)
+            self.put_str(UPLOAD_DEVICE_ID)
+            if MQTT_USER:
+                self.put_str(MQTT_USER)
+                if MQTT_PASS:
+                    self.put_str(MQTT_PASS)
+            await self._send(0x10)
+            kind, n = await asyncio.wait_for(self._recv(), UPLOAD_READ_TIMEOUT_MS / 1000)
+            if kind != 0x20 or n < 2 or self.rx[1]:
+                raise OSError("CONNACK refused ({})".format(self.rx[1] if n >= 2 else "?"))
+        except Exception:
+            self.close()
+            raise
+        self.connects += 1
+        self.task = asyncio.create_task(self._reader())
+        for pid in list(self.inflight):
+            await self._publish(self.inflight[pid], pid, True)
+
+    async def tick(self, now):
+        # keepalive: ping at half the interval, give up after 1.5 intervals of silence
+        if self.writer is None:
+            return
+        if time.ticks_diff(now, self.last_rx) > MQTT_KEEPALIVE_S * 1500:
+            print("MQTT: keepalive timeout")
+            self.close()
+        elif time.ticks_diff(now, self.last_tx) >= MQTT_KEEPALIVE_S * 500:
+            self.n = self.HDR
+            try:
+                await self._send(0xC0)
+            except Exception as e:
+                # a dead link: drop the session; the next publish reconnects
+                print("MQTT ping:", e)
+                self.close()
+
+    # -- publishing --
+    async def _publish(self, item, pid, dup=False):
+        self.n = self.HDR
+        # topic: <prefix>/<devid>/temp or <prefix>/<devid>/<pdid>/counter
+        self.put_u16(0)
+        start = self.n
+        self.put(MQTT_TOPIC)
+        self.put(b"/")
+        self.put(UPLOAD_DEVICE_ID)
+        if item[0] == "T":
+            self.put(b"/temp")
+        else:
+            self.put(b"/")
+            self.put(UPLOAD_PDID)
+            self.put(b"/counter")
+        length = self.n - start
+        self.tx[start - 2] = length >> 8
+        self.tx[start - 1] = length & 0xFF
+        if pid:
+            self.put_u16(pid)
+        if UPLOAD_ENCODING == "binary":
+            self.put_frame((item,))
+            await self._send(0x30 | (0x02 if pid else 0) | (0x08 if dup else 0))
+            return
+        if item[0] == "T":
+            self.put(b'{"temp":')
+            self.put_fixed1(item[1])
+            self.put(b',"kfactor":')
+            self.put_int(KFACTOR)
+        else:
+            self.put(b'{"qty":')
+            self.put_int(item[1])
+            self.put(b',"accm":')
+            self.put_int(item[2])
+            self.put(b',"cpm":')
+            self.put_int(item[3])
+            if item[4]:
+                self.put(b',"ch":')
+                self.put_int(item[4])
+        self.put(b',"ts":')
+        self.put_int(item[-1])
+        self.put(b"}")
+        await self._send(0x30 | (0x02 if pid else 0) | (0x08 if dup else 0))
+
+    async def publish(self, item):
+        pid = 0
+        if MQTT_QOS:
+            while len(self.inflight) >= MQTT_INFLIGHT:
+                if self.writer is None:
+                    raise OSError("MQTT disconnected")
+                self.event.clear()
+                await asyncio.wait_for(self.event.wait(), UPLOAD_READ_TIMEOUT_MS / 1000)
+            while True:
+                self.pid = self.pid % 0xFFFF + 1
+                if self.pid not in self.inflight:
+                    break
+            pid = self.pid
+            self.inflight[pid] = item
+        if self.writer is None:
+            raise OSError("MQTT disconnected")
+        await self._publish(item, pid)
+        self.published += 1
+
+    def status(self):
+        return "{}, {} connects, {} published, {} acked, {} in flight, {} bytes out".format(
+            "connected" if self.writer is not None else "down",
+            self.connects, self.published, self.acked, len(self.inflight), self.bytes)
+
+
+mqtt_client = MqttClient()
+
+
+def upload_request(c, item, replay=False):
+    c.n = 0
+    c.put(b"GET /")
+    if item[0] == "T":
+        c.put(UPLOAD_TEMP_PATH)
+        c.put(b"?devid=")
+        c.put(UPLOAD_DEVICE_ID)
+        c.put(b"&temp=")
+        c.put_fixed1(item[1])
+        c.put(b"&kfactor=")
+        c.put_int(KFACTOR)
+    else:
+        c.put(UPLOAD_COUNTER_PATH)
+        c.put(b"?devid=")
+        c.put(UPLOAD_DEVICE_ID)
+        c.put(b"&pdid=")
+        c.put(UPLOAD_PDID)
+        c.put(b"&qty=")
+        c.put_int(item[1])
+        c.put(b"&accm=")
+        c.put_int(item[2])
+        c.put(b"&cpm=")
+        c.put_int(item[3])
+        if item[4]:
+            c.put(b"&ch=")
+            c.put_int(item[4])
+    if replay:
+        # spooled readings carry their capture time (Unix seconds)
+        c.put(b"&ts=")
+        c.put_int(item[-1])
+    c.head(UPLOAD_HOST, 0)
+
+
+def bulk_request(c, items):
+    # one row per reading, each with its capture time: C,ts,qty,accm,cpm[,ch] / T,ts,temp
+    c.n = c.BODY
+    if UPLOAD_ENCODING == "binary":
+        c.put_frame(items)
+        body_len = c.n - c.BODY
+        c.n = 0
+        c.put(b"POST /")
+        c.put(UPLOAD_BULK_PATH)
+        c.head(UPLOAD_HOST, body_len, b"application/octet-stream")
         return
+    c.put(b"devid=")
+    c.put(UPLOAD_DEVICE_ID)
+    c.put(b"&pdid=")
+    c.put(UPLOAD_PDID)
+    c.put(b"&kfactor=")
+    c.put_int(KFACTOR)
+    c.put(b"&n=")
+    c.put_int(len(items))
+    c.put(b"&d=")
+    for i in range(len(items)):
+        item = items[i]
+        if i:
+            c.put(b";")
+        c.put(b"T," if item[0] == "T" else b"C,")
+        c.put_int(item[-1])
+        c.put(b",")
+        if item[0] == "T":
+            c.put_fixed1(item[1])
+        else:
+            c.put_int(item[1])
+            c.put(b",")
+            c.put_int(item[2])
+            c.put(b",")
+            c.put_int(item[3])
+            if item[4]:
+                c.put(b",")
+                c.put_int(item[4])
+    body_len = c.n - c.BODY
+    c.n = 0
+    c.put(b"POST /")
+    c.put(UPLOAD_BULK_PATH)
+    c.head(UPLOAD_HOST, body_len)
+
+
+async def mqtt_send(items):
+    # publishes every item; anything the connection loss strands goes back to the spool
+    try:
+        if not mqtt_client.connected():
+            await mqtt_client.connect()
+        for item in items:
+            await mqtt_client.publish(item)
+    except Exception:
+        mqtt_client.close()
+        for item in mqtt_client.abandon():
+            if item not in items:
+                spool.append(item)
+        raise
+
+
+async def upload_send(items, replay):
+    # GET mode sends exactly one item; bulk mode sends the whole list in one POST;
+    # MQTT mode publishes each item on the persistent session
+    temp = False
+    for item in items:
+        temp = temp or item[0] == "T"
+    if UPLOAD_MODE == "get":
+        kind = "temp" if temp else "counter"
+    else:
+        kind = UPLOAD_MODE
+    upload_q.inflight_since = time.ticks_ms()
+    ok = False
     try:
-        counter_path = UPLOAD_COUNTER_PATH.replace("%2F", "/").replace("%252F", "/")
-        url = "http://{}/{}?devid={}&pdid={}&qty={}&accm={}&cpm={}".format(
-            UPLOAD_HOST, counter_path, UPLOAD_DEVICE_ID, UPLOAD_PDID, qty, accm, cpm)
-        print("Send counter ->", url)
-        r = urequests.get(url)
+        if UPLOAD_MODE == "mqtt":
+            await mqtt_send(items)
+            status = "mqtt"
+            ok = True
+        else:
+            if UPLOAD_MODE == "bulk":
+                bulk_request(http_client, items)
+            else:
+                upload_request(http_client, items[0], replay)
+            status = await http_client.send(UPLOAD_HOST)
+            # 5xx means the ingest side is not taking data right now; keep the reading
+            ok = status < 500
+        upload_q.sent += len(items)
+        if temp:
+            state.last_send_status = "OK " + str(status)
+        print("Send", kind, len(items), "->", status)
+    except Exception as e:
+        upload_q.failed += 1
+        msg = str(e) or e.__class__.__name__
+        if temp:
+            state.last_send_status = "ERR " + msg
+        print("Send {} err: {}".format(kind, msg))
+    upload_q.last_ms = time.ticks_diff(time.ticks_ms(), upload_q.inflight_since)
+    upload_q.inflight_since = None
+    return ok
+
+
+async def upload_worker():
+    global spool
+    if spool is None:
+        spool = Spool(SPOOL_FILE, SPOOL_RECORDS)
+    host_ok = True
+    next_drain = time.ticks_ms()
+    while True:
         try:
-            print("Counter response:", r.text)
+            now = time.ticks_ms()
+            spool.tick(now)
+            if UPLOAD_MODE == "mqtt":
+                await mqtt_client.tick(now)
+                batch = MQTT_INFLIGHT
+            elif UPLOAD_MODE == "bulk":
+                batch = min(UPLOAD_BATCH_SIZE, UPLOAD_QUEUE_MAX)
+            else:
+                batch = 1
+            if UPLOAD_MODE != "mqtt" and (mqtt_client.connected() or mqtt_client.inflight):
+                # switched away from MQTT: unacknowledged messages go out the new way
+                mqtt_client.close()
+                for item in mqtt_client.abandon():
+                    spool.append(item)
+            drain_due = spool.count() and time.ticks_diff(now, next_drain) >= 0
+            if upload_q.items and not drain_due:
+                if not host_ok:
+                    spool.append(upload_q.items.pop(0))
+                    continue
+                # live readings go out directly even with a backlog; both carry their capture time
+                age = upload_q.age_ms(now)
+                if UPLOAD_MODE == "bulk" and len(upload_q.items) < batch and age < UPLOAD_BATCH_MAX_MS:
+                    # bulk: hold readings until the batch fills or the oldest one is due
+                    await asyncio.sleep_ms(min(200, UPLOAD_BATCH_MAX_MS - age))
+                    continue
+                items = upload_q.take(batch)
+                host_ok = await upload_send(items, False)
+                if not host_ok:
+                    for item in items:
+                        spool.append(item)
+                    next_drain = time.ticks_add(time.ticks_ms(), SPOOL_RETRY_MS)
+            elif drain_due:
+                items = spool.peek(batch)
+                if not items:
+                    spool.pop()
+                    continue
+                host_ok = await upload_send(items, True)
+                if host_ok:
+                    spool.pop()
+                    next_drain = time.ticks_add(time.ticks_ms(), len(items) * 60_000 // max(1, SPOOL_DRAIN_PER_MIN))
+                else:
+                    next_drain = time.ticks_add(time.ticks_ms(), SPOOL_RETRY_MS)
+            else:
+                await upload_q.wait(200)
+        except Exception as e:
+            # one failed send or flash access must not end the worker (and with it run_tasks)
+            print("Upload worker error:", e)
+            await asyncio.sleep_ms(1000)
+
+
+# ---------------- Counter persistence ----------------
+_JRN_REC = "<IBBHIII"      # seq, counter channel, spare, crc16, count, accm, divider
+_JRN_REC_LEN = 20
+_CNT_RTC_HDR = "<4sIHH"    # magic, journal seq, channels, crc16; then <III per channel
+_CNT_RTC_HDR_LEN = 12
+
+
+class CounterJournal:
+    """Counter snapshots appended to pre-sized flash segments in rotation, mirrored in RTC memory."""
+
+    def __init__(self, path, segments, records):
+        self.path = path
+        self.segments = segments
+        self.records = records
+        self.seg = 0
+        self.idx = 0
+        self.seq = 0
+        self.writes = 0
+        self.last_ms = time.ticks_ms()
+        self.saved_count = array("I", [0] * PULSE_MAX_CH)   # values at the last flash append
+        self.saved_accm = array("I", [0] * PULSE_MAX_CH)
+        self.kept_count = array("I", [0] * PULSE_MAX_CH)    # values at the last RTC write
+        self.kept_accm = array("I", [0] * PULSE_MAX_CH)
+        self.rec = bytearray(_JRN_REC_LEN)
+        self.rtc_buf = bytearray(_CNT_RTC_HDR_LEN + 12 * PULSE_MAX_CH)
+        try:
+            self.rtc = machine.RTC()
         except Exception:
-            pass
-        r.close()
-    except Exception as e:
-        print("Send counter err:", e)
+            self.rtc = None
+
+    def replay(self, p):
+        # newest valid record per channel wins; writing resumes after the newest record overall
+        best = {}
+        for seg in range(self.segments):
+            name = self.path.format(seg)
+            try:
+                with open(name, "rb") as f:
+                    data = f.read()
+            except OSError:
+                data = b""
+            if len(data) != self.records * _JRN_REC_LEN:
+                with open(name, "wb") as f:
+                    presize(f, _JRN_REC_LEN, self.records)
+                continue
+            for i in range(self.records):
+                rec = bytearray(data[i * _JRN_REC_LEN:(i + 1) * _JRN_REC_LEN])
+                seq, ch, _, _, count, accm, div = struct.unpack(_JRN_REC, rec)
+                if not seq or not crc_check(rec, 6):
+                    continue  # blank or torn record
+                if seq > self.seq:
+                    self.seq = seq
+                    self.seg = seg
+                    self.idx = i + 1
+                if ch < p.n and (ch not in best or seq > best[ch][0]):
+                    best[ch] = (seq, count, accm, div)
+        for ch, (_, count, accm, div) in best.items():
+            p.count[ch] = self.saved_count[ch] = self.kept_count[ch] = count
+            p.accm[ch] = self.saved_accm[ch] = self.kept_accm[ch] = accm
+            p.divider[ch] = div
+        return len(best)
+
+    def restore(self, p):
+        # counts kept in RTC memory after the newest journal record (soft reset, watchdog)
+        if self.rtc is None:
+            return False
+        try:
+            mem = bytearray(self.rtc.memory())
+            magic, seq, n, _ = struct.unpack_from(_CNT_RTC_HDR, mem, 0)
+        except Exception:
+            return False
+        end = _CNT_RTC_HDR_LEN + 12 * n
+        if magic != b"CNT1" or seq != self.seq or n > PULSE_MAX_CH or len(mem) < end:
+            return False
+        if not crc_check(memoryview(mem)[:end], 10):
+            return False
+        moved = False
+        for ch in range(min(n, p.n)):
+            count, accm, div = struct.unpack_from("<III", mem, _CNT_RTC_HDR_LEN + 12 * ch)
+            if count != p.count[ch] or accm != p.accm[ch]:
+                moved = True
+            p.count[ch] = self.kept_count[ch] = count
+            p.accm[ch] = self.kept_accm[ch] = accm
+            p.divider[ch] = div
+        return moved
+
+    def retain(self, p, force=False):
+        # cheap per-tick copy into RTC slow memory; survives soft and watchdog resets, not power loss
+        if self.rtc is None:
+            return
+        moved = force
+        for ch in range(p.n):
+            if p.count[ch] != self.kept_count[ch] or p.accm[ch] != self.kept_accm[ch]:
+                moved = True
+                self.kept_count[ch] = p.count[ch]
+                self.kept_accm[ch] = p.accm[ch]
+        if not moved:
+            return
+        buf = self.rtc_buf
+        for ch in range(p.n):
+            struct.pack_into("<III", buf, _CNT_RTC_HDR_LEN + 12 * ch, p.count[ch], p.accm[ch], p.divider[ch])
+        struct.pack_into(_CNT_RTC_HDR, buf, 0, b"CNT1", self.seq, p.n, 0)
+        crc_seal(memoryview(buf)[:_CNT_RTC_HDR_LEN + 12 * p.n], 10)
+        try:
+            self.rtc.memory(buf)
+        except Exception as e:
+            print("RTC memory unavailable:", e)
+            self.rtc = None
+
+    def append(self, p, force=False):
+        # one record per channel that moved since the last append; every segment starts
+        # with a record for each channel, so overwriting the oldest segment loses nothing
+        chans = [ch for ch in range(p.n)
+                 if force or p.count[ch] != self.saved_count[ch] or p.accm[ch] != self.saved_accm[ch]]
+        self.last_ms = time.ticks_ms()
+        if not chans:
+            return True
+        if self.idx + len(chans) > self.records:
+            self.seg = (self.seg + 1) % self.segments
+            self.idx = 0
+        if self.idx == 0:
+            chans = range(p.n)
+        ok = True
+        try:
+            with open(self.path.format(self.seg), "r+b") as f:
+                f.seek(self.idx * _JRN_REC_LEN)
+                for ch in chans:
+                    self.seq += 1
+                    struct.pack_into(_JRN_REC, self.rec, 0, self.seq, ch, 0, 0,
+                                     p.count[ch], p.accm[ch], p.divider[ch])
+                    crc_seal(self.rec, 6)
+                    f.write(self.rec)
+                    self.idx += 1
+                    self.saved_count[ch] = p.count[ch]
+                    self.saved_accm[ch] = p.accm[ch]
+            self.writes += 1
+        except Exception as e:
+            print("Journal write failed:", e)
+            ok = False
+        self.retain(p, force=True)
+        return ok
+
+    def status(self):
+        return "seg {} rec {}/{}, seq {}, {} flash writes, RTC {}".format(
+            self.seg, self.idx, self.records, self.seq, self.writes, "on" if self.rtc else "off")
+
+
+journal = None
 
 
 def save_counters():
-    try:
-        with open(COUNTER_FILE, "w") as f:
-            f.write(str(pulse_count) + "\n")
-            f.write(str(pulse_accm) + "\n")
-            f.write(str(divider_counter) + "\n")
-        return True
-    except Exception as e:
-        print("Save counters failed:", e)
+    # immediate snapshot of every channel (counter resets)
+    if journal is None:
         return False
+    return journal.append(pulses, force=True)
 
 
 def load_counters():
-    global pulse_count, pulse_accm, divider_counter
+    global journal
+    journal = CounterJournal(JOURNAL_FILE, JOURNAL_SEGMENTS, JOURNAL_SEG_RECORDS)
     try:
-        with open(COUNTER_FILE, "r") as f:
-            lines = f.read().splitlines()
-        if len(lines) >= 1:
-            pulse_count = int(lines[0])
-        if len(lines) >= 2:
-            pulse_accm = int(lines[1])
-        if len(lines) >= 3:
-            divider_counter = int(lines[2])
-        print("Counters loaded:", pulse_count, pulse_accm, divider_counter)
+        found = journal.replay(pulses)
     except Exception as e:
-        print("No counters loaded (starting fresh):", e)
+        print("Journal replay failed:", e)
+        found = 0
+    seeded = False
+    if not found:
+        try:
+            with open(COUNTER_FILE, "r") as f:
+                lines = f.read().splitlines()
+            # three lines (count, accm, divider) per channel, primary channel first
+            for ch in range(pulses.n):
+                if len(lines) >= ch * 3 + 1:
+                    pulses.count[ch] = int(lines[ch * 3])
+                if len(lines) >= ch * 3 + 2:
+                    pulses.accm[ch] = int(lines[ch * 3 + 1])
+                if len(lines) >= ch * 3 + 3:
+                    pulses.divider[ch] = int(lines[ch * 3 + 2])
+            seeded = True
+        except Exception as e:
+            print("No counters loaded (starting fresh):", e)
+    if journal.restore(pulses):
+        print("Counters restored from RTC memory")
+        seeded = True
+    if seeded:
+        journal.append(pulses, force=True)
+    print("Counters loaded:", pulses.rows())
+
+# ---------------- Configuration store ----------------
+def _check_devices(v):
+    parse_devices(v)  # raises on a malformed table
+    return v
+
+
+CONFIG_VERSION = 2  # 1 = the positional CONFIG_LEGACY_FILE, one line per field in schema order
+# Typed settings, each stored under the name of the module-level global that holds it; the
+# values assigned at the top of this file are the defaults. Kinds: "int" (clamped to lo..hi),
+# "bool", "str" (may be blank), "text" (blank keeps the current value), "path" (text with
+# encoded slashes undone), "choice" (lo = allowed values). check(v) may normalize or raise.
+CONFIG_SCHEMA = (
+    ("wifi_mode", "choice", ("dhcp", "static"), None, None),
+    ("wifi_ssid", "text", None, None, None),
+    ("wifi_pass", "text", None, None, None),
+    ("wifi_ip", "str", None, None, None),
+    ("wifi_gateway", "str", None, None, None),
+    ("wifi_subnet", "str", None, None, None),
+    ("counter_divider", "int", 1, None, None),
+    ("counter_enabled", "bool", None, None, None),
+    ("rs485_enabled", "bool", None, None, None),
+    ("RS485_SLAVE", "int", 1, 247, None),
+    ("RS485_FUNC", "int", 3, 4, None),
+    ("RS485_REG", "int", 0, 0xFFFF, None),
+    ("RS485_COUNT", "int", 1, 125, None),
+    ("UPLOAD_HOST", "text", None, None, None),
+    ("UPLOAD_COUNTER_PATH", "path", None, None, None),
+    ("UPLOAD_TEMP_PATH", "path", None, None, None),
+    ("UPLOAD_TEMP_INTERVAL_MS", "int", 1000, None, None),
+    ("counter_send_divider", "int", 1, None, None),
+    ("UPLOAD_DEVICE_ID", "text", None, None, None),
+    ("UPLOAD_PDID", "text", None, None, None),
+    ("KFACTOR", "int", 1, 10_000, None),
+    ("RS485_MAP", "text", None, None, lambda v: regmap_text(parse_regmap(v))),
+    ("RS485_PERIOD_MS", "int", 100, None, None),
+    ("RS485_DEVICES", "str", None, None, _check_devices),
+    ("MBTCP_CACHE_TTL_MS", "int", 0, None, None),
+    ("MBTCP_ENABLED", "bool", None, None, None),
+    ("UPLOAD_OVERFLOW", "choice", ("coalesce", "drop_oldest"), None, None),
+    ("SPOOL_DRAIN_PER_MIN", "int", 1, None, None),
+    ("UPLOAD_MODE", "choice", ("get", "bulk", "mqtt"), None, None),
+    ("UPLOAD_BULK_PATH", "path", None, None, None),
+    ("UPLOAD_BATCH_SIZE", "int", 1, UPLOAD_QUEUE_MAX, None),
+    ("UPLOAD_BATCH_MAX_MS", "int", 1000, None, None),
+    ("MQTT_HOST", "str", None, None, None),
+    ("MQTT_PORT", "int", 1, 0xFFFF, None),
+    ("MQTT_TOPIC", "text", None, None, lambda v: v.strip("/") or MQTT_TOPIC),
+    ("MQTT_QOS", "int", 0, 1, None),
+    ("MQTT_USER", "str", None, None, None),
+    ("MQTT_PASS", "str", None, None, None),
+    ("MQTT_KEEPALIVE_S", "int", 5, 0xFFFF, None),
+    ("UPLOAD_ENCODING", "choice", ("text", "binary"), None, None),
+    ("PULSE_CHANNELS", "text", None, None, lambda v: PulseChannels(v).spec()),
+    # fields below were never in the positional file
+    ("RS485_BAUD", "int", 1200, 115_200, None),
+    ("MBTCP_READ_ONLY", "bool", None, None, None),
+)
+CONFIG_LEGACY_FIELDS = 41
+_config_fields = {f[0]: f for f in CONFIG_SCHEMA}
+_config_changed = set()
+_config_watchers = []
+
+# form field -> setting, for the two settings forms (checkbox fields arrive blank when off)
+UPLOAD_FORM = (
+    ("upload_host", "UPLOAD_HOST"), ("upload_counter_path", "UPLOAD_COUNTER_PATH"),
+    ("upload_temp_path", "UPLOAD_TEMP_PATH"), ("upload_temp_interval", "UPLOAD_TEMP_INTERVAL_MS"),
+    ("upload_counter_div", "counter_send_divider"), ("upload_device_id", "UPLOAD_DEVICE_ID"),
+    ("upload_pdid", "UPLOAD_PDID"), ("upload_kfactor", "KFACTOR"), ("upload_overflow", "UPLOAD_OVERFLOW"),
+    ("upload_drain", "SPOOL_DRAIN_PER_MIN"), ("upload_mode", "UPLOAD_MODE"), ("upload_encoding", "UPLOAD_ENCODING"),
+    ("upload_bulk_path", "UPLOAD_BULK_PATH"), ("upload_batch", "UPLOAD_BATCH_SIZE"),
+    ("mqtt_host", "MQTT_HOST"), ("mqtt_port", "MQTT_PORT"), ("mqtt_topic", "MQTT_TOPIC"), ("mqtt_qos", "MQTT_QOS"),
+    ("mqtt_keepalive", "MQTT_KEEPALIVE_S"), ("mqtt_user", "MQTT_USER"), ("mqtt_pass", "MQTT_PASS"),
+)
+SETTINGS_FORM = (
+    ("divider", "counter_divider"), ("pulse_channels", "PULSE_CHANNELS"),
+    ("counter_on", "counter_enabled"), ("rs485_on", "rs485_enabled"),
+    ("rs485_baud", "RS485_BAUD"), ("rs485_slave", "RS485_SLAVE"), ("rs485_func", "RS485_FUNC"),
+    ("rs485_reg", "RS485_REG"), ("rs485_count", "RS485_COUNT"), ("rs485_period", "RS485_PERIOD_MS"),
+    ("mbtcp_ttl", "MBTCP_CACHE_TTL_MS"), ("mbtcp_on", "MBTCP_ENABLED"),
+    ("mbtcp_ro", "MBTCP_READ_ONLY"),
+)
+
+
+def config_set(key, value):
+    """Coerce value to the type of setting key and assign it; False if blank-kept or rejected."""
+    _, kind, lo, hi, check = _config_fields[key]
+    g = globals()
+    if kind == "bool":
+        v = value is True or value == "1"
+    elif isinstance(value, str) and not value.strip() and kind != "str":
+        return False
+    else:
+        try:
+            if kind == "int":
+                v = int(value)
+                if lo is not None:
+                    v = max(lo, v)
+                if hi is not None:
+                    v = min(hi, v)
+            else:
+                v = str(value).strip()
+                if kind == "path":
+                    v = v.replace("%252F", "/").replace("%2F", "/")
+                elif kind == "choice" and v not in lo:
+                    raise ValueError("not one of " + "/".join(lo))
+                if check:
+                    v = check(v)
+        except Exception as e:
+            print("Setting {} rejected: {!r} ({})".format(key, value, e))
+            return False
+    if g[key] != v:
+        g[key] = v
+        _config_changed.add(key)
+    return True
+
+
+def config_watch(keys, fn):
+    # fn(changed) runs after a commit that changed any of keys
+    _config_watchers.append((keys, fn))
+
+
+def config_commit(save=True, notify=True):
+    """Write pending changes atomically, then notify the watchers of the settings that changed."""
+    changed = set(_config_changed)
+    _config_changed.clear()
+    if changed and save:
+        save_config()
+    if changed and notify:
+        for keys, fn in _config_watchers:
+            if any(k in changed for k in keys):
+                try:
+                    fn(changed)
+                except Exception as e:
+                    print("Applying settings failed:", e)
+    return changed
+
 
 def save_config():
-    global wifi_mode, wifi_ssid, wifi_pass, wifi_ip, wifi_gateway, wifi_subnet, counter_divider, counter_enabled, rs485_enabled
-    global RS485_SLAVE, RS485_FUNC, RS485_REG, RS485_COUNT
-    global UPLOAD_HOST, UPLOAD_COUNTER_PATH, UPLOAD_TEMP_PATH, UPLOAD_TEMP_INTERVAL_MS, counter_send_divider, UPLOAD_DEVICE_ID, UPLOAD_PDID, KFACTOR
+    data = {"version": CONFIG_VERSION}
+    g = globals()
+    for f in CONFIG_SCHEMA:
+        data[f[0]] = g[f[0]]
+    tmp = CONFIG_FILE + ".tmp"
     try:
         print("Saving config...")
-        print("kfactor= ",KFACTOR, " PDID= ", UPLOAD_PDID)
-        with open(CONFIG_FILE, "w") as f:
-            f.write((wifi_mode or "") + "\n")
-            f.write((wifi_ssid or "") + "\n")
-            f.write((wifi_pass or "") + "\n")
-            f.write((wifi_ip or "") + "\n")
-            f.write((wifi_gateway or "") + "\n")
-            f.write((wifi_subnet or "") + "\n")
-            f.write(str(counter_divider) + "\n")
-            f.write("1\n" if counter_enabled else "0\n")
-            f.write("1\n" if rs485_enabled else "0\n")
-            f.write(str(RS485_SLAVE) + "\n")
-            f.write(str(RS485_FUNC) + "\n")
-            f.write(str(RS485_REG) + "\n")
-            f.write(str(RS485_COUNT) + "\n")
-            f.write(UPLOAD_HOST + "\n")
-            f.write(UPLOAD_COUNTER_PATH + "\n")
-            f.write(UPLOAD_TEMP_PATH + "\n")
-            f.write(str(UPLOAD_TEMP_INTERVAL_MS) + "\n")
-            f.write(str(counter_send_divider) + "\n")
-            f.write(UPLOAD_DEVICE_ID + "\n")
-            f.write(UPLOAD_PDID + "\n")
-            f.write(str(KFACTOR) + "\n")
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        # the rename is the commit point: a power loss leaves either the old or the new file
+        try:
+            os.rename(tmp, CONFIG_FILE)
+        except OSError:
+            os.remove(CONFIG_FILE)  # no replace-on-rename here; load_config() falls back to the .tmp
+            os.rename(tmp, CONFIG_FILE)
         return True
     except Exception as e:
         print("Save config failed:", e)
@@ -813,246 +3697,321 @@ def save_config():
 
 
 def load_config():
-    global wifi_mode, wifi_ssid, wifi_pass, wifi_ip, wifi_gateway, wifi_subnet, counter_divider, counter_enabled, rs485_enabled
-    global RS485_SLAVE, RS485_FUNC, RS485_REG, RS485_COUNT
-    global UPLOAD_HOST, UPLOAD_COUNTER_PATH, UPLOAD_TEMP_PATH, UPLOAD_TEMP_INTERVAL_MS, counter_send_divider, UPLOAD_DEVICE_ID, UPLOAD_PDID, KFACTOR
-    try:
-        print("Loading config >>>>>:")
-        with open(CONFIG_FILE, "r") as f:
-            lines = f.read().splitlines()
-        if len(lines) >= 1:
-            wifi_mode = lines[0].strip() or "dhcp"
-        if len(lines) >= 2:
-            wifi_ssid = lines[1].strip() or DEFAULT_SSID
-        if len(lines) >= 3:
-            wifi_pass = lines[2].strip() or DEFAULT_PASS
-        if len(lines) >= 4:
-            wifi_ip = lines[3].strip()
-        if len(lines) >= 5:
-            wifi_gateway = lines[4].strip()
-        if len(lines) >= 6:
-            wifi_subnet = lines[5].strip()
-        if len(lines) >= 7:
-            try:
-                counter_divider = int(lines[6].strip())
-            except:
-                counter_divider = 10
-        if len(lines) >= 8:
-            counter_enabled = (lines[7].strip() == "1")
-        if len(lines) >= 9:
-            rs485_enabled = (lines[8].strip() == "1")
-        if len(lines) >= 10:
-            try:
-                RS485_SLAVE = int(lines[9].strip())
-            except:
-                RS485_SLAVE = 1
-        if len(lines) >= 11:
-            try:
-                RS485_FUNC = int(lines[10].strip())
-            except:
-                RS485_FUNC = 0x03
-        if len(lines) >= 12:
-            try:
-                RS485_REG = int(lines[11].strip())
-            except:
-                RS485_REG = 0
-        if len(lines) >= 13:
-            try:
-                RS485_COUNT = int(lines[12].strip())
-            except:
-                RS485_COUNT = 1
-        if len(lines) >= 14:
-            UPLOAD_HOST = lines[13].strip() or UPLOAD_HOST
-        if len(lines) >= 15:
-            UPLOAD_COUNTER_PATH = (lines[14].strip() or UPLOAD_COUNTER_PATH).replace("%252F", "/").replace("%2F", "/")
-        if len(lines) >= 16:
-            UPLOAD_TEMP_PATH = (lines[15].strip() or UPLOAD_TEMP_PATH).replace("%252F", "/").replace("%2F", "/")
-        if len(lines) >= 17:
-            try:
-                UPLOAD_TEMP_INTERVAL_MS = int(lines[16].strip())
-            except:
-                UPLOAD_TEMP_INTERVAL_MS = 60_000
-        if len(lines) >= 18:
-            try:
-                counter_send_divider = int(lines[17].strip())
-            except:
-                counter_send_divider = 10
-        if len(lines) >= 19:
-            UPLOAD_DEVICE_ID = lines[18].strip() or UPLOAD_DEVICE_ID
-        if len(lines) >= 20:
-            UPLOAD_PDID = lines[19].strip() or UPLOAD_PDID
-        if len(lines) >= 21:
-            try:
-                KFACTOR = int(lines[20].strip())
-            except:
-                KFACTOR = 100
-        print("Config loaded:", wifi_mode, wifi_ssid, wifi_ip, wifi_gateway, wifi_subnet,UPLOAD_PDID,KFACTOR)
-    except Exception as e:
-        print("No config loaded (using defaults):", e)
-
-
-def main():
-    global i2c, sock, last_send_ms, last_counter_send_ms, pulse_cpm, pulse_count, pulse_window_start, pulse_window_pulses, pulse_cpm_prev, has_prev_cpm, lcd_page, lcd_page_timer, counter_save_pending, counter_send_pending
-    load_config()
-    load_counters()
-    pulse_window_start = time.ticks_ms()
-    pulse_window_pulses = 0
-    pulse_cpm_prev = 0
-    has_prev_cpm = False
-    counter_send_pending = False
-    i2c = I2C(0, scl=Pin(I2C_SCL), sda=Pin(I2C_SDA), freq=400000)
-    lcd_init()
-    rs485_init()
-    pulse_init()
-
-    try:
-        ip = connect_wifi()
-        sock = create_server(ip)
-        if ntptime:
-            sync_time()
-    except Exception as exc:
-        print("Startup error:", exc)
-        lcd_print_at(0, "WiFi fail")
-        lcd_print_at(1, str(exc)[:16])
-        time.sleep(5)
-        machine.reset()
+    print("Loading config >>>>>:")
+    data = None
+    for path in (CONFIG_FILE, CONFIG_FILE + ".tmp"):
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                break
+        except Exception:
+            pass
+        data = None
+    migrate = True
+    if data is not None:
+        for f in CONFIG_SCHEMA:
+            if f[0] in data:
+                config_set(f[0], data[f[0]])
+        migrate = path != CONFIG_FILE or data.get("version") != CONFIG_VERSION
+    else:
+        try:
+            with open(CONFIG_LEGACY_FILE, "r") as f:
+                lines = f.read().splitlines()
+            for i in range(min(len(lines), CONFIG_LEGACY_FIELDS)):
+                config_set(CONFIG_SCHEMA[i][0], lines[i].strip())
+            print("Migrating", CONFIG_LEGACY_FILE, "to", CONFIG_FILE)
+        except Exception as e:
+            print("No config loaded (using defaults):", e)
+            migrate = False
+    # boot: main() brings up RS485, Wi-Fi and the counter IRQs with the loaded values
+    config_commit(save=migrate, notify=False)
+    set_pulse_channels(PULSE_CHANNELS)
+    print("Config loaded:", wifi_mode, wifi_ssid, wifi_ip, wifi_gateway, wifi_subnet, UPLOAD_PDID, KFACTOR)
+
+
+def _apply_rs485(changed):
+    if "RS485_BAUD" in changed:
+        uart.init(baudrate=RS485_BAUD)
+        modbus.set_baud(RS485_BAUD)
+    if "RS485_MAP" in changed:
+        set_regmap(RS485_MAP)
+    build_poll_table()
+    print("RS485 settings applied, baud={}".format(RS485_BAUD))
+
+
+def _apply_mqtt(changed):
+    # the broker session restarts on the next publish; HTTP notices a new host by itself
+    mqtt_client.close()
+
+
+def _apply_pulses(changed):
+    pins_changed = set_pulse_channels(PULSE_CHANNELS) if "PULSE_CHANNELS" in changed else False
+    if pins_changed or "counter_enabled" in changed:
+        # re-attach pulse IRQs when the counter is toggled or the pins change
+        pulse_init()
+
+
+config_watch(("RS485_BAUD", "RS485_SLAVE", "RS485_FUNC", "RS485_REG", "RS485_COUNT", "RS485_MAP",
+              "RS485_PERIOD_MS", "RS485_DEVICES"), _apply_rs485)
+config_watch(("UPLOAD_HOST", "MQTT_HOST", "MQTT_PORT", "MQTT_QOS", "MQTT_USER", "MQTT_PASS",
+              "MQTT_KEEPALIVE_S"), _apply_mqtt)
+config_watch(("PULSE_CHANNELS", "counter_enabled"), _apply_pulses)
+
+
+# ---------------- Tasks ----------------
+SENSOR_TICK_MS = 5     # scheduler pass while the bus is idle (1 ms while a reply is in flight)
+MBTCP_TICK_MS = 5
+CPM_TICK_MS = 250
+UPLOAD_TICK_MS = 100
+LCD_PAGE_MS = 2000
+HTTP_IDLE_MS = 20
+HTTP_MAX_CONNS = 4             # more wait in the listen backlog (same length)
+HTTP_MAX_HEADER = 1536         # request line and headers; longer is a 431
+HTTP_MAX_BODY = 2048           # form body; a longer Content-Length is a 413 before it is read
+HTTP_IDLE_TIMEOUT_MS = 10_000  # a browser that stops reading or sending loses its connection
+SSE_TICK_MS = 100         # live values reach open dashboards this fast
+SSE_DIAG_MS = 5000        # queue/spool/bus status lines change slower
+SSE_HEARTBEAT_MS = 15_000
+SSE_MAX_CLIENTS = 3
+PERSIST_TICK_MS = 500
+
+
+def get_state(diag=True):
+    # dashboard values keyed by element id; diag adds the slower-moving status lines
+    d = {
+        "status": "ok" if not state.latest_err else "error",
+        "temp": round(state.latest_temp, 1) if state.latest_temp is not None else None,
+        "err": state.latest_err,
+        "ts": fmt_datetime(state.last_ts if state.last_ts else time.time()),
+        "send": state.last_send_status,
+        "counter": counter_enabled,
+        "rs485": rs485_enabled,
+    }
+    rows = pulses.rows()
+    for ch in range(len(rows)):
+        d["ch{}".format(ch)] = rows[ch]  # name, count, accm, cpm, cpm 5 s, cpm 15 min
+    if not diag:
+        return d
+    now = time.ticks_ms()
+    devs = []
+    for dev in (poller.devices if poller else ()):
+        st = modbus.slave_stats(dev.slave)
+        devs.append((dev.name, "id {} every {}ms {:.2f}/s late {}/{}ms {} {}ms<br>rtt p50/p99 {}/{}ms timeout {}ms retry {} ({} used)".format(
+            dev.slave, dev.period_ms, poller.dev_rate(dev, now),
+            dev.late_sum_ms // dev.polls if dev.polls else 0, dev.late_max_ms,
+            "ok" if not dev.error else dev.error, dev.txn_ms,
+            st.percentile(0.5), st.percentile(0.99), st.timeout_ms(), st.retries(), st.retried)))
+    d["devices"] = devs
+    d["ip"] = state.ip
+    d["ntp"] = state.ntp_synced
+    d["regs"] = " ".join("{}={}".format(k, "-" if v is None else "{:g}".format(v)) for k, v in rs485_values.items()) or "-"
+    d["bus"] = "load {:.0f}% {:.2f} poll/s".format(poller.load() * 100, poller.rate) if poller else "-"
+    d["upload_queue"] = upload_q.status()
+    d["upload_http"] = http_client.status()
+    d["mqtt"] = mqtt_client.status() if UPLOAD_MODE == "mqtt" else "off"
+    d["spool"] = "{}/{} waiting, {} overwritten, {} flash writes".format(
+        spool.count(), spool.records, spool.overwritten, spool.writes) if spool else "-"
+    d["journal"] = journal.status() if journal else "-"
+    d["lcd_i2c"] = "{} B/s, {} B total".format(state.i2c_rate, state.i2c_bytes)
+    d["mbtcp"] = mbtcp.status() if mbtcp else "off"
+    d["http"] = web.status() if web else "-"
+    return d
+
+
+def _on_pt100(dev, now):
+    if dev.error:
+        state.latest_err = dev.error
+        state.last_ts = time.time()
+        if state.lcd_page == 0:
+            lcd_print_at(0, fmt_datetime(state.last_ts))
+            lcd_print_at(1, "Err:{}".format(dev.error[:10]))
+        print("Read error:", dev.error)
         return
+    temp_c = dev.value
+    adjusted_temp = temp_c * KFACTOR / 100.0
+    state.latest_temp = adjusted_temp
+    state.latest_err = ""
+    state.last_ts = time.time()
+    if state.lcd_page == 0:
+        lcd_print_at(0, fmt_datetime(state.last_ts))
+        lcd_print_at(1, "{:6.1f} C".format(adjusted_temp))
+    print("Temp raw: {:.1f} C adj: {:.1f} (k={}) in {} ms".format(temp_c, adjusted_temp, KFACTOR, dev.txn_ms))
+    # periodic send (enqueue only)
+    if rs485_enabled and time.ticks_diff(now, state.last_send_ms) >= UPLOAD_TEMP_INTERVAL_MS:
+        send_temp(adjusted_temp)
+        state.last_send_ms = now
+
+
+async def sensor_task():
+    last_read = 0
+    while True:
+        now = time.ticks_ms()
+        try:
+            if not rs485_enabled and time.ticks_diff(now, last_read) >= RS485_PERIOD_MS:
+                state.latest_err = "RS485 disabled"
+                state.latest_temp = None
+                if state.lcd_page == 0:
+                    lcd_print_at(0, fmt_datetime(state.last_ts if state.last_ts else time.time()))
+                    lcd_print_at(1, "RS485 disabled")
+                last_read = now
+            # due devices are polled back-to-back, replies collected on later passes
+            done = poller.tick(now)
+            if done is pt100_dev:
+                _on_pt100(done, now)
+            elif done is not None and done.error:
+                print("RS485 {} (slave {}) error: {}".format(done.name, done.slave, done.error))
+        except Exception as e:
+            print("Sensor task error:", e)
+        await asyncio.sleep_ms(1 if modbus.busy() else SENSOR_TICK_MS)
 
-    latest_temp = None
-    latest_err = ""
-    last_ts = 0
-    ip_cached = ip
-
-    def get_state():
-        return ("ok" if not latest_err else "error",
-                "{:.1f} C".format(latest_temp) if latest_temp is not None else "N/A",
-                latest_err,
-                fmt_datetime(last_ts if last_ts else time.time()),
-                last_send_status,
-                ip_cached,
-                ntp_synced,
-                pulse_count,
-                pulse_accm,
-                pulse_cpm,
-                counter_enabled,
-                rs485_enabled)
 
-    last_read = 0
-    interval = 10_000  # ms
-    lcd_print_at(0, fmt_datetime())
-    lcd_print_at(1, "Temp init...")
-    lcd_page_timer = time.ticks_ms()
+async def mbtcp_task():
+    while True:
+        try:
+            mbtcp.poll(time.ticks_ms())
+        except Exception as e:
+            print("Modbus TCP error:", e)
+        await asyncio.sleep_ms(MBTCP_TICK_MS)
+
 
+async def cpm_task():
     while True:
+        pulse_service()  # backstop for edges whose scheduled call was dropped
         now = time.ticks_ms()
-        # pulse CPM update
-        elapsed = time.ticks_diff(now, pulse_window_start)
-        if elapsed < 0:
-            elapsed = 0
-        if elapsed >= 60_000:
-            # close the window, compute CPM from that minute, show it during next minute
-            if elapsed == 0:
-                elapsed = 1
-            pulse_cpm_prev = int(pulse_window_pulses * 60_000 / elapsed)
-            pulse_cpm = pulse_cpm_prev
-            has_prev_cpm = True
-            print("Pulse window done: pulses={} accm={} cpm={}".format(pulse_window_pulses, pulse_accm, pulse_cpm))
-            pulse_window_start = now
-            pulse_window_pulses = 0
-        else:
-            # during the current minute, show live CPM only for the first minute; afterward show last full minute
-            if not has_prev_cpm:
-                live_elapsed = elapsed if elapsed > 0 else 1
-                pulse_cpm = int(pulse_window_pulses * 60_000 / live_elapsed) if pulse_window_pulses > 0 else 0
-            else:
-                pulse_cpm = pulse_cpm_prev
+        p = pulses
+        for ch in range(p.n):
+            m = p.meters[ch]
+            m.tick(now, _pulse_edges[ch])
+            p.cpm[ch] = m.cpm
+            p.cpm_5s[ch] = m.cpm_5s
+            p.cpm_15m[ch] = m.cpm_15m
+        await asyncio.sleep_ms(CPM_TICK_MS)
 
-        if counter_save_pending:
-            if save_counters():
-                counter_save_pending = False
 
-        if time.ticks_diff(now, last_read) >= interval:
-            try:
-                temp_c = read_pt100_temp()
-                if temp_c is None and not rs485_enabled:
-                    latest_err = "RS485 disabled"
-                    latest_temp = None
-                    if lcd_page == 0:
-                        lcd_print_at(0, fmt_datetime(last_ts if last_ts else time.time()))
-                        lcd_print_at(1, "RS485 disabled")
-                elif temp_c is None:
-                    latest_err = "No data"
-                    latest_temp = None
-                    if lcd_page == 0:
-                        lcd_print_at(0, fmt_datetime(last_ts if last_ts else time.time()))
-                        lcd_print_at(1, "Temp N/A")
-                else:
-                    adjusted_temp = temp_c * KFACTOR / 100.0
-                    latest_temp = adjusted_temp
-                    latest_err = ""
-                    last_ts = time.time()
-                    if lcd_page == 0:
-                        lcd_print_at(0, fmt_datetime(last_ts))
-                        lcd_print_at(1, "{:6.1f} C".format(adjusted_temp))
-                    print("Temp raw: {:.1f} C adj: {:.1f} (k={})".format(temp_c, adjusted_temp, KFACTOR))
-                    # periodic send
-                    if rs485_enabled and time.ticks_diff(now, last_send_ms) >= UPLOAD_TEMP_INTERVAL_MS:
-                        send_temp(adjusted_temp)
-                        last_send_ms = now
-            except Exception as e:
-                latest_err = str(e)
-                last_ts = time.time()
-                if lcd_page == 0:
-                    lcd_print_at(0, fmt_datetime(last_ts))
-                    lcd_print_at(1, "Err:{}".format(str(e)[:10]))
-                print("Read error:", e)
-            last_read = now
-
-        # send counter upload when pending (triggered every counter_send_divider pulses)
-        if counter_send_pending and counter_enabled:
-            try:
-                send_counter(pulse_count, pulse_accm, pulse_cpm)
-            except Exception as e:
-                print("Counter upload error:", e)
-            counter_send_pending = False
-            last_counter_send_ms = now
-
-        # LCD page toggle every 2 seconds
-        if time.ticks_diff(now, lcd_page_timer) >= 2000:
-            lcd_page_timer = now
-            lcd_page = (lcd_page + 1) % 3  # three pages: temp, counter, wifi
-            if lcd_page == 0:
-                lcd_print_at(0, fmt_datetime(last_ts if last_ts else time.time()))
-                if rs485_enabled and latest_temp is not None:
-                    lcd_print_at(1, "{:6.1f} C".format(latest_temp))
-                elif rs485_enabled and latest_temp is None:
+async def uploader_task():
+    while True:
+        # queue counter uploads when pending (triggered every send divider pulses per channel)
+        p = pulses
+        for ch in range(p.n):
+            if p.send_pending[ch] and counter_enabled:
+                send_counter(p.count[ch], p.accm[ch], p.cpm[ch], ch)
+                p.send_pending[ch] = 0
+                state.last_counter_send_ms = time.ticks_ms()
+        await asyncio.sleep_ms(UPLOAD_TICK_MS)
+
+
+async def lcd_task():
+    sent = state.i2c_bytes
+    last = time.ticks_ms()
+    while True:
+        await asyncio.sleep_ms(LCD_PAGE_MS)
+        now = time.ticks_ms()
+        state.i2c_rate = (state.i2c_bytes - sent) * 1000 // max(1, time.ticks_diff(now, last))
+        sent = state.i2c_bytes
+        last = now
+        try:
+            state.lcd_page = (state.lcd_page + 1) % (pulses.n + 2)  # temp, one page per counter channel, wifi
+            if state.lcd_page == 0:
+                lcd_print_at(0, fmt_datetime(state.last_ts if state.last_ts else time.time()))
+                if rs485_enabled and state.latest_temp is not None:
+                    lcd_print_at(1, "{:6.1f} C".format(state.latest_temp))
+                elif rs485_enabled and state.latest_temp is None:
                     lcd_print_at(1, "Temp N/A")
                 else:
                     lcd_print_at(1, "                ")  # RS485 disabled: show only datetime on page 0
-            elif lcd_page == 1:
-                lcd_print_at(0, "Q:{:4d} CPM:{:4d}".format(pulse_count, pulse_cpm))
-                if counter_enabled:
-                    lcd_print_at(1, "Accm:{:6d}".format(pulse_accm))
+            elif state.lcd_page <= pulses.n:
+                ch = state.lcd_page - 1
+                if pulses.n == 1:
+                    lcd_print_at(0, "Q:{:4d} CPM:{:4d}".format(pulses.count[ch], pulses.cpm[ch]))
                 else:
+                    lcd_print_at(0, "{:<6.6}Q:{:7d}".format(pulses.names[ch], pulses.count[ch]))
+                if not counter_enabled:
                     lcd_print_at(1, "Counter disabled")
+                elif pulses.n == 1:
+                    lcd_print_at(1, "Accm:{:6d}".format(pulses.accm[ch]))
+                else:
+                    lcd_print_at(1, "C:{:4d} A:{:7d}".format(pulses.cpm[ch], pulses.accm[ch]))
             else:
                 sig = wifi_rssi()
-                lcd_print_at(0, "IP {}".format(ip_cached or "0.0.0.0"))
+                lcd_print_at(0, "IP {}".format(state.ip or "0.0.0.0"))
                 if sig is None:
                     lcd_print_at(1, "RSSI: N/A")
                 else:
                     lcd_print_at(1, "RSSI:{:4d} dBm".format(sig))
+        except Exception as e:
+            print("LCD error:", e)
 
+
+async def http_task():
+    while True:
         try:
-            served = handle_http_once(sock, get_state)
-            if not served:
-                time.sleep_ms(20)
+            busy = web.poll(time.ticks_ms())
         except Exception as e:
             print("HTTP server error:", e)
-            time.sleep_ms(200)
+            busy = False
+            await asyncio.sleep_ms(200)
+        await asyncio.sleep_ms(0 if busy else HTTP_IDLE_MS)
 
 
-if __name__ == "__main__":
-    main()
+async def sse_task():
+    while True:
+        try:
+            events.tick(time.ticks_ms(), get_state)
+        except Exception as e:
+            print("SSE error:", e)
+        await asyncio.sleep_ms(SSE_TICK_MS)
+
+
+async def persist_task():
+    while True:
+        # counts go to RTC memory every tick and to the flash journal on a divider hit
+        # (rate-limited) or once JOURNAL_PERIOD_MS has passed since the last append
+        if journal:
+            due = time.ticks_diff(time.ticks_ms(), journal.last_ms)
+            if (state.counter_save_pending and due >= JOURNAL_MIN_MS) or due >= JOURNAL_PERIOD_MS:
+                if journal.append(pulses):
+                    state.counter_save_pending = False
+            else:
+                journal.retain(pulses)
+        await asyncio.sleep_ms(PERSIST_TICK_MS)
+
 
+async def run_tasks():
+    tasks = [sensor_task(), cpm_task(), uploader_task(), upload_worker(), lcd_task(), http_task(), sse_task(), persist_task()]
+    if mbtcp:
+        tasks.append(mbtcp_task())
+    await asyncio.gather(*tasks)
 
+
+def main():
+    global i2c, web, mbtcp
+    load_config()
+    load_counters()
+    i2c = I2C(0, scl=Pin(I2C_SCL), sda=Pin(I2C_SDA), freq=400000)
+    lcd_init()
+    rs485_init()
+    pulse_init()
+
+    try:
+        state.ip = connect_wifi()
+        web = HttpServer(create_server(state.ip), get_state)
+        if MBTCP_ENABLED:
+            mbtcp = ModbusTcpGateway(poller)
+        if ntptime:
+            sync_time()
+    except Exception as exc:
+        print("Startup error:", exc)
+        lcd_print_at(0, "WiFi fail")
+        lcd_print_at(1, str(exc)[:16])
+        time.sleep(5)
+        machine.reset()
+        return
+
+    lcd_print_at(0, fmt_datetime())
+    lcd_print_at(1, "Temp init...")
+    asyncio.run(run_tasks())
+
+
+if __name__ == "__main__":
+    main()
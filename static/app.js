@@ -0,0 +1,56 @@
+// Dashboard live values: /api/events sends the full state on connect, then only what changed.
+(function () {
+  var live = document.getElementById("live");
+  function text(v, k) {
+    if (v === null || v === undefined) return "-";
+    if (v === true || v === false) return k === "ntp" ? (v ? "yes" : "no") : (v ? "on" : "off");
+    return String(v);
+  }
+  function esc(s) {
+    return String(s).replace(/[&<>"]/g, function (c) {
+      return {"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;"}[c];
+    });
+  }
+  function pill(id, parent, title) {
+    var el = document.getElementById(id);
+    if (!el) {
+      var div = document.createElement("div");
+      div.className = "pill";
+      div.innerHTML = "<strong></strong><span class=\"mono\"></span>";
+      div.firstChild.textContent = title;
+      div.lastChild.id = id;
+      parent.appendChild(div);
+      el = div.lastChild;
+    }
+    return el;
+  }
+  function apply(d) {
+    for (var k in d) {
+      var v = d[k], el;
+      if (k === "temp") {
+        el = document.getElementById(k);
+        el.textContent = v === null ? "N/A" : v.toFixed(1) + " C";
+      } else if (k.slice(0, 2) === "ch" && k !== "chans") {
+        // name, count, accm, cpm, cpm 5 s, cpm 15 min
+        el = pill(k, document.getElementById("chans"), "Pulses " + v[0]);
+        el.innerHTML = "count " + v[1] + " accm " + v[2] + "<br>CPM " + v[3] + " (5 s " + v[4] + ", 15 min " + v[5] + ")";
+      } else if (k === "devices") {
+        var devs = document.getElementById("devs");
+        devs.innerHTML = "";
+        for (var i = 0; i < v.length; i++) {
+          pill("dev" + i, devs, v[i][0]).innerHTML = v[i][1];
+        }
+      } else if ((el = document.getElementById(k))) {
+        el.innerHTML = esc(text(v, k));
+      }
+    }
+  }
+  var es = new EventSource("/api/events");
+  es.onmessage = function (e) {
+    apply(JSON.parse(e.data));
+    live.textContent = "live, " + new Date().toLocaleTimeString();
+  };
+  es.onerror = function () {
+    live.textContent = "reconnecting...";
+  };
+})();
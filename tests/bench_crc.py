@@ -0,0 +1,31 @@
+"""Table-driven modbus_crc() against the original bit-by-bit loop.
+
+    python tests/bench_crc.py
+
+Times a typical 8-byte request and a 255-byte reply. Absolute numbers are CPython on
+the host; the ratio is what carries over to the device.
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import host  # noqa: E402
+from test_crc import crc_bitwise  # noqa: E402
+
+
+def main():
+    fw = host.load()
+    for size in (8, 255):
+        data = memoryview(bytes(range(size)))
+        n = 20_000 if size < 64 else 2_000
+        old = min(timeit.repeat(lambda: crc_bitwise(data), number=n, repeat=5)) / n
+        new = min(timeit.repeat(lambda: fw.modbus_crc(data), number=n, repeat=5)) / n
+        print("{:4d} bytes: bitwise {:7.2f} us, table {:6.2f} us, {:.1f}x".format(
+            size, old * 1e6, new * 1e6, old / new))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""HttpClient (keep-alive, preallocated buffers) against the per-upload HTTP/1.0 helper it replaced.
+
+    python tests/bench_http_client.py
+
+Sends counter GETs to a local asyncio server that answers like the ingest host (HTTP/1.1,
+Content-Length). Reports latency per request and, with tracemalloc, the peak heap each
+request takes above the idle level. Absolute numbers are CPython on loopback; on the device
+the saved TCP handshake is a network round trip.
+"""
+
+import asyncio
+import asyncio.selector_events
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import host  # noqa: E402
+
+N = 500
+RESPONSE = b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: 2\r\n\r\nOK"
+
+
+# ---------------- the helper HttpClient replaced ----------------
+def old_path(fw, item):
+    counter_path = fw.UPLOAD_COUNTER_PATH.replace("%2F", "/").replace("%252F", "/")
+    return "{}?devid={}&pdid={}&qty={}&accm={}&cpm={}".format(
+        counter_path, fw.UPLOAD_DEVICE_ID, fw.UPLOAD_PDID, item[1], item[2], item[3])
+
+
+async def old_get(fw, host_, path):
+    name, port = host_.split(":", 1)
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(name, int(port)),
+                                            fw.UPLOAD_CONNECT_TIMEOUT_MS / 1000)
+    try:
+        writer.write("GET /{} HTTP/1.0\r\nHost: {}\r\nConnection: close\r\n\r\n".format(path, host_).encode())
+        await asyncio.wait_for(writer.drain(), fw.UPLOAD_READ_TIMEOUT_MS / 1000)
+        line = await asyncio.wait_for(reader.readline(), fw.UPLOAD_READ_TIMEOUT_MS / 1000)
+        status = int(line.split()[1])
+        head = await asyncio.wait_for(reader.read(256), fw.UPLOAD_READ_TIMEOUT_MS / 1000)
+        i = head.find(b"\r\n\r\n")
+        return status, head[i + 4:] if i >= 0 else b""
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+
+
+# ---------------- ingest host stand-in ----------------
+async def serve(reader, writer):
+    try:
+        while True:
+            head = await reader.readuntil(b"\r\n\r\n")
+            writer.write(RESPONSE)
+            await writer.drain()
+            if b"HTTP/1.0" in head:
+                break
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    writer.close()
+
+
+def item(i):
+    return ("C", i, 1000 + i, 42, 0, 1_700_000_000 + i)
+
+
+async def run(label, one):
+    # latency and per-request peak heap above the level before the request
+    await one(0)  # warm up (first connect, lazy imports)
+    times = []
+    peaks = []
+    tracemalloc.start()
+    for i in range(1, N + 1):
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        t0 = time.perf_counter()
+        await one(i)
+        times.append(time.perf_counter() - t0)
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+    times.sort()
+    print("{:24s} median {:6.0f} us  p95 {:6.0f} us  peak heap/request {:6.0f} B".format(
+        label, statistics.median(times) * 1e6, times[int(N * 0.95)] * 1e6, statistics.median(peaks)))
+
+
+async def main():
+    # CPython's transports recv() 256 KB at a time, which would hide everything else in the peaks
+    asyncio.selector_events._SelectorTransport.max_size = 4096
+    fw = host.load()
+    fw.print = lambda *a, **k: None
+    server = await asyncio.start_server(serve, "127.0.0.1", 0)
+    fw.UPLOAD_HOST = "127.0.0.1:{}".format(server.sockets[0].getsockname()[1])
+
+    async def old(i):
+        status, _ = await old_get(fw, fw.UPLOAD_HOST, old_path(fw, item(i)))
+        assert status == 200
+
+    client = fw.HttpClient()
+
+    async def new(i):
+        fw.upload_request(client, item(i))
+        assert await client.send(fw.UPLOAD_HOST) == 200
+
+    await run("HTTP/1.0 per upload", old)
+    fw.UPLOAD_KEEPALIVE_MS = 0
+    await run("HttpClient, reconnect", new)
+    fw.UPLOAD_KEEPALIVE_MS = 15_000
+    await run("HttpClient, keep-alive", new)
+    print("HttpClient:", client.status())
+    client.close()
+    await asyncio.sleep(0.05)
+    server.close()
+    await server.wait_closed()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
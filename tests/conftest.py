@@ -0,0 +1,15 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import host  # noqa: E402
+
+
+@pytest.fixture
+def fw(tmp_path, monkeypatch):
+    # a fresh firmware module per test, with its flash files in a scratch directory
+    monkeypatch.chdir(tmp_path)
+    return host.load()
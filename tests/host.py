@@ -0,0 +1,265 @@
+"""Run esp32c3-rs485-pt100.py under CPython for the host tests and benchmarks.
+
+The MicroPython-only modules (machine, network, micropython) are replaced by small
+stand-ins, and time gets the ticks_* functions with the same 30-bit wrap as the ESP32
+port. mp_select() gives the HTTP server MicroPython's socket and poll behaviour.
+load() imports a fresh copy of the firmware; main() is not run.
+"""
+
+import asyncio
+import importlib.util
+import os
+import select
+import socket
+import sys
+import time
+import traceback
+import types
+
+FIRMWARE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "esp32c3-rs485-pt100.py")
+TICKS_PERIOD = 1 << 30
+
+
+# ---------------- time / asyncio ----------------
+_t0 = time.monotonic()
+
+
+def ticks_diff(a, b):
+    d = (a - b) & (TICKS_PERIOD - 1)
+    return d - TICKS_PERIOD if d & (TICKS_PERIOD >> 1) else d
+
+
+time.ticks_ms = lambda: int((time.monotonic() - _t0) * 1000) & (TICKS_PERIOD - 1)
+time.ticks_us = lambda: int((time.monotonic() - _t0) * 1_000_000) & (TICKS_PERIOD - 1)
+time.ticks_diff = ticks_diff
+time.ticks_add = lambda a, b: (a + b) & (TICKS_PERIOD - 1)
+time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+time.sleep_us = lambda us: None
+asyncio.sleep_ms = lambda ms: asyncio.sleep(ms / 1000)
+sys.print_exception = lambda e, *a: traceback.print_exception(e)
+
+
+async def _readinto(self, buf):
+    # uasyncio's StreamReader.readinto
+    data = await self.read(len(buf))
+    buf[:len(data)] = data
+    return len(data)
+
+
+asyncio.StreamReader.readinto = _readinto
+
+
+# ---------------- machine ----------------
+class Pin:
+    IN = 0
+    OUT = 1
+    PULL_DOWN = 2
+    PULL_UP = 3
+    IRQ_RISING = 1
+    IRQ_FALLING = 2
+
+    def __init__(self, *a, **k):
+        self.handler = None
+
+    def irq(self, trigger=None, handler=None, hard=False):
+        self.handler = handler
+
+    def value(self, *a):
+        return 0
+
+
+class I2C:
+    def __init__(self, *a, **k):
+        self.log = []
+
+    def writeto(self, addr, buf):
+        self.log.append(bytes(buf))
+        return len(buf)
+
+
+class UART:
+    """Loopback UART: responder(request bytes) returns the slave's reply, or None for silence."""
+
+    def __init__(self, *a, **k):
+        self.rx = bytearray()
+        self.tx = bytearray()
+        self.responder = None
+
+    def init(self, *a, **k):
+        pass
+
+    def any(self):
+        return len(self.rx)
+
+    def read(self, n=None):
+        if not self.rx:
+            return None
+        n = len(self.rx) if n is None else n
+        d = bytes(self.rx[:n])
+        del self.rx[:n]
+        return d
+
+    def readinto(self, buf, n=None):
+        if not self.rx:
+            return None
+        n = min(len(buf), len(self.rx)) if n is None else min(n, len(self.rx), len(buf))
+        buf[:n] = self.rx[:n]
+        del self.rx[:n]
+        return n
+
+    def write(self, b):
+        self.tx += b
+        if self.responder:
+            r = self.responder(bytes(b))
+            if r:
+                self.rx += r
+        return len(b)
+
+    def flush(self):
+        pass
+
+
+class RTC:
+    _mem = b""
+
+    def memory(self, data=None):
+        if data is None:
+            return RTC._mem
+        RTC._mem = bytes(data)
+
+    def datetime(self, *a):
+        return (2026, 1, 1, 0, 0, 0, 0, 0)
+
+
+def _reset():
+    raise SystemExit("machine.reset()")
+
+
+machine = types.ModuleType("machine")
+machine.Pin = Pin
+machine.I2C = I2C
+machine.UART = UART
+machine.RTC = RTC
+machine.reset = _reset
+machine.unique_id = lambda: b"\x01\x02\x03\x04\x05\x06"
+machine.disable_irq = lambda: 0
+machine.enable_irq = lambda state: None
+
+
+# ---------------- network ----------------
+class WLAN:
+    def __init__(self, *a):
+        pass
+
+    def active(self, *a):
+        return True
+
+    def isconnected(self):
+        return True
+
+    def ifconfig(self, *a):
+        return ("10.0.0.2", "255.255.255.0", "10.0.0.1", "10.0.0.1")
+
+    def config(self, *a):
+        return b"\x01\x02\x03\x04\x05\x06"
+
+    def status(self, *a):
+        return -50
+
+    def connect(self, *a):
+        pass
+
+
+network = types.ModuleType("network")
+network.STA_IF = 0
+network.WLAN = WLAN
+
+
+# ---------------- micropython ----------------
+micropython = types.ModuleType("micropython")
+micropython.schedule_queue = None  # set to a list to hold scheduled calls instead of running them
+micropython.const = lambda x: x
+micropython.native = lambda f: f
+micropython.viper = lambda f: f
+micropython.alloc_emergency_exception_buf = lambda n: None
+
+
+def _schedule(fn, arg):
+    if micropython.schedule_queue is None:
+        fn(arg)
+    else:
+        micropython.schedule_queue.append((fn, arg))
+
+
+micropython.schedule = _schedule
+
+# ---------------- socket / select (MicroPython behaviour, for the HTTP server) ----------------
+class MpSocket(socket.socket):
+    """readinto() returns None on EAGAIN, send() takes str, accept() returns the same class."""
+
+    def readinto(self, buf):
+        try:
+            return self.recv_into(buf)
+        except BlockingIOError:
+            return None
+
+    def send(self, data, *a):
+        return super().send(data.encode() if isinstance(data, str) else data, *a)
+
+    def sendall(self, data, *a):
+        return super().sendall(data.encode() if isinstance(data, str) else data, *a)
+
+    def accept(self):
+        fd, addr = self._accept()
+        s = MpSocket(self.family, self.type, self.proto, fileno=fd)
+        s.setblocking(True)
+        return s, addr
+
+
+class Poll:
+    """select.poll whose ipoll() yields the registered objects, as MicroPython's does."""
+
+    def __init__(self):
+        self.p = select.poll()
+        self.objs = {}
+
+    def register(self, obj, ev):
+        self.objs[obj.fileno()] = obj
+        self.p.register(obj, ev)
+
+    def modify(self, obj, ev):
+        self.p.modify(obj, ev)
+
+    def unregister(self, obj):
+        del self.objs[obj.fileno()]
+        self.p.unregister(obj)
+
+    def ipoll(self, timeout=-1):
+        return [(self.objs[fd], ev) for fd, ev in self.p.poll(timeout)]
+
+
+def mp_select(fw):
+    """Give fw a select module with MicroPython's poll(); returns a listening MpSocket on an ephemeral port."""
+    shim = types.ModuleType("select")
+    shim.__dict__.update({k: getattr(select, k) for k in dir(select) if k.startswith("POLL")})
+    shim.poll = Poll
+    fw.select = shim
+    s = MpSocket()
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind(("127.0.0.1", 0))
+    s.listen(8)
+    s.setblocking(False)
+    return s
+
+
+sys.modules["machine"] = machine
+sys.modules["network"] = network
+sys.modules["micropython"] = micropython
+
+
+def load():
+    """Import a fresh copy of the firmware module (files go to the current directory)."""
+    spec = importlib.util.spec_from_file_location("firmware", FIRMWARE)
+    fw = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(fw)
+    return fw
@@ -0,0 +1,113 @@
+"""In-process MQTT 3.1.1 broker stand-in for the MqttClient tests (asyncio, one port, no routing).
+
+It records what the client sends: CONNECT fields, every PUBLISH (topic, payload, QoS, DUP,
+packet id) and PINGREQs. PUBACKs can be held back (ack = False) and released later,
+and drop() cuts the current connection as a broker restart or network loss would.
+"""
+
+import asyncio
+
+
+class Broker:
+    def __init__(self):
+        self.server = None
+        self.port = 0
+        self.connects = []   # dicts: client_id, clean, keepalive, user, password
+        self.publishes = []  # (topic, payload, qos, dup, pid)
+        self.pings = 0
+        self.ack = True
+        self.answer_pings = True
+        self.held = []       # packet ids not acknowledged while ack was False
+        self.writer = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.drop()
+        self.server.close()
+        await self.server.wait_closed()
+
+    def drop(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    async def release(self):
+        # acknowledge everything held back, then ack as usual
+        self.ack = True
+        for pid in self.held:
+            self.writer.write(bytes((0x40, 2, pid >> 8, pid & 0xFF)))
+        self.held = []
+        await self.writer.drain()
+
+    async def settle(self, n, timeout=2.0):
+        # wait until n PUBLISH packets have arrived in total
+        for _ in range(int(timeout / 0.01)):
+            if len(self.publishes) >= n:
+                return
+            await asyncio.sleep(0.01)
+        raise AssertionError("{} of {} publishes arrived".format(len(self.publishes), n))
+
+    @staticmethod
+    async def _length(reader):
+        n = 0
+        shift = 0
+        while True:
+            b = (await reader.readexactly(1))[0]
+            n |= (b & 0x7F) << shift
+            shift += 7
+            if not b & 0x80:
+                return n
+
+    @staticmethod
+    def _str(body, i):
+        n = body[i] << 8 | body[i + 1]
+        return body[i + 2:i + 2 + n].decode(), i + 2 + n
+
+    async def _handle(self, reader, writer):
+        self.writer = writer
+        try:
+            while True:
+                head = (await reader.readexactly(1))[0]
+                body = await reader.readexactly(await self._length(reader))
+                kind = head >> 4
+                if kind == 1:
+                    self._connect(body)
+                    writer.write(bytes((0x20, 2, 1 if len(self.connects) > 1 else 0, 0)))
+                elif kind == 3:
+                    qos = (head >> 1) & 3
+                    topic, i = self._str(body, 0)
+                    pid = 0
+                    if qos:
+                        pid = body[i] << 8 | body[i + 1]
+                        i += 2
+                    self.publishes.append((topic, bytes(body[i:]), qos, bool(head & 0x08), pid))
+                    if qos:
+                        if self.ack:
+                            writer.write(bytes((0x40, 2, pid >> 8, pid & 0xFF)))
+                        else:
+                            self.held.append(pid)
+                elif kind == 12:
+                    self.pings += 1
+                    if self.answer_pings:
+                        writer.write(b"\xd0\x00")
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    def _connect(self, body):
+        name, i = self._str(body, 0)
+        assert name == "MQTT" and body[i] == 4, "not MQTT 3.1.1"
+        flags = body[i + 1]
+        keepalive = body[i + 2] << 8 | body[i + 3]
+        client_id, i = self._str(body, i + 4)
+        user = password = None
+        if flags & 0x80:
+            user, i = self._str(body, i)
+        if flags & 0x40:
+            password, i = self._str(body, i)
+        self.connects.append({"client_id": client_id, "clean": bool(flags & 0x02), "keepalive": keepalive,
+                              "user": user, "password": password})
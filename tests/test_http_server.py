@@ -0,0 +1,221 @@
+"""HttpServer under load: many concurrent clients, stalled clients, SSE handover, buffer pools."""
+
+import os
+import shutil
+import socket
+import threading
+import time
+
+import pytest
+
+import host
+
+STATIC = os.path.join(os.path.dirname(host.FIRMWARE), "static")
+PATHS = [b"/", b"/settings", b"/upload", b"/static/app.css", b"/api/state", b"/static/app.js"]
+
+
+class Loop:
+    """Runs the firmware's HTTP pass in a thread, as http_task would, and records the longest pass gap."""
+
+    def __init__(self, fw, **settings):
+        for k, v in settings.items():
+            setattr(fw, k, v)
+        fw.print = lambda *a, **k: None
+        shutil.copytree(STATIC, "static")
+        self.fw = fw
+        self.srv = fw.HttpServer(host.mp_select(fw), fw.get_state)
+        fw.web = self.srv
+        self.port = self.srv.sock.getsockname()[1]
+        self.stop = False
+        self.max_gap = 0.0
+        self.thread = threading.Thread(target=self._run)
+
+    def _run(self):
+        fw = self.fw
+        last = time.monotonic()
+        while not self.stop:
+            fw.events.tick(time.ticks_ms(), fw.get_state)
+            if not self.srv.poll(time.ticks_ms()):
+                time.sleep(0.002)
+            now = time.monotonic()
+            self.max_gap = max(self.max_gap, now - last)
+            last = now
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop = True
+        self.thread.join()
+        self.srv.sock.close()
+
+    def connect(self):
+        return socket.create_connection(("127.0.0.1", self.port), timeout=5)
+
+    def get(self, path, headers=b""):
+        s = self.connect()
+        s.sendall(b"GET " + path + b" HTTP/1.1\r\nHost: x\r\n" + headers + b"\r\n")
+        out = b""
+        while True:
+            d = s.recv(4096)
+            if not d:
+                break
+            out += d
+        s.close()
+        return out
+
+    def pools_full(self):
+        n = self.fw.HTTP_MAX_CONNS
+        return not self.srv.conns and len(self.srv.pool) == n and len(self.srv.tx_pool) == n
+
+
+def status(resp):
+    # status code, after checking Content-Length against the body actually received
+    head, body = resp.split(b"\r\n\r\n", 1)
+    lines = head.split(b"\r\n")
+    code = int(lines[0].split()[1])
+    for line in lines[1:]:
+        if line.lower().startswith(b"content-length:"):
+            assert int(line.split(b":")[1]) == len(body)
+    return code
+
+
+def wait_for(cond, timeout=3.0):
+    for _ in range(int(timeout / 0.01)):
+        if cond():
+            return
+        time.sleep(0.01)
+    raise AssertionError("timed out")
+
+
+def test_many_concurrent_clients(fw):
+    codes = {}
+    lock = threading.Lock()
+
+    def client(i, loop):
+        for k in range(8):
+            try:
+                code = status(loop.get(PATHS[(i + k) % len(PATHS)], b"Accept-Encoding: gzip\r\n" if k % 2 else b""))
+            except OSError as e:
+                code = repr(e)
+            with lock:
+                codes[code] = codes.get(code, 0) + 1
+
+    with Loop(fw) as loop:
+        clients = [threading.Thread(target=client, args=(i, loop)) for i in range(32)]
+        for t in clients:
+            t.start()
+        for t in clients:
+            t.join()
+        wait_for(loop.pools_full)
+        assert codes == {200: 256}
+        assert loop.srv.served == 256 and loop.srv.rejected == 0
+        assert loop.max_gap < 0.5  # no pass waits on a client
+
+
+def test_stalled_clients_time_out(fw):
+    with Loop(fw, HTTP_IDLE_TIMEOUT_MS=300) as loop:
+        stalled = [loop.connect() for _ in range(fw.HTTP_MAX_CONNS - 1)]
+        for s in stalled:
+            s.sendall(b"GET / HTTP/1.1\r\nHo")  # half a request, then nothing
+        time.sleep(0.1)
+        assert status(loop.get(b"/api/state")) == 200  # the one free slot still serves
+        # a full house: the next client waits in the backlog until the stalled ones time out
+        blocker = loop.connect()
+        blocker.sendall(b"GET / HTTP/1.1\r\nHo")
+        t0 = time.monotonic()
+        assert status(loop.get(b"/static/app.css")) == 200
+        assert time.monotonic() - t0 > 0.15
+        wait_for(lambda: loop.srv.timeouts == fw.HTTP_MAX_CONNS)
+        assert all(s.recv(100) == b"" for s in stalled)
+        wait_for(loop.pools_full)
+        blocker.close()
+
+
+def test_rejected_requests_return_buffers(fw):
+    with Loop(fw) as loop:
+        assert status(loop.get(b"/nope")) == 404
+        s = loop.connect()
+        s.sendall(b"POST /settings HTTP/1.1\r\nContent-Length: 99999\r\n\r\n")
+        assert status(s.recv(4096)) == 413
+        s.close()
+        wait_for(loop.pools_full)
+        assert loop.srv.rejected == 2
+
+
+def test_sse_handover_keeps_socket_returns_buffers(fw):
+    with Loop(fw) as loop:
+        s = loop.connect()
+        s.sendall(b"GET /api/events HTTP/1.1\r\n\r\n")
+        assert b"text/event-stream" in s.recv(4096)
+        wait_for(lambda: len(fw.events.clients) == 1)
+        wait_for(loop.pools_full)  # the stream's socket now belongs to the event stream
+        fw.state.latest_temp = 30.5
+        assert b"data:" in s.recv(4096)
+        s.close()
+
+
+@pytest.mark.parametrize("path", [b"/", b"/static/app.js"])
+def test_page_larger_than_one_chunk(fw, path):
+    with Loop(fw) as loop:
+        resp = loop.get(path)
+        assert status(resp) == 200 and len(resp) > fw.HTTP_CHUNK
+
+
+def test_field_values_escaped(fw):
+    fw.wifi_pass = 'pa"ss<&>'
+    page = b"".join(fw.template_parts(fw.HTML, fw.page_values("settings", "Counter reset & saved.")))
+    assert b'value="pa&quot;ss&lt;&amp;&gt;"' in page
+    assert b"Counter reset &amp; saved." in page
+    assert len(page) == fw.template_len(fw.HTML, fw.page_values("settings", "Counter reset & saved."))
+
+
+def test_posted_quote_round_trips(fw):
+    with Loop(fw) as loop:
+        s = loop.connect()
+        body = b"ssid=my%22net&password=a%26b&mode=dhcp"
+        s.sendall(b"POST /settings HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % len(body) + body)
+        out = b""
+        while True:
+            d = s.recv(4096)
+            if not d:
+                break
+            out += d
+        s.close()
+        assert status(out) == 200
+        assert fw.wifi_ssid == 'my"net'
+        assert b'value="my&quot;net"' in out and b'value="a&amp;b"' in out
+
+
+class FakeConn:
+    def __init__(self):
+        self.out = []
+        self.then = None
+
+    def sendall(self, data):
+        self.out.append(bytes(data))
+
+    def send(self, data):
+        self.out.append(bytes(data))
+        return len(data)
+
+
+def test_sse_diag_after_ticks_half_range(fw, monkeypatch):
+    # a dashboard opened after 2^29 ms of uptime (past half the ticks range) still gets diagnostics
+    events = fw.EventStream()  # created at boot
+    start = time.ticks_add(time.ticks_ms(), (1 << 29) + 1000)
+    monkeypatch.setattr(time, "ticks_ms", lambda: start)
+    passes = []
+
+    def get_state(diag=False):
+        passes.append(diag)
+        return {"t": len(passes)}
+
+    c = FakeConn()
+    events.open(c, get_state)
+    c.then(c)
+    passes.clear()
+    for i in range(200):
+        events.tick(time.ticks_add(start, i * 100), get_state)
+    assert sum(passes) == 3  # every SSE_DIAG_MS over 20 s
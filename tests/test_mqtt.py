@@ -0,0 +1,168 @@
+"""MqttClient against the in-process broker stand-in (tests/mqtt_broker.py)."""
+
+import asyncio
+import json
+import time
+
+from mqtt_broker import Broker
+
+
+def run(fw, scenario, **settings):
+    # point the firmware at a fresh broker and run scenario(client, broker)
+    async def main():
+        broker = await Broker().start()
+        fw.MQTT_HOST = "127.0.0.1"
+        fw.MQTT_PORT = broker.port
+        fw.UPLOAD_DEVICE_ID = "dev1"
+        fw.UPLOAD_PDID = "PO-1"
+        fw.MQTT_TOPIC = "plant"
+        for k, v in settings.items():
+            setattr(fw, k, v)
+        client = fw.MqttClient()
+        try:
+            await scenario(client, broker)
+        finally:
+            client.close()
+            await broker.stop()
+
+    asyncio.run(main())
+
+
+def counter(i):
+    return ("C", i, 100 + i, 7, 0, 1_700_000_000 + i)
+
+
+def test_connect(fw):
+    async def scenario(c, b):
+        await c.connect()
+        assert c.connected()
+        assert b.connects == [{"client_id": "dev1", "clean": False, "keepalive": 30,
+                               "user": "u", "password": "p"}]
+
+    run(fw, scenario, MQTT_USER="u", MQTT_PASS="p", MQTT_KEEPALIVE_S=30)
+
+
+def test_publish_qos1_acked(fw):
+    async def scenario(c, b):
+        await c.connect()
+        await c.publish(counter(1))
+        await c.publish(("T", 21.25, 1_700_000_000))
+        await b.settle(2)
+        await asyncio.sleep(0.05)
+        topic, payload, qos, dup, pid = b.publishes[0]
+        assert (topic, qos, dup, pid) == ("plant/dev1/PO-1/counter", 1, False, 1)
+        assert json.loads(payload) == {"qty": 1, "accm": 101, "cpm": 7, "ts": 1_700_000_001}
+        assert b.publishes[1][0] == "plant/dev1/temp"
+        assert abs(json.loads(b.publishes[1][1])["temp"] - 21.25) < 0.1
+        assert c.acked == 2 and not c.inflight
+
+    run(fw, scenario)
+
+
+def test_qos0_has_no_packet_id(fw):
+    async def scenario(c, b):
+        await c.connect()
+        await c.publish(counter(2))
+        await b.settle(1)
+        assert b.publishes[0][2:] == (0, False, 0)
+        assert not c.inflight
+
+    run(fw, scenario, MQTT_QOS=0)
+
+
+def test_puback_window(fw):
+    async def scenario(c, b):
+        await c.connect()
+        b.ack = False
+        for i in range(fw.MQTT_INFLIGHT):
+            await c.publish(counter(i))
+        assert len(c.inflight) == fw.MQTT_INFLIGHT
+        # the window is full: the next publish waits for a PUBACK
+        blocked = asyncio.ensure_future(c.publish(counter(99)))
+        await asyncio.sleep(0.2)
+        assert not blocked.done()
+        await b.release()
+        await asyncio.wait_for(blocked, 1)
+        await b.settle(fw.MQTT_INFLIGHT + 1)
+        await asyncio.sleep(0.05)
+        assert c.acked == fw.MQTT_INFLIGHT + 1 and not c.inflight
+
+    run(fw, scenario)
+
+
+def test_pingreq_when_idle(fw):
+    async def scenario(c, b):
+        await c.connect()
+        await asyncio.sleep(0.6)  # past half the 1 s keepalive
+        await c.tick(time.ticks_ms())
+        await asyncio.sleep(0.05)
+        assert b.pings == 1
+        await c.tick(time.ticks_ms())
+        assert b.pings == 1  # the ping just went out; nothing more until the next half interval
+        assert c.connected()
+
+    run(fw, scenario, MQTT_KEEPALIVE_S=1)
+
+
+def test_keepalive_timeout_closes(fw):
+    async def scenario(c, b):
+        b.answer_pings = False
+        await c.connect()
+        for _ in range(4):
+            await asyncio.sleep(0.45)
+            await c.tick(time.ticks_ms())
+        assert not c.connected()  # nothing heard for 1.5 keepalive intervals
+
+    run(fw, scenario, MQTT_KEEPALIVE_S=1)
+
+
+def test_reconnect_resends_with_dup(fw):
+    async def scenario(c, b):
+        await c.connect()
+        b.ack = False
+        for i in range(3):
+            await c.publish(counter(i))
+        await b.settle(3)
+        b.drop()
+        b.held = []
+        b.ack = True
+        await asyncio.sleep(0.05)
+        await c.connect()
+        await b.settle(6)
+        await asyncio.sleep(0.05)
+        resent = b.publishes[3:]
+        assert [p[4] for p in resent] == [p[4] for p in b.publishes[:3]]  # same packet ids
+        assert all(p[3] for p in resent)  # DUP set
+        assert [p[1] for p in resent] == [p[1] for p in b.publishes[:3]]
+        assert not c.inflight and c.connects == 2
+        assert not b.connects[1]["clean"]
+
+    run(fw, scenario)
+
+
+def test_abandon_returns_unacked(fw):
+    async def scenario(c, b):
+        await c.connect()
+        b.ack = False
+        await c.publish(counter(5))
+        await c.publish(counter(6))
+        c.close()
+        assert sorted(item[1] for item in c.abandon()) == [5, 6]
+        assert not c.inflight
+
+    run(fw, scenario)
+
+
+def test_failed_ping_closes(fw):
+    async def scenario(c, b):
+        await c.connect()
+        await asyncio.sleep(0.6)
+
+        def unreachable(data):
+            raise OSError(113)
+
+        c.writer.write = unreachable  # Wi-Fi gone: the next socket write fails
+        await c.tick(time.ticks_ms())  # must not raise
+        assert not c.connected()
+
+    run(fw, scenario, MQTT_KEEPALIVE_S=1)
@@ -0,0 +1,62 @@
+"""Pre-sized record files and their crc seal: the upload spool and the counter journal."""
+
+import os
+
+
+def test_seal_and_check(fw):
+    rec = bytearray(b"\x43\x01\xff\xff" + bytes(range(16)))
+    crc = fw.crc_seal(rec, 2)
+    assert rec[2] | rec[3] << 8 == crc
+    assert fw.crc_check(rec, 2)
+    rec[10] ^= 0x40
+    assert not fw.crc_check(bytearray(rec), 2)
+
+
+def test_spool_presized_and_skips_corrupt(fw):
+    sp = fw.Spool("spool.bin", 40)
+    size = fw._SPOOL_HDR_LEN + 40 * fw._SPOOL_REC_LEN
+    assert os.path.getsize("spool.bin") == size
+    for i in range(3):
+        sp.append(("C", i, 100 + i, 5, 0, 1_700_000_000 + i))
+    sp.flush()
+    assert os.path.getsize("spool.bin") == size
+    with open("spool.bin", "r+b") as f:
+        f.seek(fw._SPOOL_HDR_LEN + fw._SPOOL_REC_LEN + 8)  # a value byte of the second record
+        f.write(b"\x99")
+    assert [it[1] for it in fw.Spool("spool.bin", 40).peek(3)] == [0, 2]
+
+
+def test_journal_presized_and_skips_torn(fw):
+    p = fw.PulseChannels("20:a,21:b")
+    j = fw.CounterJournal("jrn{}.bin", 3, 20)
+    assert j.replay(p) == 0
+    assert [os.path.getsize("jrn{}.bin".format(s)) for s in range(3)] == [20 * fw._JRN_REC_LEN] * 3
+    p.count[0], p.accm[0] = 5, 50
+    p.count[1], p.accm[1] = 7, 70
+    j.append(p, force=True)
+    p.count[0], p.accm[0] = 6, 60
+    j.append(p)  # third record: channel 0 only
+    with open("jrn0.bin", "r+b") as f:
+        f.seek(2 * fw._JRN_REC_LEN + 8)  # tear the newest record
+        f.write(b"\x00\x00")
+    q = fw.PulseChannels("20:a,21:b")
+    assert fw.CounterJournal("jrn{}.bin", 3, 20).replay(q) == 2
+    assert (q.count[0], q.accm[0], q.count[1], q.accm[1]) == (5, 50, 7, 70)
+
+
+def test_spool_survives_missing_file(fw):
+    sp = fw.Spool("spool.bin", 16)
+    sp.append(("C", 1, 101, 5, 0, 1_700_000_001))
+    sp.flush()
+    os.remove("spool.bin")
+    assert sp.peek(4) == []
+    assert sp.count() == 0 and os.path.getsize("spool.bin") == fw._SPOOL_HDR_LEN + 16 * fw._SPOOL_REC_LEN
+    sp.append(("C", 2, 102, 5, 0, 1_700_000_002))
+    assert [it[1] for it in sp.peek(4)] == [2]
+
+
+def test_spool_unwritable_path(fw):
+    os.mkdir("spool.bin")  # open() of the file fails, as on a full or broken filesystem
+    sp = fw.Spool("spool.bin", 16)
+    sp.append(("T", 21.5, 1_700_000_000))
+    assert sp.peek(4) == [] and sp.count() == 0
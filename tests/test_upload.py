@@ -0,0 +1,22 @@
+"""Upload request building: the same text as the old str.format-based GET path."""
+
+import random
+
+
+def test_fixed1_matches_format(fw):
+    c = fw.TxBuffer(64, 16)
+    values = [0.05, -0.05, 0.15, 0.25, 21.25, -0.04, 0.0, 99.95, -273.15, 1e6 + 0.05]
+    rng = random.Random(3)
+    values += [rng.uniform(-50, 150) for _ in range(2000)]
+    values += [round(rng.uniform(-50, 150), 2) for _ in range(2000)]  # two-decimal register readings
+    for v in values:
+        c.n = 0
+        c.put_fixed1(v)
+        assert bytes(c.tx[:c.n]) == "{:.1f}".format(v).encode(), v
+
+
+def test_temp_get_request(fw):
+    c = fw.HttpClient()
+    fw.upload_request(c, ("T", 0.05, 1_700_000_000), replay=True)
+    line = bytes(c.tx[:c.head_len]).split(b" HTTP/1.1")[0]
+    assert line == b"GET /" + fw.UPLOAD_TEMP_PATH.encode() + b"?devid=smart01&temp=0.1&kfactor=100&ts=1700000000"
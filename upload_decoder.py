@@ -0,0 +1,79 @@
+"""Reference decoder for the binary upload frames sent by esp32c3-rs485-pt100.py.
+
+Frames are the body of a bulk POST (Content-Type: application/octet-stream)
+or the payload of an MQTT publish when the Upload tab selects binary encoding.
+All fields are little-endian:
+
+    header  <BBIIHB  version (2), record count, FNV-1a hash of devid,
+                     frame sequence number (since boot), kfactor, pdid length
+    pdid    <pdid length> bytes of UTF-8
+    record  <BBIiIH  kind, counter channel, captured unix ts, a, b, c
+                     (repeated count times; version 1 records have no channel byte)
+
+    kind "T": a = temperature * 100 (kfactor already applied), b = c = 0
+    kind "C": a = qty, b = accm, c = cpm; channel 0 is the primary counter
+
+Plain Python, no dependencies, so the ingest side can import it as is.
+"""
+
+import struct
+import sys
+
+FRAME_HDR = "<BBIIHB"
+FRAME_HDR_LEN = struct.calcsize(FRAME_HDR)
+FRAME_REC = "<BBIiIH"
+FRAME_REC_LEN = struct.calcsize(FRAME_REC)
+FRAME_REC_V1 = "<BIiIH"
+FRAME_REC_V1_LEN = struct.calcsize(FRAME_REC_V1)
+
+
+def device_hash(devid):
+    # FNV-1a 32-bit, as computed on the device; map hashes back to ids with a lookup table
+    h = 0x811C9DC5
+    for b in devid.encode():
+        h = ((h ^ b) * 0x01000193) & 0xFFFFFFFF
+    return h
+
+
+def decode_frame(data):
+    """Decode one frame into a dict; raises ValueError on a malformed frame."""
+    if len(data) < FRAME_HDR_LEN:
+        raise ValueError("frame too short")
+    version, count, devhash, seq, kfactor, pdid_len = struct.unpack_from(FRAME_HDR, data, 0)
+    if version == 2:
+        rec, rec_len = FRAME_REC, FRAME_REC_LEN
+    elif version == 1:
+        rec, rec_len = FRAME_REC_V1, FRAME_REC_V1_LEN
+    else:
+        raise ValueError("unsupported frame version {}".format(version))
+    off = FRAME_HDR_LEN
+    if len(data) != off + pdid_len + count * rec_len:
+        raise ValueError("frame length does not match its record count")
+    pdid = bytes(data[off:off + pdid_len]).decode()
+    off += pdid_len
+    rows = []
+    for _ in range(count):
+        if version == 1:
+            kind, ts, a, b, c = struct.unpack_from(rec, data, off)
+            ch = 0
+        else:
+            kind, ch, ts, a, b, c = struct.unpack_from(rec, data, off)
+        off += rec_len
+        if kind == ord("T"):
+            rows.append({"kind": "T", "ts": ts, "temp": a / 100})
+        elif kind == ord("C"):
+            rows.append({"kind": "C", "ts": ts, "ch": ch, "qty": a, "accm": b, "cpm": c})
+        else:
+            raise ValueError("unknown record kind {}".format(kind))
+    return {"devhash": devhash, "seq": seq, "kfactor": kfactor, "pdid": pdid, "rows": rows}
+
+
+if __name__ == "__main__":
+    # usage: python upload_decoder.py frame.bin [devid ...]
+    with open(sys.argv[1], "rb") as f:
+        frame = decode_frame(f.read())
+    names = {device_hash(d): d for d in sys.argv[2:]}
+    print("devid", names.get(frame["devhash"], "{:08x}".format(frame["devhash"])),
+          "pdid", frame["pdid"], "seq", frame["seq"], "kfactor", frame["kfactor"])
+    for row in frame["rows"]:
+        print(row)